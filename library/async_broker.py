@@ -0,0 +1,204 @@
+"""
+Asyncio variant of the AMTD client for use inside event loops. Shares payload building and transforms with AMTD,
+only the HTTP layer is swapped for an awaitable transport.
+"""
+
+import asyncio
+import time
+from library.broker import AMTD, APIError, HTTPSession, retry_delay
+from library.ratelimit import AsyncRateLimiter
+
+
+class AiohttpTransport(object):
+    """Default transport for AsyncAMTD. Any object with awaitable get_json(url, params, headers) and
+    post_json(url, headers, data) can replace it, e.g. a stub pointed at a local test server.
+    Throttled (429) and server error (5xx) responses as well as dropped connections are retried with exponential
+    backoff and full jitter like HTTPSession; other error statuses raise APIError."""
+    retry_statuses = HTTPSession.retry_statuses
+    _connection_errors = (ConnectionError, asyncio.TimeoutError)
+
+    def __init__(self, timeout=30, max_retries=5, backoff=0.5, max_backoff=30):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._session = None
+
+    def _client_session(self):
+        if self._session is None:
+            import aiohttp
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._connection_errors = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+        return self._session
+
+    async def _request_json(self, method, url, **kwargs):
+        session = self._client_session()
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with session.request(method, url, **kwargs) as response:
+                    if response.status in self.retry_statuses and attempt < self.max_retries:
+                        delay = retry_delay(attempt, self.backoff, self.max_backoff, response)
+                    elif response.status >= 400:
+                        raise APIError(response.status, url, await response.text())
+                    else:
+                        return await response.json(content_type=None)
+            except self._connection_errors:
+                if attempt == self.max_retries:
+                    raise
+                delay = retry_delay(attempt, self.backoff, self.max_backoff)
+            await asyncio.sleep(delay)
+
+    async def get_json(self, url, params=None, headers=None):
+        params = {k: str(v) for k, v in (params or {}).items() if v is not None}
+        return await self._request_json('GET', url, params=params, headers=headers)
+
+    async def post_json(self, url, headers=None, data=None):
+        return await self._request_json('POST', url, headers=headers, data=data)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class _AwaitableAMTD(AMTD):
+    """AMTD whose _get_json hands back the awaitable request of the owning AsyncAMTD, so the inherited _get_*_raw
+    payload builders return coroutines. Kept private to AsyncAMTD, which never exposes its synchronous methods."""
+    def __init__(self, owner, apikey, base_url):
+        super().__init__(apikey, base_url=base_url)
+        self._owner = owner
+
+    def _get_json(self, url, params=None, headers=None):
+        return self._owner._get_json(url, params=params, headers=headers)
+
+
+class AsyncAMTD(object):
+    """Async TD Ameritrade client. Each public method is a coroutine returning what the AMTD method of the same name
+    returns; iter_30min_price_timeframe is an async generator. Payloads and transforms come from a wrapped AMTD, so
+    only the HTTP layer differs. The quote snapshot and benchmark store are synchronous and live on AMTD only."""
+    def __init__(self, apikey, transport=None, limiter=None, cache=None, base_url="https://api.tdameritrade.com/v1"):
+        self._client = _AwaitableAMTD(self, apikey, base_url)
+        self.cache = cache
+        self.transport = transport if transport is not None else AiohttpTransport()
+        self.limiter = limiter if limiter is not None else AsyncRateLimiter(self._client.rate_limiter)
+
+    async def _get_json(self, url, params=None, headers=None):
+        """Calls the API through the limiter. An authorized call rejected with 401 gets one retry with a freshly
+        generated access token."""
+        try:
+            async with self.limiter:
+                return await self.transport.get_json(url, params=params, headers=headers)
+        except APIError as e:
+            if e.status != 401 or not headers or 'Authorization' not in headers or self._client._refresh_tkn is None:
+                raise
+            await self.generate_access_token(self._client._refresh_tkn)
+            headers = dict(headers, **await self._auth_headers())
+            async with self.limiter:
+                return await self.transport.get_json(url, params=params, headers=headers)
+
+    async def close(self):
+        await self.transport.close()
+
+    async def generate_access_token(self, refresh_tkn):
+        headers, data = self._client._token_request(refresh_tkn)
+        async with self.limiter:
+            r = await self.transport.post_json(self._client.auth_url, headers=headers, data=data)
+        self._client._store_token(refresh_tkn, r)
+
+    async def _auth_headers(self):
+        if self._client._refresh_tkn is not None and time.monotonic() >= self._client._access_tkn_expiry:
+            await self.generate_access_token(self._client._refresh_tkn)
+        return {'Authorization': "Bearer " + str(self._client._access_tkn)}
+
+    async def get_fundamentals(self, symbol: str):
+        raw = await self._client._get_fundamentals_raw(symbol)
+        return self._client._transform_fundamentals(raw, symbol)
+
+    async def get_fundamentals_bulk(self, list_of_tickers, batch_size=100):
+        """Fetches the batches of batch_size symbols concurrently. Failed or missing symbols are listed in the result's
+        attrs['failed_symbols'] like AMTD.get_fundamentals_bulk."""
+        batches = [list(list_of_tickers[i:i + batch_size]) for i in range(0, len(list_of_tickers), batch_size)]
+        results = await asyncio.gather(*[self._client._get_fundamentals_raw(','.join(str(e) for e in batch))
+                                         for batch in batches], return_exceptions=True)
+        data = {}
+        failed = []
+        for batch, raw in zip(batches, results):
+            if isinstance(raw, Exception):
+                failed.extend((symbol, raw) for symbol in batch)
+                continue
+            data.update(raw)
+            failed.extend((symbol, KeyError(symbol)) for symbol in batch if str(symbol) not in raw)
+        fundamentals = self._client._transform_fundamentals(data)
+        fundamentals.attrs['failed_symbols'] = failed
+        return fundamentals
+
+    async def get_daily_price_hist(self, symbol, freq_type, freq, prd_type, prd, reindex = True):
+        raw = await self._client._get_price_hist_raw(symbol, freq_type, freq, prd_type, prd)
+        if reindex:
+            return self._client._price_panel(raw, symbol)
+        return self._client._transform_prices(raw, symbol)
+
+    async def get_daily_price_timeframe(self, symbol, start, end, reindex = True):
+        if self.cache is None:
+            raw = await self._client._get_price_daily_timeframe_raw(symbol, start, end)
+        else:
+            raw = await self._get_price_daily_timeframe_cached(symbol, start, end)
+        if reindex:
+            return self._client._price_panel(raw, symbol)
+        return self._client._transform_prices(raw, symbol)
+
+    async def _get_price_daily_timeframe_cached(self, symbol, start, end):
+        for gap_start, gap_end in self.cache.missing_ranges(symbol, start, end):
+            data = await self._client._get_price_daily_timeframe_raw(symbol, gap_start, gap_end)
+            self.cache.store(symbol, data, gap_start, gap_end)
+        return self.cache.load(symbol, start, end)
+
+    async def get_30min_price_timeframe(self, symbol, start, end):
+        raw = await self._client._get_price_30minute_timeframe_raw(symbol, start, end)
+        return self._client._transform_prices(raw, symbol)
+
+    async def iter_30min_price_timeframe(self, list_of_tickers, start, end, window_days=10):
+        """Async generator of IntradayChunk like AMTD.iter_30min_price_timeframe. The symbols of a window are fetched
+        concurrently and the next window is requested while the current one is being consumed."""
+        if isinstance(list_of_tickers, str):
+            list_of_tickers = [list_of_tickers]
+        pending = None
+        try:
+            for w_start, w_end in self._client._intraday_windows(start, end, window_days):
+                fetch = asyncio.ensure_future(asyncio.gather(
+                    *[self._client._get_price_30minute_timeframe_raw(i, w_start, w_end) for i in list_of_tickers]))
+                if pending is not None:
+                    yield self._client._intraday_chunk(list_of_tickers, pending[0], pending[1], await pending[2])
+                pending = (w_start, w_end, fetch)
+            if pending is not None:
+                yield self._client._intraday_chunk(list_of_tickers, pending[0], pending[1], await pending[2])
+                pending = None
+        finally:
+            if pending is not None:
+                pending[2].cancel()
+
+    async def get_quotes(self, symbol_list: list):
+        raw = await self._client._get_quotes_raw(symbol_list)
+        return self._client._transform_quotes(raw)
+
+    async def get_account_info(self, account, initial_bal=True, projected_bal=True, current_bal=True, current_pos=True):
+        raw = await self._get_json(self._client.account_url.format(account), headers=await self._auth_headers())
+        self._client._transform_account_inf(raw, initial_bal, projected_bal, current_bal, current_pos)
+        return self._client._return_desired_account_data(initial_bal, projected_bal, current_bal, current_pos)
+
+    async def get_daily_prices(self, list_of_tickers, start, end):
+        """Fetches all symbols concurrently, returns a dictionary of dataframes and a list of (symbol, exception)"""
+        results = await asyncio.gather(*[self.get_daily_price_timeframe(i, start, end) for i in list_of_tickers],
+                                       return_exceptions=True)
+        prices = {}
+        failed = []
+        for symbol, result in zip(list_of_tickers, results):
+            if isinstance(result, Exception):
+                failed.append((symbol, result))
+            else:
+                prices[symbol] = result
+        return prices, failed
+
+    async def get_ohlcv_array(self, start, end, list_of_tickers, filter = 0):
+        prices, failed = await self.get_daily_prices(list_of_tickers, start, end)
+        return self._client._ohlcv_array(prices, failed, list_of_tickers, filter)
@@ -0,0 +1,155 @@
+"""
+Vectorized evaluation of many weight vectors against one shared asset return panel.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+from library.timeseries import TimeSeries, rolling_std
+from library.drawdown import drawdown_stats, rolling_max_drawdown
+from library.risk import cornish_fisher_z, sample_skew_kurtosis, rolling_risk
+from library.benchmarks import betas
+
+
+def column_moments(x):
+    """Mean, sample std, and pandas-style bias corrected skew and excess kurtosis of every column of x"""
+    n = x.shape[0]
+    mean = x.mean(axis=0)
+    d = x - mean
+    m2 = (d * d).sum(axis=0)
+    m3 = (d * d * d).sum(axis=0)
+    m4 = (d * d * d * d).sum(axis=0)
+    std = np.sqrt(m2 / (n - 1))
+    skew, kurt = sample_skew_kurtosis(n, m2, m3, m4)
+    return mean, std, skew, kurt
+
+
+class PortfolioBatch(object):
+    """Risk and return metrics for P portfolios (rows of a P x N weight matrix) over one (T x N) asset return panel.
+    Returns are held ascending in time; rows with a missing asset return (e.g. the first row of log returns) are
+    dropped once up front. Every metric is a handful of matrix operations over the (T x P) portfolio return matrix
+    and comes back as an array with one entry per portfolio. An ndarray panel is taken as ascending and has no
+    dates, so positions such as drawdown peaks and window ends come back as row numbers of the kept rows."""
+    def __init__(self, asset_returns, weights, names=None, log=True, periods=252):
+        if isinstance(asset_returns, pd.DataFrame):
+            core = TimeSeries.from_frame(asset_returns)
+            values, index, self.symbols = core.values, core.index, core.symbols
+        else:
+            values = np.asarray(asset_returns, dtype=np.float64).reshape(len(asset_returns), -1)
+            index, self.symbols = None, list(range(values.shape[1]))
+        keep = np.isfinite(values).all(axis=1)
+        self._keep = keep
+        self.index = index[keep] if index is not None else None
+        self.asset_returns = np.ascontiguousarray(values[keep])
+        self.weights = np.atleast_2d(np.asarray(weights, dtype=np.float64))
+        self.names = list(names) if names is not None else list(range(len(self.weights)))
+        self.log = log
+        self.periods = periods
+        self.returns = self.asset_returns @ self.weights.T
+        self._moments = None
+
+    @classmethod
+    def from_portfolio(cls, portfolio, weights, names=None):
+        """Evaluates weight vectors over the assets, window and return type already loaded in a Portfolio"""
+        portfolio.get_historical_asset_returns(log=portfolio._log)
+        return cls(portfolio.asset_returns, weights, names, log=portfolio._log)
+
+    def _align(self, series):
+        """Aligns benchmark or rate series to the kept return rows, by date for a Series or DataFrame when the batch
+        has dates, else by position"""
+        if isinstance(series, (pd.Series, pd.DataFrame)) and self.index is not None:
+            return series.reindex(pd.DatetimeIndex(self.index)).values.astype(np.float64)
+        series = np.asarray(series, dtype=np.float64)
+        return series[self._keep] if len(series) == len(self._keep) else series
+
+    @property
+    def moments(self):
+        if self._moments is None:
+            self._moments = column_moments(self.returns)
+        return self._moments
+
+    def total_returns(self):
+        return self.returns.sum(axis=0)
+
+    def volatility(self, window=None, annualized=True):
+        """Full sample volatility per portfolio, or the (T x P) rolling volatility if a window is given"""
+        vol = self.moments[1] if window is None else rolling_std(self.returns, window)
+        return vol * np.sqrt(self.periods) if annualized else vol
+
+    def skew(self):
+        return self.moments[2]
+
+    def kurtosis(self):
+        return self.moments[3]
+
+    def var_historic(self, level=5):
+        return -np.percentile(self.returns, level, axis=0)
+
+    def cvar_historic(self, level=5):
+        beyond = self.returns <= -self.var_historic(level)
+        return -(self.returns * beyond).sum(axis=0) / beyond.sum(axis=0)
+
+    def parametric_var(self, level=5, modified=False):
+        mean, std, skew, kurt = self.moments
+        z = norm.ppf(level / 100)
+        if modified:
+            z = cornish_fisher_z(z, skew, kurt)
+        return -(mean + z * std)
+
+    def rolling_risk(self, levels=(5,), window=250, step=1):
+        """Historic VaR/CVaR, parametric and modified VaR of every portfolio at every level over trailing windows,
+        see risk.rolling_risk. 'end' holds the window end dates, or rows for array input."""
+        risk = rolling_risk(self.returns, levels, window, step)
+        if self.index is not None:
+            risk['end'] = self.index[risk['end']]
+        return risk
+
+    def sharpe_ratio(self, risk_free=0.0):
+        """Same definition as Portfolio.sharpe_ratio. risk_free is a flat rate over the window or an array of
+        per period rates aligned to the returns."""
+        if np.ndim(risk_free) or isinstance(risk_free, pd.Series):
+            excess = (self.returns - self._align(risk_free)[:, None]).sum(axis=0)
+        else:
+            excess = self.returns.sum(axis=0) - risk_free
+        return excess / (self.moments[1] * np.sqrt(self.periods))
+
+    def beta(self, benchmark_returns):
+        """Beta of every portfolio to one benchmark return series, a dated Series or an array matching the rows.
+        A DataFrame or 2-D array of several benchmarks gives a (portfolios x benchmarks) array."""
+        if np.ndim(benchmark_returns) == 2:
+            return betas(self.returns, self._align(benchmark_returns))
+        return betas(self.returns, self._align(benchmark_returns))[:, 0]
+
+    def values(self):
+        """(T x P) growth of one unit invested in each portfolio"""
+        if self.log:
+            return np.exp(np.cumsum(self.returns, axis=0))
+        return np.cumprod(1 + self.returns, axis=0)
+
+    def max_drawdown(self):
+        return self.drawdowns()['max_drawdown']
+
+    def drawdowns(self, window=None):
+        """Drawdown statistics of every portfolio, see drawdown.drawdown_stats, plus the (T x P) rolling
+        max drawdown if a window is given"""
+        values = self.values()
+        stats = drawdown_stats(values, self.index)
+        if window is not None:
+            stats['rolling_max_drawdown'] = rolling_max_drawdown(values, window)
+        return stats
+
+    def summary(self, level=5, risk_free=0.0, benchmark_returns=None):
+        """DataFrame of the headline metrics with one row per portfolio"""
+        table = {'Returns': self.total_returns(),
+                 'Volatility': self.volatility(),
+                 'Sharpe Ratio': self.sharpe_ratio(risk_free),
+                 'Skew': self.skew(),
+                 'Kurtosis': self.kurtosis(),
+                 'VaR': self.var_historic(level),
+                 'CVaR': self.cvar_historic(level),
+                 'Parametric VaR': self.parametric_var(level),
+                 'Modified VaR': self.parametric_var(level, modified=True),
+                 'Max Drawdown': self.max_drawdown()}
+        if benchmark_returns is not None:
+            table['Beta'] = self.beta(benchmark_returns)
+        return pd.DataFrame(table, index=self.names)
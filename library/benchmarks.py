@@ -0,0 +1,139 @@
+"""
+Benchmark returns shared by every Portfolio on a client, and one-pass betas against many benchmarks.
+"""
+
+import threading
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+from library.timeseries import TimeSeries, window_sums
+
+
+class BenchmarkStore(object):
+    """Daily closes of benchmark symbols (SPY, QQQ, sector ETFs, ...) kept per symbol with the date window they
+    cover. A symbol is downloaded once per window and requests inside a stored window are served from memory, so
+    portfolios sharing a client share the downloads. A request reaching outside refetches the combined window.
+    Missing symbols are fetched together on the source's thread pool."""
+    def __init__(self, source):
+        self.source = source
+        self._closes = {}
+        self._lock = threading.Lock()
+        self.downloads = 0
+
+    def closes(self, symbols, start, end):
+        """DataFrame of closes by symbol on an ascending date index, start and end inclusive"""
+        start, end = pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize()
+        symbols = [str(s) for s in symbols]
+        with self._lock:
+            stale = {}
+            for symbol in dict.fromkeys(symbols):
+                if symbol in self._closes:
+                    stored_start, stored_end, _ = self._closes[symbol]
+                    if stored_start <= start and end <= stored_end:
+                        continue
+                    stale.setdefault((min(stored_start, start), max(stored_end, end)), []).append(symbol)
+                else:
+                    stale.setdefault((start, end), []).append(symbol)
+            for (fetch_start, fetch_end), group in stale.items():
+                self._fetch(group, fetch_start, fetch_end)
+            return pd.DataFrame({s: self._closes[s][2].loc[start:end] for s in symbols}, columns=symbols)
+
+    def _fetch(self, symbols, start, end):
+        prices, failed = self.source.get_daily_prices(symbols, start.strftime('%Y-%m-%d'),
+                                                      (end + pd.Timedelta(days=1)).strftime('%Y-%m-%d'))
+        if failed:
+            raise KeyError("No benchmark prices returned for {}".format(failed))
+        self.downloads += len(symbols)
+        for symbol in symbols:
+            close = prices[symbol]['close'][symbol].sort_index()
+            self._closes[symbol] = (start, end, close)
+
+    def returns(self, symbols, start, end, log=True):
+        """Log or simple returns of the benchmarks from their closes between start and end, ascending by date.
+        The first date has no return, so results do not depend on what else is stored."""
+        closes = TimeSeries.from_frame(self.closes(symbols, start, end))
+        returns = closes.log_returns() if log else closes.simple_returns()
+        return returns.to_frame(descending=False)
+
+    def clear(self):
+        with self._lock:
+            self._closes = {}
+
+
+def betas(returns, benchmarks):
+    """Betas of every column of a (T x A) return matrix to every column of a (T x B) benchmark matrix, from a few
+    matrix products instead of a covariance matrix per pair. Each pair uses the rows where both are finite, like
+    pandas' pairwise cov. Returns an (A x B) array."""
+    returns = np.asarray(returns, dtype=np.float64).reshape(len(returns), -1)
+    benchmarks = np.asarray(benchmarks, dtype=np.float64).reshape(len(benchmarks), -1)
+    x_valid = np.isfinite(returns).astype(np.float64)
+    b_valid = np.isfinite(benchmarks).astype(np.float64)
+    x = np.where(x_valid > 0, returns, 0.0)
+    b = np.where(b_valid > 0, benchmarks, 0.0)
+    # shifting a column leaves its covariances unchanged and keeps the sums of products small
+    x = (x - x.sum(axis=0) / np.maximum(x_valid.sum(axis=0), 1)) * x_valid
+    b = (b - b.sum(axis=0) / np.maximum(b_valid.sum(axis=0), 1)) * b_valid
+    n = x_valid.T @ b_valid
+    sum_x = x.T @ b_valid
+    sum_b = x_valid.T @ b
+    sum_xb = x.T @ b
+    sum_bb = x_valid.T @ (b * b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = sum_xb - sum_x * sum_b / n
+        var = sum_bb - sum_b * sum_b / n
+        return cov / var
+
+
+def _pair_moments(returns, benchmarks):
+    """Centred, NaN-zeroed per pair (T x A x B) terms whose sums give the cross moments, and the column centres"""
+    x_valid = np.isfinite(returns)
+    b_valid = np.isfinite(benchmarks)
+    x_centre = np.where(x_valid, returns, 0.0).sum(axis=0) / np.maximum(x_valid.sum(axis=0), 1)
+    b_centre = np.where(b_valid, benchmarks, 0.0).sum(axis=0) / np.maximum(b_valid.sum(axis=0), 1)
+    x = np.where(x_valid, returns - x_centre, 0.0)[:, :, None]
+    b = np.where(b_valid, benchmarks - b_centre, 0.0)[:, None, :]
+    valid = (x_valid[:, :, None] & b_valid[:, None, :]).astype(np.float64)
+    terms = {'n': valid, 'x': x * valid, 'b': b * valid, 'xx': x * x * valid, 'bb': b * b * valid, 'xb': x * b}
+    return terms, x_centre[None, :, None], b_centre[None, None, :]
+
+
+def rolling_betas(returns, benchmarks, window=None, halflife=None, risk_free=None):
+    """Time-varying beta, correlation and alpha of every column of a (T x A) return matrix to every column of a
+    (T x B) benchmark matrix, over trailing windows of `window` rows or with exponential weights of the given
+    halflife (pandas ewm weighting, adjust=True). Cross moments come from running sums, so the cost is
+    O(T x A x B) whatever the window. Pairs are NaN until a window holds `window` joint observations, or for
+    ewm until two. risk_free, a per period rate array, is taken off both sides first. alpha is the per period
+    regression intercept. Returns a dictionary of (T x A x B) arrays 'beta', 'correlation' and 'alpha'."""
+    if (window is None) == (halflife is None):
+        raise ValueError("Pass exactly one of window or halflife")
+    returns = np.asarray(returns, dtype=np.float64).reshape(len(returns), -1)
+    benchmarks = np.asarray(benchmarks, dtype=np.float64).reshape(len(benchmarks), -1)
+    if risk_free is not None:
+        risk_free = np.asarray(risk_free, dtype=np.float64).reshape(-1, 1)
+        returns, benchmarks = returns - risk_free, benchmarks - risk_free
+    terms, x_centre, b_centre = _pair_moments(returns, benchmarks)
+    shape = (len(returns),) + terms['n'].shape[1:]
+    if window is not None:
+        sums = {}
+        for name, term in terms.items():
+            sums[name] = np.full(shape, np.nan)
+            if len(returns) >= window:
+                sums[name][window - 1:] = window_sums(term, window)
+        enough = sums['n'] >= window
+    else:
+        decay = 0.5 ** (1 / halflife)
+        sums = {name: lfilter([1.0], [1.0, -decay], term, axis=0) for name, term in terms.items()}
+        enough = np.cumsum(terms['n'], axis=0) >= 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = sums['n']
+        mean_x = sums['x'] / n
+        mean_b = sums['b'] / n
+        cov = sums['xb'] / n - mean_x * mean_b
+        var_x = np.maximum(sums['xx'] / n - mean_x * mean_x, 0)
+        var_b = np.maximum(sums['bb'] / n - mean_b * mean_b, 0)
+        beta = cov / var_b
+        correlation = cov / np.sqrt(var_x * var_b)
+        alpha = (mean_x + x_centre) - beta * (mean_b + b_centre)
+    return {'beta': np.where(enough, beta, np.nan),
+            'correlation': np.where(enough, correlation, np.nan),
+            'alpha': np.where(enough, alpha, np.nan)}
@@ -7,6 +7,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import time
+from library.frontier import EfficientFrontier
 
 class portfolio(object):
     """Portfolio Object to get data from TD Ameritrade API, calculate returns, and get Mean-Variance Portfolio."""
@@ -71,42 +72,57 @@ class portfolio(object):
         self.current_ps = self.close.tail(1)
         return self.returns
 
-    def markowitz_ef(self, num_folios):
+    def markowitz_ef(self, num_folios, chunk_size = 100000, concentration = 1.0, seed = None):
+        """Scores num_folios random long-only portfolios into pf_df. Weights are Dirichlet draws, uniform over the
+        simplex for concentration 1. pf_df keeps every portfolio for the plot, so its memory grows with num_folios
+        whatever the chunk_size: chunking only bounds the temporary arrays of the draws and the variance products."""
         #input is the list of symbols and the dataframe of close prices
-        port_returns = []
-        port_volatility = []
-        stock_weights = []
-        sharpe_ratio = []
         num_assets = len(self.folio.symbol)
         num_portfolios = num_folios
 
+        self._annual_moments()
+        mean = self.returns_annual.values
+        cov = self.cov_annual.values
+        rng = np.random.default_rng(seed)
+        results = np.empty((num_portfolios, 3 + num_assets))
+        for start in range(0, num_portfolios, chunk_size):
+            chunk = results[start:start + chunk_size]
+            weights = chunk[:, 3:]
+            weights[:] = rng.dirichlet(np.full(num_assets, concentration), size=len(chunk))
+            chunk[:, 0] = weights @ mean
+            chunk[:, 1] = np.sqrt(np.einsum('ij,ij->i', weights @ cov, weights))
+            chunk[:, 2] = chunk[:, 0] / chunk[:, 1]
+        column_order = ['Returns', 'Volatility', 'Sharpe Ratio'] + [stock + ' Weight' for stock in self.folio.symbol]
+        self.pf_df = pd.DataFrame(results, columns=column_order, copy=False)
+        return print("Markowitz Portofolio Matrix Complete; Shape = {}".format(self.pf_df.shape))
+
+    def _annual_moments(self):
         self.returns_daily = self.close.pct_change()
         self.returns_annual = self.returns_daily.mean() * 250
         self.cov_daily = self.returns_daily.cov()
         self.cov_annual = self.cov_daily * 250
-        for single_portfolio in range(num_portfolios):
-            weights = np.random.random(num_assets)
-            weights = weights / np.sum(weights)
-            returns = np.dot(weights, self.returns_annual)
-            volatility = np.sqrt(np.dot(weights.T, np.dot(self.cov_annual, weights)))
-            port_returns.append(returns)
-            port_volatility.append(volatility)
-            sharpe = returns / volatility
-            sharpe_ratio.append(sharpe)
-            stock_weights.append(weights)
-        self.portfolio = {'Returns': port_returns,
-                     'Volatility': port_volatility,
-                     'Sharpe Ratio': sharpe_ratio}
-        # extend original dictionary to accomodate each ticker and weight in the portfolio
-        for counter, symbol in enumerate(self.folio.symbol):
-            self.portfolio[symbol + ' Weight'] = [Weight[counter] for Weight in stock_weights]
-        # make a nice dataframe of the extended dictionary
-        self.pf_df = pd.DataFrame(self.portfolio)
-        # get better labels for desired arrangement of columns
-        column_order = ['Returns', 'Volatility', 'Sharpe Ratio'] + [stock + ' Weight' for stock in self.folio.symbol]
-        # reorder dataframe columns
-        self.pf_df = self.pf_df[column_order]
-        return print("Markowitz Portofolio Matrix Complete; Shape = {}".format(self.pf_df.shape))
+
+    def efficient_frontier(self, points = 50, long_only = True, risk_free = 0.0):
+        """Exact frontier instead of sampling. Sets frontier_df (same columns as pf_df) and replaces
+        min_variance_port and sharpe_portfolio with the exact portfolios, so get_balanced_portfolio uses them."""
+        self._annual_moments()
+        self.ef = EfficientFrontier(self.returns_annual, self.cov_annual, risk_free, long_only)
+        self.frontier_df = self.ef.frontier(points)
+        self.min_variance_port = self.ef.table(self.ef.min_variance()).T
+        self.sharpe_portfolio = self.ef.table(self.ef.tangency()).T
+        return self.frontier_df
+
+    def benchmark_frontier(self, num_folios = 100000):
+        """Min volatility, max Sharpe ratio and seconds taken by sampling num_folios portfolios vs the exact solver"""
+        rows = {}
+        start = time.perf_counter()
+        self.markowitz_ef(num_folios)
+        rows['Sampled'] = [self.pf_df['Volatility'].min(), self.pf_df['Sharpe Ratio'].max(), time.perf_counter() - start]
+        start = time.perf_counter()
+        self.efficient_frontier()
+        rows['Exact'] = [self.min_variance_port.loc['Volatility'].item(), self.sharpe_portfolio.loc['Sharpe Ratio'].item(),
+                         time.perf_counter() - start]
+        return pd.DataFrame.from_dict(rows, orient='index', columns=['Min Volatility', 'Max Sharpe', 'Seconds'])
 
     def get_min_var_pf(self):
         # find min Volatility & max sharpe values in the dataframe (df)
@@ -141,7 +157,9 @@ class portfolio(object):
         print("Maximum Sharpe Portfolio:")
         print(self.sharpe_portfolio.T)
 
-    def get_balanced_portfolio(self, var_or_sharpe):
+    def get_balanced_portfolio(self, var_or_sharpe, exact = False):
+        if exact:
+            self.efficient_frontier()
         if var_or_sharpe == "var":
             self.new_weights = self.min_variance_port.T.filter(like='Weight')
         elif var_or_sharpe == "sharpe":
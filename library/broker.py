@@ -1,35 +1,172 @@
+import collections
 import datetime
+import random
+import threading
+import time
 import urllib.parse
+import numpy as np
 import pandas as pd
-import time
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import orjson as json
+except ImportError:
+    import json
+from library.pricecache import PriceCache
+from library.ratelimit import TokenBucket
+from library.quotes import QuoteSnapshot
+from library.benchmarks import BenchmarkStore
+from library.yieldcurve import YieldCurve, default_curve
+
+
+IntradayChunk = collections.namedtuple('IntradayChunk', ['prices', 'start', 'end', 'cursor'])
+
+
+class APIError(Exception):
+    """Raised when the API answers with an error status that retrying did not fix."""
+    def __init__(self, status, url, text):
+        super().__init__("HTTP {} from {}: {}".format(status, url, text[:200]))
+        self.status = status
+        self.url = url
+
+
+def retry_delay(attempt, backoff, max_backoff, response=None):
+    """Seconds to wait before retry number attempt: the response's Retry-After if sent, else full jitter backoff"""
+    if response is not None and response.headers.get('Retry-After', '').isdigit():
+        return float(response.headers['Retry-After'])
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+class HTTPSession(object):
+    """Pooled keep-alive session shared by the API clients. Throttled (429) and server error (5xx) responses as well
+    as dropped connections are retried with exponential backoff and full jitter, honoring Retry-After if sent."""
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, pool_size=16, timeout=(5, 30), max_retries=5, backoff=0.5, max_backoff=30):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _sleep_time(self, attempt, response=None):
+        return retry_delay(attempt, self.backoff, self.max_backoff, response)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self._sleep_time(attempt))
+                continue
+            if response.status_code in self.retry_statuses and attempt < self.max_retries:
+                time.sleep(self._sleep_time(attempt, response))
+                continue
+            if response.status_code >= 400:
+                raise APIError(response.status_code, url, response.text)
+            return response
+
+    def get_json(self, url, params=None, headers=None):
+        return json.loads(self.request('GET', url, params=params, headers=headers).content)
+
+    def post_json(self, url, headers=None, data=None):
+        return json.loads(self.request('POST', url, headers=headers, data=data).content)
+
+    def close(self):
+        self.session.close()
+
+
+_default_session = None
+_default_session_lock = threading.Lock()
+
+
+def default_session():
+    """Returns the process-wide HTTPSession so every client reuses the same connection pool"""
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = HTTPSession()
+        return _default_session
 
 
 class AMTD(object):
-    """Class for hitting TD Ameritrade API and getting data."""
-    def __init__(self, apikey):
+    """Class for hitting TD Ameritrade API and getting data.
+    The session can be any object with get_json/post_json, e.g. the offline transports in library.transport."""
+    def __init__(self, apikey, cache=None, calls_per_second=2, max_workers=8,
+                 base_url="https://api.tdameritrade.com/v1", session=None):
         self._api_key = apikey
+        self.cache = cache
+        self.session = session if session is not None else default_session()
+        self.rate_limiter = TokenBucket(calls_per_second)
+        self.max_workers = max_workers
+        self.quotes = QuoteSnapshot(self)
+        self.benchmarks = BenchmarkStore(self)
         self._access_tkn = None
-        self.price_hist_url = "https://api.tdameritrade.com/v1/marketdata/{}/pricehistory"
-        self.quote_url = "https://api.tdameritrade.com/v1/marketdata/quotes"
-        self.instr_url = "https://api.tdameritrade.com/v1/instruments"
-        self.auth_url = "https://api.tdameritrade.com/v1/oauth2/token"
+        self._refresh_tkn = None
+        self._access_tkn_expiry = 0
+        self.price_hist_url = base_url + "/marketdata/{}/pricehistory"
+        self.quote_url = base_url + "/marketdata/quotes"
+        self.instr_url = base_url + "/instruments"
+        self.auth_url = base_url + "/oauth2/token"
+        self.account_url = base_url + "/accounts/{}?fields=positions"
         self.initial_balances = None
         self.projected_balances = None
         self.current_balances = None
         self.current_positions = None
         self.risk_free = None
         self._raw_rates = None
+        self.yield_curve = default_curve()
 
     def generate_access_token(self, refresh_tkn):
         """Need to do this to pull data from API as well as log in to see account info"""
+        headers, data = self._token_request(refresh_tkn)
+        self._store_token(refresh_tkn, self.session.post_json(self.auth_url, headers=headers, data=data))
+
+    def _token_request(self, refresh_tkn):
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
         data = "grant_type=refresh_token&refresh_token="+urllib.parse.quote_plus(refresh_tkn)+"&access_type=&code=&client_id="+str(self._api_key)+"&redirect_uri="
-        response = requests.post(self.auth_url, headers=headers, data=data)
-        r = response.json()
-        df = pd.DataFrame.from_dict(r, orient='index')
-        tkn = df.T.access_token
-        self._access_tkn = tkn.item()
+        return headers, data
+
+    def _store_token(self, refresh_tkn, r):
+        self._access_tkn = r['access_token']
+        self._refresh_tkn = refresh_tkn
+        # refresh a minute early so a token never expires mid request
+        self._access_tkn_expiry = time.monotonic() + float(r.get('expires_in', 1800)) - 60
+
+    def _auth_headers(self):
+        """Returns the bearer header, generating a new access token first if the current one has expired"""
+        if self._refresh_tkn is not None and time.monotonic() >= self._access_tkn_expiry:
+            self.generate_access_token(self._refresh_tkn)
+        return {'Authorization': "Bearer " + str(self._access_tkn)}
+
+    def set_yield_curve(self, cache_path=None, csv_path=None):
+        """Persists the treasury yield curve to cache_path (refreshed daily) or reads it offline from csv_path"""
+        self.yield_curve = YieldCurve(cache_path, csv_path)
+
+    def set_cache(self, path):
+        """Keeps daily price history in a local SQLite file so only missing date ranges are requested from the API"""
+        self.cache = PriceCache(path)
+
+    def _get_json(self, url, params=None, headers=None):
+        """Waits for a token from the rate limiter, then calls the API and returns the decoded json.
+        An authorized call rejected with 401 gets one retry with a freshly generated access token."""
+        self.rate_limiter.acquire()
+        try:
+            return self.session.get_json(url, params=params, headers=headers)
+        except APIError as e:
+            if e.status != 401 or not headers or 'Authorization' not in headers or self._refresh_tkn is None:
+                raise
+            self.generate_access_token(self._refresh_tkn)
+            headers = dict(headers, **self._auth_headers())
+            self.rate_limiter.acquire()
+            return self.session.get_json(url, params=params, headers=headers)
 
     def get_fundamentals(self, symbol: str):
         """Input ticker string and returns a dataframe of fundamental ratios """
@@ -37,26 +174,47 @@ class AMTD(object):
         fundamentals = self._transform_fundamentals(raw, symbol)
         return fundamentals
 
+    def get_fundamentals_bulk(self, list_of_tickers, batch_size=100):
+        """Fetches fundamentals for many symbols, batch_size symbols per instruments request, on the thread pool.
+        Returns one long dataframe of (fundamental, value, update_ts, cusip, symbol, assetType) rows.
+        Symbols missing from the responses or in failed batches are listed as (symbol, exception) pairs in the
+        result's attrs['failed_symbols']."""
+        batches = [list(list_of_tickers[i:i + batch_size]) for i in range(0, len(list_of_tickers), batch_size)]
+        def fetch(batch):
+            try:
+                return batch, self._get_fundamentals_raw(','.join(str(e) for e in batch)), None
+            except Exception as e:
+                return batch, None, e
+        data = {}
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for batch, raw, error in pool.map(fetch, batches):
+                if error is not None:
+                    failed.extend((symbol, error) for symbol in batch)
+                    continue
+                data.update(raw)
+                failed.extend((symbol, KeyError(symbol)) for symbol in batch if str(symbol) not in raw)
+        fundamentals = self._transform_fundamentals(data)
+        fundamentals.attrs['failed_symbols'] = failed
+        return fundamentals
+
     def get_daily_price_hist(self, symbol, freq_type, freq, prd_type, prd, reindex = True):
         """Gets price data from the API. Example: One year price history - get_price_hist('AAPL', 'daily', 1, 'year', 1)"""
         raw = self._get_price_hist_raw(symbol, freq_type, freq, prd_type, prd)
-        prices = self._transform_prices(raw, symbol)
         if reindex:
-            prices['datetime'] = prices['datetime'].astype('datetime64[D]')
-            prices = prices.set_index(['datetime'], drop=True)
-            prices = prices.pivot(columns='symbol')
-        return prices
+            return self._price_panel(raw, symbol)
+        return self._transform_prices(raw, symbol)
 
     def get_daily_price_timeframe(self, symbol, start, end, reindex = True):
         """Gets dataframe of daily prices for a single symbol given a start and end date.
          Example: get_price_daily_timeframe('AAPL', '2019-01-01', '2019-05-01')"""
-        raw = self._get_price_daily_timeframe_raw(symbol, start, end)
-        prices = self._transform_prices(raw, symbol)
+        if self.cache is None:
+            raw = self._get_price_daily_timeframe_raw(symbol, start, end)
+        else:
+            raw = self._get_price_daily_timeframe_cached(symbol, start, end)
         if reindex:
-            prices['datetime'] = prices['datetime'].astype('datetime64[D]')
-            prices = prices.set_index(['datetime'], drop=True)
-            prices = prices.pivot(columns='symbol')
-        return prices
+            return self._price_panel(raw, symbol)
+        return self._transform_prices(raw, symbol)
 
 
     def get_30min_price_timeframe(self, symbol, start, end):
@@ -65,6 +223,42 @@ class AMTD(object):
         prices = self._transform_prices(raw, symbol)
         return prices
 
+    def iter_30min_price_timeframe(self, list_of_tickers, start, end, window_days=10):
+        """Generator of 30 minute bars from start to end for one or more symbols in constant memory.
+        The range is split into windows of window_days that are fetched ahead on the thread pool and yielded in time
+        order as IntradayChunk(prices, start, end, cursor). prices is indexed by bar time with (field, symbol) columns
+        aligned across symbols. Passing a chunk's cursor as start resumes right after that chunk."""
+        if isinstance(list_of_tickers, str):
+            list_of_tickers = [list_of_tickers]
+        windows = self._intraday_windows(start, end, window_days)
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for w_start, w_end in windows:
+                futures = [pool.submit(self._get_price_30minute_timeframe_raw, i, w_start, w_end)
+                           for i in list_of_tickers]
+                pending.append((w_start, w_end, futures))
+                if len(pending) * len(list_of_tickers) >= self.max_workers:
+                    w_start, w_end, futures = pending.popleft()
+                    yield self._intraday_chunk(list_of_tickers, w_start, w_end, [f.result() for f in futures])
+            while pending:
+                w_start, w_end, futures = pending.popleft()
+                yield self._intraday_chunk(list_of_tickers, w_start, w_end, [f.result() for f in futures])
+
+    def _intraday_windows(self, start, end, window_days):
+        w_start, end = pd.Timestamp(start), pd.Timestamp(end)
+        step = pd.Timedelta(days=window_days)
+        while w_start < end:
+            w_end = min(w_start + step, end)
+            yield w_start, w_end
+            w_start = w_end
+
+    def _intraday_chunk(self, list_of_tickers, w_start, w_end, raws):
+        """Builds one window's panel, keeping only bars inside [w_start, w_end) so windows never overlap"""
+        frames = [self._price_panel(raw, i, daily=False) for i, raw in zip(list_of_tickers, raws)]
+        prices = pd.concat(frames, axis=1) if len(frames) > 1 else frames[0]
+        prices = prices[(prices.index >= w_start) & (prices.index < w_end)]
+        return IntradayChunk(prices, w_start, w_end, w_end.isoformat())
+
     def get_quotes(self, symbol_list: list):
         """Inputs a list of ticker strings and returns a dataframe of quotes"""
         raw = self._get_quotes_raw(symbol_list)
@@ -83,26 +277,22 @@ class AMTD(object):
         payload = {'apikey': self._api_key,
                    'symbol': symbol,
                    'projection': 'fundamental'}
-        content = requests.get(self.instr_url, params=payload)
-        data = content.json()
-        return data
+        return self._get_json(self.instr_url, params=payload)
 
-    def _transform_fundamentals(self, data, symbol):
-        """Transforms the dictionary of fundamental values into a consumable dataframe"""
-        df = pd.DataFrame.from_dict(data)
-        dft = df.T
-        base_df = dft.drop('fundamental', axis = 1)
-        fund_dict = dft.fundamental.to_dict()
-        funds = pd.DataFrame.from_dict(fund_dict)
-        funds['update_ts'] = datetime.datetime.now().strftime("%m-%d-%Y %H:%M:%S")
-        for i in base_df.columns:
-            funds[i] = base_df[i].item()
-        funds = funds.reset_index().rename(columns={'index': 'fundamental', str(symbol): 'value'})
-        funds = funds[~funds.fundamental.str.contains("Date")]      ##.reset_index(drop=True)
-        funds = funds[funds.fundamental != 'symbol'].reset_index(drop=True)
-        funds = funds.astype({'value': 'float', 'update_ts': 'datetime64'})
-        funds = funds.drop(columns=['description','exchange'])
-        return funds
+    def _transform_fundamentals(self, data, symbol=None):
+        """Transforms the instruments dictionary, for one or many symbols, into a long dataframe with one row per
+        symbol and fundamental. Date fields and the repeated symbol field are left out."""
+        rows = [(instr['symbol'], instr.get('cusip'), instr.get('assetType'), name, value)
+                for instr in data.values()
+                for name, value in instr['fundamental'].items()
+                if name != 'symbol' and 'Date' not in name]
+        symbols, cusips, asset_types, names, values = zip(*rows) if rows else ((), (), (), (), ())
+        return pd.DataFrame({'fundamental': np.array(names, dtype=object),
+                             'value': np.array(values, dtype=np.float64),
+                             'update_ts': pd.Timestamp.now().floor('s'),
+                             'cusip': np.array(cusips, dtype=object),
+                             'symbol': np.array(symbols, dtype=object),
+                             'assetType': np.array(asset_types, dtype=object)})
 
     def _get_price_hist_raw(self, symbol, freq_type, freq, prd_type, prd):
         """Gets raw dictionary of price history from the API"""
@@ -112,17 +302,35 @@ class AMTD(object):
                    'frequency' : freq,
                    'periodType': prd_type,
                    'period' : prd}
-        content = requests.get(url, params=payload)
-        data = content.json()
-        return data
+        return self._get_json(url, params=payload)
+
+    def _decode_candles(self, data):
+        """Decodes the candles list straight into numpy arrays of epoch ms, open/high/low/close and volume"""
+        candles = data['candles']
+        values = np.array([(c['open'], c['high'], c['low'], c['close'], c['volume'], c['datetime']) for c in candles],
+                          dtype=np.float64).reshape(-1, 6)
+        return values[:, 5].astype(np.int64), values[:, :4], values[:, 4].astype(np.int64)
 
     def _transform_prices(self, data, symbol):
         """Transforms raw price data to consumable dataframe"""
-        df = pd.DataFrame.from_dict(data['candles'])
-        df['symbol'] = str(symbol)
-        df['datetime'] = df['datetime'].astype(float)
-        df['datetime'] = pd.to_datetime(df['datetime'],unit='ms')
-        return df
+        epoch_ms, ohlc, volume = self._decode_candles(data)
+        return pd.DataFrame({'open': ohlc[:, 0], 'high': ohlc[:, 1], 'low': ohlc[:, 2], 'close': ohlc[:, 3],
+                             'volume': volume,
+                             'datetime': epoch_ms.astype('datetime64[ms]').astype('datetime64[ns]'),
+                             'symbol': str(symbol)})
+
+    def _price_panel(self, data, symbol, daily=True):
+        """Transforms raw price data to a dataframe indexed by date (or bar time if not daily) with (field, symbol) columns"""
+        epoch_ms, ohlc, volume = self._decode_candles(data)
+        times = epoch_ms.astype('datetime64[ms]')
+        if daily:
+            times = times.astype('datetime64[D]')
+        index = pd.Index(times.astype('datetime64[ns]'), name='datetime')
+        columns = pd.MultiIndex.from_product([['open', 'high', 'low', 'close', 'volume'], [str(symbol)]],
+                                             names=[None, 'symbol'])
+        return pd.DataFrame({('open', str(symbol)): ohlc[:, 0], ('high', str(symbol)): ohlc[:, 1],
+                             ('low', str(symbol)): ohlc[:, 2], ('close', str(symbol)): ohlc[:, 3],
+                             ('volume', str(symbol)): volume}, index=index, columns=columns)
 
     def _get_price_daily_timeframe_raw(self, symbol, start, end): #end is not inclusive
         """Calls the API and returns dictionary of raw daily time frame data from start to end dates"""
@@ -136,10 +344,15 @@ class AMTD(object):
                    #'period' : "1",
                    'startDate' : str(startint),
                    'endDate' : str(endint)}
-        content = requests.get(url, params=payload)
-        data = content.json()
-        return data
+        return self._get_json(url, params=payload)
+
 
+    def _get_price_daily_timeframe_cached(self, symbol, start, end):
+        """Fetches only the date ranges missing from the cache, stores them, and returns the full range from the cache"""
+        for gap_start, gap_end in self.cache.missing_ranges(symbol, start, end):
+            data = self._get_price_daily_timeframe_raw(symbol, gap_start, gap_end)
+            self.cache.store(symbol, data, gap_start, gap_end)
+        return self.cache.load(symbol, start, end)
 
     def _get_price_30minute_timeframe_raw(self, symbol, start, end):
         """Gets 30 minute tick data from API in dictionary form"""
@@ -155,9 +368,7 @@ class AMTD(object):
                #'period' : "1",
                'startDate': str(startint),
                'endDate': str(endint)}
-        content = requests.get(url, params=payload)
-        data = content.json()
-        return data
+        return self._get_json(url, params=payload)
 
     def _get_quotes_raw(self, symbol_list: list):
         """Gets raw quote data from API in form of a dictionary"""
@@ -165,9 +376,7 @@ class AMTD(object):
         symbs = ','.join(str(e) for e in symbol_list)
         payload = {'apikey': self._api_key,
                    'symbol' : symbs}
-        content = requests.get(url, params=payload)
-        data = content.json()
-        return data
+        return self._get_json(url, params=payload)
 
     def _transform_quotes(self, data):
         """Transforms quote dictionary to dataframe with a timestamp"""
@@ -177,11 +386,8 @@ class AMTD(object):
         return dft
 
     def _get_account_info_raw(self, account):
-        url = "https://api.tdameritrade.com/v1/accounts/{}?fields=positions".format(account)
-        headers = {'Authorization': "Bearer " + str(self._access_tkn)}
-        content = requests.get(url, headers=headers)
-        data = content.json()
-        return data
+        url = self.account_url.format(account)
+        return self._get_json(url, headers=self._auth_headers())
 
     def _transform_account_inf(self, data, initial_bal, projected_bal, current_bal, current_pos):
         df = pd.DataFrame(list(data['securitiesAccount'].items()))
@@ -218,29 +424,51 @@ class AMTD(object):
 
 
 
-    def get_ohlcv_array(self, start, end, list_of_tickers, filter = 0):
+    def get_daily_prices(self, list_of_tickers, start, end):
+        """Fetches daily prices for many symbols on a thread pool, paced by the rate limiter.
+        Returns a dictionary of symbol to dataframe and a list of (symbol, exception) for the symbols that failed."""
+        def fetch(symbol):
+            try:
+                return symbol, self.get_daily_price_timeframe(symbol, start, end), None
+            except Exception as e:
+                return symbol, None, e
         prices = {}
-        first = list_of_tickers[0]
-        prices[first] = self.get_daily_price_timeframe(first, start, end)
-        p_array = prices[first]
-        for i in list_of_tickers[1:]:
-            time.sleep(1)
-            prices[i] = self.get_daily_price_timeframe(i, start, end)
-            p_array = pd.concat([p_array,prices[i]], axis = 1)
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for symbol, frame, error in pool.map(fetch, list_of_tickers):
+                if error is None:
+                    prices[symbol] = frame
+                else:
+                    failed.append((symbol, error))
+        return prices, failed
+
+    def get_ohlcv_array(self, start, end, list_of_tickers, filter = 0):
+        """Returns a wide dataframe of daily ohlcv for all tickers aligned on date.
+        Symbols that could not be fetched are left out and listed as (symbol, exception) pairs in the result's
+        attrs['failed_symbols'], so concurrent callers sharing the client each see their own failures."""
+        prices, failed = self.get_daily_prices(list_of_tickers, start, end)
+        return self._ohlcv_array(prices, failed, list_of_tickers, filter)
+
+    @staticmethod
+    def _ohlcv_array(prices, failed, list_of_tickers, filter):
+        if not prices:
+            p_array = pd.DataFrame()
+        else:
+            p_array = pd.concat([prices[i] for i in list_of_tickers if i in prices], axis = 1)
         if bool(filter):
             p_array = p_array.filter(like=filter)
+        p_array.attrs['failed_symbols'] = failed
         return p_array
 
     def get_risk_free_rate(self, time_prd = "1 yr"):
-        url = "https://www.treasury.gov/resource-center/data-chart-center/interest-rates/pages/textview.aspx?data=yield"
-        r_data = pd.read_html(url)
-        rfr = r_data[1]
-        rfr.columns = list(rfr[:1].values)
-        rdf = rfr[1:]
-        self._raw_rates = rdf[::-1].reset_index(drop=True)
-        risk_free = self._raw_rates.iloc[0,:]
+        """Latest treasury rate for a tenor as a decimal, or the whole yield curve table if time_prd is falsy"""
+        self._raw_rates = self.yield_curve.table
         if bool(time_prd) == True:
-            self.risk_free = float(risk_free[str(time_prd)].values)/100
+            self.risk_free = self.yield_curve.rate(tenor=str(time_prd))
             return self.risk_free
         else:
-            return self._raw_rates
\ No newline at end of file
+            return self._raw_rates
+
+    def get_risk_free_rates(self, dates, time_prd = "1 yr", periods = 252):
+        """Per period risk free rate in force on each date, for netting against daily returns"""
+        return self.yield_curve.daily_rates(dates, str(time_prd), periods)
@@ -0,0 +1,48 @@
+"""
+Memoized computation nodes with dependency-aware invalidation, used by Portfolio to skip repeated work.
+"""
+
+import collections
+
+
+class DependencyCache(object):
+    """Stores computed values per node, keyed on the node's inputs. A node's key embeds the keys of the nodes it is
+    computed from, so a changed input only recomputes the nodes downstream of it. Each node keeps its `maxsize`
+    most recently used keys. `dependencies` maps each node to the nodes it is computed from."""
+    def __init__(self, dependencies, maxsize=4):
+        self.dependencies = dependencies
+        self.maxsize = maxsize
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, key, compute):
+        """Returns the cached value of a node for a key, calling compute() on a miss"""
+        entries = self._entries.setdefault(name, collections.OrderedDict())
+        if key in entries:
+            entries.move_to_end(key)
+            self.hits += 1
+            return entries[key]
+        self.misses += 1
+        value = compute()
+        entries[key] = value
+        if len(entries) > self.maxsize:
+            entries.popitem(last=False)
+        return value
+
+    def dependents(self, name):
+        """All nodes computed directly or indirectly from a node"""
+        found = []
+        for node, upstream in self.dependencies.items():
+            if name in upstream and node not in found:
+                found.append(node)
+                found.extend(n for n in self.dependents(node) if n not in found)
+        return found
+
+    def invalidate(self, name=None):
+        """Drops a node and everything computed from it, or every node if no name is given"""
+        if name is None:
+            self._entries = {}
+            return
+        for node in [name] + self.dependents(name):
+            self._entries.pop(node, None)
@@ -0,0 +1,65 @@
+"""
+Running-peak drawdown engine. Works on (time x series) value matrices in ascending time order so drawdowns for every
+account in a batch come out of the same few array passes.
+"""
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+def _as_matrix(values):
+    values = np.asarray(values, dtype=np.float64)
+    return values.reshape(len(values), -1)
+
+
+def underwater(values):
+    """Drawdown from the running peak at every date, 0 at a new high and negative below it.
+    Missing values are NaN and do not reset the peak."""
+    values = _as_matrix(values)
+    return values / np.fmax.accumulate(values, axis=0) - 1
+
+
+def drawdown_stats(values, index=None):
+    """Max drawdown, peak/trough/recovery positions and durations of every column in one pass.
+    Returns a dictionary of arrays with one entry per column. Positions are row numbers, or dates if an index is
+    given. A series that has not recovered gets recovery -1 (NaT with an index) and its duration runs to the end.
+    Missing values (e.g. before a series starts) are skipped."""
+    values = _as_matrix(values)
+    rows = np.arange(len(values))[:, None]
+    peaks = np.fmax.accumulate(values, axis=0)
+    dd = values / peaks - 1
+    peak_rows = np.maximum.accumulate(np.where(values >= peaks, rows, 0), axis=0)
+    cols = np.arange(values.shape[1])
+    trough = np.where(np.isnan(dd), np.inf, dd).argmin(axis=0)
+    peak = peak_rows[trough, cols]
+    recovered = (rows > trough) & (dd >= 0)
+    has_recovered = recovered.any(axis=0)
+    recovery = np.where(has_recovered, recovered.argmax(axis=0), -1)
+    stats = {'max_drawdown': dd[trough, cols],
+             'peak': peak,
+             'trough': trough,
+             'recovery': recovery,
+             'decline_duration': trough - peak,
+             'drawdown_duration': np.where(has_recovered, recovery, len(values) - 1) - peak}
+    if index is not None:
+        index = pd.DatetimeIndex(index)
+        stats['peak'] = index[peak]
+        stats['trough'] = index[trough]
+        stats['recovery'] = pd.DatetimeIndex([index[r] if r >= 0 else pd.NaT for r in recovery])
+    return stats
+
+
+def rolling_max_drawdown(values, window, chunk_size=4096):
+    """Worst drawdown inside each trailing window of `window` rows, NaN until the first full window. Missing values
+    are skipped, a window with no values is NaN. Windows are processed in row chunks so memory stays at chunk_size x window x columns."""
+    values = _as_matrix(values)
+    out = np.full(values.shape, np.nan)
+    if len(values) < window:
+        return out
+    windows = sliding_window_view(values, window, axis=0)
+    for start in range(0, len(windows), chunk_size):
+        chunk = windows[start:start + chunk_size]
+        peaks = np.fmax.accumulate(chunk, axis=-1)
+        out[window - 1 + start:window - 1 + start + len(chunk)] = np.fmin.reduce(chunk / peaks - 1, axis=-1)
+    return out
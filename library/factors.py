@@ -0,0 +1,105 @@
+"""
+Factor regression engine. Factor returns are aligned once and every portfolio and asset is regressed on them in a
+single least squares solve, or through time from running X'X and X'y sums.
+"""
+
+import numpy as np
+from scipy.linalg import solve_triangular
+from scipy.signal import lfilter
+from library.timeseries import window_sums
+
+
+def factor_regression(returns, factors, intercept=True):
+    """OLS of every column of a (T x P) return matrix on a (T x K) factor matrix with one QR factorization of the
+    design, shared by all P regressions. Rows where any factor or return is missing are dropped once for all.
+    Returns a dictionary of arrays:
+      alpha, alpha_t         (P,)      intercept and its t-stat, NaN without an intercept
+      betas, t_stats         (P x K)   factor loadings and their t-stats
+      r_squared              (P,)      centred with an intercept, uncentred without, as in statsmodels
+      residual_volatility    (P,)      per period standard error of the regression
+      nobs                             rows used"""
+    returns = np.asarray(returns, dtype=np.float64).reshape(len(returns), -1)
+    factors = np.asarray(factors, dtype=np.float64).reshape(len(factors), -1)
+    keep = np.isfinite(returns).all(axis=1) & np.isfinite(factors).all(axis=1)
+    y = returns[keep]
+    x = factors[keep]
+    if intercept:
+        x = np.column_stack([np.ones(len(x)), x])
+    nobs, k = x.shape
+    q, r = np.linalg.qr(x)
+    diag = np.abs(np.diag(r))
+    if diag.min() > diag.max() * 1e-10:
+        coef = solve_triangular(r, q.T @ y)
+        r_inv = solve_triangular(r, np.eye(k))
+        xtx_inv_diag = (r_inv * r_inv).sum(axis=1)
+        rank = k
+    else:
+        # a factor flat over the sample (e.g. a T-bill ETF) leaves the design rank deficient, so fall back to the
+        # minimum norm fit of the pseudo-inverse as statsmodels' OLS does
+        x_pinv = np.linalg.pinv(x)
+        coef = x_pinv @ y
+        xtx_inv_diag = (x_pinv * x_pinv).sum(axis=1)
+        rank = np.linalg.matrix_rank(x)
+    resid = y - x @ coef
+    ssr = (resid * resid).sum(axis=0)
+    sigma2 = ssr / (nobs - rank)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_stats = coef / np.sqrt(np.outer(xtx_inv_diag, sigma2))
+        centred = y - y.mean(axis=0) if intercept else y
+        r_squared = 1 - ssr / (centred * centred).sum(axis=0)
+    nan = np.full(y.shape[1], np.nan)
+    return {'alpha': coef[0] if intercept else nan,
+            'alpha_t': t_stats[0] if intercept else nan,
+            'betas': coef[int(intercept):].T,
+            't_stats': t_stats[int(intercept):].T,
+            'r_squared': r_squared,
+            'residual_volatility': np.sqrt(sigma2),
+            'nobs': nobs}
+
+
+def _running(terms, window, halflife):
+    """Expanding, trailing-window or exponentially weighted sums of per-row terms along time"""
+    if halflife is not None:
+        return lfilter([1.0], [1.0, -0.5 ** (1 / halflife)], terms, axis=0)
+    if window is None:
+        return np.cumsum(terms, axis=0)
+    sums = np.zeros(terms.shape)
+    if len(terms) >= window:
+        sums[window - 1:] = window_sums(terms, window)
+    return sums
+
+
+def rolling_factor_regression(returns, factors, window=None, halflife=None, intercept=True, chunk_size=256):
+    """Factor loadings of every column of a (T x P) return matrix through time, from running X'X and X'y sums and
+    one batched solve per date rather than a fit per window. Expanding by default, over trailing windows of
+    `window` rows, or exponentially weighted with the given halflife. Rows where a factor or return is missing
+    count as absent. A date is NaN until its window holds `window` rows, or k + 1 rows when expanding or weighted.
+    Portfolios are solved chunk_size at a time so memory stays near T x k x chunk_size. Dates where X'X is singular,
+    e.g. a factor flat over the window, get the minimum norm pseudo-inverse fit.
+    Returns a dictionary with 'betas' (T x P x K) and 'alpha' (T x P), NaN without an intercept."""
+    if window is not None and halflife is not None:
+        raise ValueError("Pass at most one of window or halflife")
+    returns = np.asarray(returns, dtype=np.float64).reshape(len(returns), -1)
+    factors = np.asarray(factors, dtype=np.float64).reshape(len(factors), -1)
+    valid = np.isfinite(returns).all(axis=1) & np.isfinite(factors).all(axis=1)
+    x = np.where(valid[:, None], factors, 0.0)
+    if intercept:
+        x = np.column_stack([valid.astype(np.float64), x])
+    y = np.where(valid[:, None], returns, 0.0)
+    k = x.shape[1]
+    count = _running(valid.astype(np.float64), window, None)
+    enough = count >= (window if window is not None else k + 1)
+    xtx = _running(x[:, :, None] * x[:, None, :], window, halflife)[enough]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        singular = ~(np.linalg.cond(xtx) < 1e12)
+    xtx_pinv = np.linalg.pinv(xtx[singular])
+    coef = np.full((len(y), y.shape[1], k), np.nan)
+    for start in range(0, y.shape[1], chunk_size):
+        stop = start + chunk_size
+        xty = _running(x[:, :, None] * y[:, None, start:stop], window, halflife)[enough]
+        solved = np.empty(xty.shape)
+        solved[~singular] = np.linalg.solve(xtx[~singular], xty[~singular])
+        solved[singular] = xtx_pinv @ xty[singular]
+        coef[enough, start:stop] = solved.transpose(0, 2, 1)
+    return {'betas': coef[:, :, int(intercept):],
+            'alpha': coef[:, :, 0] if intercept else np.full(returns.shape, np.nan)}
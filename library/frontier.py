@@ -0,0 +1,140 @@
+"""
+Exact mean-variance efficient frontier. Closed form when short sales are allowed, and an active-set quadratic
+program over the long-only simplex otherwise, so the min-variance and tangency portfolios are exact rather than the
+best of a random sample.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def active_set_qp(q, a, b, x, tol=1e-12, max_iter=500):
+    """Minimises x'Qx/2 subject to Ax = b and x >= 0 from a feasible starting x (primal active-set method).
+    Each iteration solves the equality constrained problem on the free variables; blocking bounds are added
+    and bounds with a negative multiplier are released until the KKT conditions hold."""
+    x = np.array(x, dtype=np.float64)
+    a = np.atleast_2d(a)
+    working = x <= tol
+    x[working] = 0.0
+    for _ in range(max_iter):
+        free = ~working
+        g = q @ x
+        n_free, m = free.sum(), len(a)
+        kkt = np.zeros((n_free + m, n_free + m))
+        kkt[:n_free, :n_free] = q[np.ix_(free, free)]
+        kkt[:n_free, n_free:] = -a[:, free].T
+        kkt[n_free:, :n_free] = a[:, free]
+        solution = np.linalg.lstsq(kkt, np.concatenate([-g[free], np.zeros(m)]), rcond=None)[0]
+        p = np.zeros_like(x)
+        p[free] = solution[:n_free]
+        multipliers = solution[n_free:]
+        if np.abs(p).max() <= tol * max(1.0, np.abs(x).max()):
+            bound = g - a.T @ multipliers
+            bound[free] = np.inf
+            release = np.argmin(bound)
+            if bound[release] >= -tol:
+                return x
+            working[release] = False
+            continue
+        falling = free & (p < 0)
+        steps = np.full_like(x, np.inf)
+        steps[falling] = -x[falling] / p[falling]
+        block = np.argmin(steps)
+        step = min(1.0, steps[block])
+        x += step * p
+        if step < 1.0:
+            x[block] = 0.0
+            working[block] = True
+    raise RuntimeError("Quadratic program did not converge in {} iterations".format(max_iter))
+
+
+class EfficientFrontier(object):
+    """Efficient frontier for annualised mean returns and covariance (Series/DataFrame labels are kept).
+    long_only=False uses the closed-form (Merton) frontier with short sales allowed. long_only=True solves the
+    quadratic program with weights >= 0 summing to one."""
+    def __init__(self, mean, cov, risk_free=0.0, long_only=True):
+        self.symbols = list(mean.index) if isinstance(mean, pd.Series) else list(range(len(mean)))
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.cov = np.asarray(cov, dtype=np.float64)
+        self.risk_free = risk_free
+        self.long_only = long_only
+        self._closed_form = None
+        self._min_variance = None
+
+    def _merton(self):
+        """inv(S)1, inv(S)mean and the a, b, c scalars of the short sale frontier. Only solved when short sales are
+        allowed, so a singular covariance still works long only."""
+        if self._closed_form is None:
+            ones = np.ones(len(self.mean))
+            inv_ones = np.linalg.solve(self.cov, ones)
+            inv_mean = np.linalg.solve(self.cov, self.mean)
+            self._closed_form = (inv_ones, inv_mean, ones @ inv_ones, ones @ inv_mean, self.mean @ inv_mean)
+        return self._closed_form
+
+    def min_variance(self):
+        """Weights of the global minimum variance portfolio"""
+        if self._min_variance is None:
+            if self.long_only:
+                n = len(self.mean)
+                self._min_variance = active_set_qp(self.cov, np.ones(n), [1.0], np.full(n, 1.0 / n))
+            else:
+                inv_ones, _, a, _, _ = self._merton()
+                self._min_variance = inv_ones / a
+        return self._min_variance
+
+    def tangency(self):
+        """Weights of the maximum Sharpe ratio portfolio for the risk free rate. Long only, this minimises y'Sy
+        over y >= 0 with (mean - rf)'y = 1 and rescales y to sum to one. With short sales, a risk free rate at or
+        above the minimum variance return leaves no tangency portfolio (rescaling would pick the minimum Sharpe
+        ratio instead) and raises ValueError."""
+        excess = self.mean - self.risk_free
+        if self.long_only:
+            best = np.argmax(excess)
+            if excess[best] <= 0:
+                raise ValueError("No asset returns more than the risk free rate")
+            start = np.zeros(len(excess))
+            start[best] = 1 / excess[best]
+            y = active_set_qp(self.cov, excess, [1.0], start)
+        else:
+            inv_ones, inv_mean, _, _, _ = self._merton()
+            y = inv_mean - self.risk_free * inv_ones
+            if y.sum() <= 0:
+                raise ValueError("Risk free rate {} is not below the minimum variance return {}"
+                                 .format(self.risk_free, self.mean @ self.min_variance()))
+        return y / y.sum()
+
+    def weights_for_return(self, target):
+        """Minimum variance weights with the given expected return"""
+        if not self.long_only:
+            inv_ones, inv_mean, a, b, c = self._merton()
+            return ((c - target * b) * inv_ones + (target * a - b) * inv_mean) / (a * c - b ** 2)
+        low, top = self.mean @ self.min_variance(), np.argmax(self.mean)
+        if not low - 1e-12 <= target <= self.mean[top] + 1e-12:
+            raise ValueError("Target return {} is outside the long only frontier [{}, {}]"
+                             .format(target, low, self.mean[top]))
+        # a mix of the min variance portfolio and the best asset meets the target and starts the solver feasible
+        t = 0.0 if self.mean[top] == low else (target - low) / (self.mean[top] - low)
+        start = (1 - t) * self.min_variance()
+        start[top] += t
+        constraints = np.vstack([np.ones(len(self.mean)), self.mean])
+        return active_set_qp(self.cov, constraints, [1.0, target], start)
+
+    def frontier(self, points=50, max_return=None):
+        """DataFrame of `points` frontier portfolios from the minimum variance return up to max_return (the best
+        asset's return if long only, otherwise twice the span to it), with the same columns as
+        blakefolio's pf_df: Returns, Volatility, Sharpe Ratio and one weight column per symbol."""
+        low = self.mean @ self.min_variance()
+        if max_return is None:
+            max_return = self.mean.max() if self.long_only else low + 2 * (self.mean.max() - low)
+        weights = np.array([self.weights_for_return(r) for r in np.linspace(low, max_return, points)])
+        return self.table(weights)
+
+    def table(self, weights):
+        weights = np.atleast_2d(weights)
+        returns = weights @ self.mean
+        volatility = np.sqrt(np.einsum('ij,ij->i', weights @ self.cov, weights))
+        table = pd.DataFrame(weights, columns=[str(s) + ' Weight' for s in self.symbols])
+        table.insert(0, 'Sharpe Ratio', (returns - self.risk_free) / volatility)
+        table.insert(0, 'Volatility', volatility)
+        table.insert(0, 'Returns', returns)
+        return table
@@ -0,0 +1,123 @@
+"""
+Monte Carlo VaR/CVaR. Correlated asset return paths are simulated in bounded chunks, optionally across a process
+pool, and only the portfolio's horizon return per path is kept.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from scipy.stats import binom, norm
+from library.timeseries import TimeSeries
+
+_worker_model = None
+
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = model
+
+
+def _run_chunk(task):
+    return _worker_model.simulate_chunk(*task)
+
+
+class MonteCarloVaR(object):
+    """Simulates `horizon`-period portfolio returns from a (time x asset) return panel.
+    Per-period asset returns are mean + z @ L.T with L the Cholesky factor of the sample covariance, and z drawn from:
+      'normal'    standard normal
+      't'         multivariate Student-t with `dof` degrees of freedom, scaled to unit variance
+      'bootstrap' whole historic rows resampled with replacement, which keeps their joint fat tails as they are
+    Assets compound over the horizon (exp of summed log returns, or product of simple returns) and the portfolio
+    return is the weighted sum of the asset returns. Losses are reported as positive fractions like var_historic."""
+    def __init__(self, asset_returns, weights, horizon=1, innovations='normal', dof=5, log=True):
+        if innovations not in ('normal', 't', 'bootstrap'):
+            raise ValueError("innovations must be 'normal', 't' or 'bootstrap', not {}".format(innovations))
+        if innovations == 't' and dof <= 2:
+            raise ValueError("Student-t innovations need dof > 2 for a finite variance")
+        if isinstance(asset_returns, pd.DataFrame):
+            asset_returns = TimeSeries.from_frame(asset_returns).values
+        history = np.asarray(asset_returns, dtype=np.float64)
+        history = history.reshape(len(history), -1)
+        self.history = np.ascontiguousarray(history[np.isfinite(history).all(axis=1)])
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.horizon = horizon
+        self.innovations = innovations
+        self.dof = dof
+        self.log = log
+        self.mean = self.history.mean(axis=0)
+        self.cov = np.atleast_2d(np.cov(self.history, rowvar=False))
+        self.chol = self._cholesky(self.cov)
+
+    @staticmethod
+    def _cholesky(cov):
+        """Cholesky factor, with a growing diagonal jitter for covariances that are only semi-definite"""
+        jitter = 0.0
+        scale = np.trace(cov) / len(cov)
+        for _ in range(10):
+            try:
+                return np.linalg.cholesky(cov + jitter * np.eye(len(cov)))
+            except np.linalg.LinAlgError:
+                jitter = max(jitter * 10, scale * 1e-10)
+        raise np.linalg.LinAlgError("Covariance matrix is not positive semi-definite")
+
+    def simulate_chunk(self, paths, seed):
+        """Horizon portfolio returns of `paths` paths from one seed. Memory is paths x horizon x assets."""
+        rng = np.random.default_rng(seed)
+        shape = (paths, self.horizon, len(self.mean))
+        if self.innovations == 'bootstrap':
+            returns = self.history[rng.integers(0, len(self.history), size=shape[:2])]
+        else:
+            z = rng.standard_normal(shape)
+            if self.innovations == 't':
+                z *= np.sqrt((self.dof - 2) / rng.chisquare(self.dof, size=shape[:2] + (1,)))
+            returns = self.mean + z @ self.chol.T
+        if self.log:
+            growth = np.exp(returns.sum(axis=1))
+        else:
+            growth = np.prod(1 + returns, axis=1)
+        return (growth - 1) @ self.weights
+
+    def simulate(self, paths, seed=0, chunk_size=None, workers=1):
+        """Horizon portfolio returns of `paths` paths. Each chunk gets its own child of SeedSequence(seed), so a
+        seed gives the same paths for any number of workers. workers > 1 runs chunks on a process pool
+        (None for one worker per core). chunk_size defaults to about 4M simulated asset returns per chunk."""
+        if chunk_size is None:
+            chunk_size = max(1, 2 ** 22 // (self.horizon * len(self.mean)))
+        sizes = [min(chunk_size, paths - start) for start in range(0, paths, chunk_size)]
+        tasks = list(zip(sizes, np.random.SeedSequence(seed).spawn(len(sizes))))
+        workers = os.cpu_count() if workers is None else workers
+        if workers <= 1 or len(tasks) == 1:
+            return np.concatenate([self.simulate_chunk(*task) for task in tasks])
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), initializer=_init_worker,
+                                 initargs=(self,)) as pool:
+            return np.concatenate(list(pool.map(_run_chunk, tasks)))
+
+    def var(self, levels=(5,), paths=100000, seed=0, chunk_size=None, workers=1, confidence=95):
+        """VaR and CVaR at each level 0-100 with `confidence`% intervals, one row per level.
+        VaR bounds are the distribution-free order statistic interval of the quantile, CVaR bounds the normal
+        interval of the Rockafellar-Uryasev estimator."""
+        returns = self.simulate(paths, seed, chunk_size, workers)
+        return var_table(returns, levels, confidence)
+
+
+def var_table(returns, levels=(5,), confidence=95):
+    """VaR/CVaR table with confidence intervals from a sample of simulated returns"""
+    returns = np.asarray(returns, dtype=np.float64)
+    n = len(returns)
+    alpha = (100 - confidence) / 200
+    z = norm.ppf(1 - alpha)
+    rows = []
+    for level in levels:
+        p = level / 100
+        low = int(np.clip(binom.ppf(alpha, n, p) - 1, 0, n - 1))
+        high = int(np.clip(binom.ppf(1 - alpha, n, p), 0, n - 1))
+        var = -np.percentile(returns, level)
+        tail = np.partition(returns, [low, high])
+        loss = np.maximum(-returns - var, 0)
+        beyond = returns <= -var
+        cvar = -returns[beyond].mean()
+        cvar_se = np.std(var + loss / p) / np.sqrt(n)
+        rows.append({'VaR': var, 'VaR Lower': -tail[high], 'VaR Upper': -tail[low],
+                     'CVaR': cvar, 'CVaR Lower': cvar - z * cvar_se, 'CVaR Upper': cvar + z * cvar_se})
+    return pd.DataFrame(rows, index=pd.Index(list(levels), name='level'))
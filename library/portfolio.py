@@ -3,13 +3,22 @@ Revised implementation of Portfolio Object for better interfacing with stress te
 and other objects in an attempt to better separate functionality.
 """
 
-from config import apikey
 import pandas as pd
 import numpy as np
 from library.broker import AMTD
+from library.timeseries import TimeSeries, rolling_std, nancumsum
+from library.streaming import PortfolioStream
+from library.depcache import DependencyCache
+from library.drawdown import underwater, drawdown_stats, rolling_max_drawdown
+from library.risk import cornish_fisher_z, historic_risk, rolling_risk
+from library.montecarlo import MonteCarloVaR
+from library.benchmarks import betas, rolling_betas
+from library.factors import factor_regression, rolling_factor_regression
+from library.scenarios import ScenarioSet
 import collections
 from scipy.stats import norm
-import statsmodels.api as sm
+
+_sources = {}
 
 
 class Portfolio(object):
@@ -26,9 +35,37 @@ class Portfolio(object):
         self.asset_volatilty = pd.DataFrame()
         self.portfolio_volatilty = pd.DataFrame()
         self.benchmark = {}
+        self._prices = None
+        self._close_columns = None
+        self._asset_returns = None
+        self._portfolio_returns = None
+        self.stream = None
+        self._window = None
+        self._log = True
+        self._nodes = DependencyCache({'asset_returns': ('ohlcv',),
+                                       'portfolio_returns': ('asset_returns',),
+                                       'historical_value': ('ohlcv',),
+                                       'fin_metrics': ('ohlcv',),
+                                       'asset_volatility': ('asset_returns',),
+                                       'portfolio_volatility': ('portfolio_returns',),
+                                       'var_historic': ('portfolio_returns',),
+                                       'parametric_var': ('portfolio_returns',),
+                                       'cvar_historic': ('portfolio_returns',),
+                                       'risk_report': ('portfolio_returns',),
+                                       'monte_carlo_var': ('portfolio_returns',),
+                                       'benchmark_returns': ('asset_returns',),
+                                       'betas': ('portfolio_returns', 'benchmark_returns'),
+                                       'rolling_betas': ('portfolio_returns', 'benchmark_returns')})
 
     def set_source(self, api_key):
-        self.source = AMTD(api_key)
+        """Portfolios on the same api key share one client, so they share its rate limit and quote snapshot.
+        An AMTD client can also be passed directly, e.g. one running on an offline transport."""
+        if isinstance(api_key, AMTD):
+            self.source = api_key
+            return
+        if api_key not in _sources:
+            _sources[api_key] = AMTD(api_key)
+        self.source = _sources[api_key]
 
     def _test_source(self):
         if self.source is None:
@@ -42,121 +79,222 @@ class Portfolio(object):
 
     def calculate_shares_from_alloc(self, total_money):
         self._test_source()
-        share_prices = self.source.get_quotes(list(self.asset_alloc.keys()))[['closePrice', 'symbol']] ##COULD BE CLEANED UP
+        share_prices = self.source.quotes.get_prices(list(self.asset_alloc.keys()))
         self.assets = {}
         for key in self.asset_alloc.keys():
-            self.assets[key] = self.asset_alloc[key] * total_money / share_prices['closePrice'][share_prices['symbol'] == key].values[0]
+            self.assets[key] = self.asset_alloc[key] * total_money / share_prices[key]
 
     def calculate_current_value(self):
         """Think about implementing to allow bid/ask/mid"""
         self._test_source()
+        current_prices = self.source.quotes.get_prices(list(self.assets.keys()))
         self.asset_values = {}
         for key in self.assets.keys():
-            current_price = self.source.get_quotes([key])[['closePrice', 'symbol']]
-            self.asset_values[key] = self.assets[key] * current_price['closePrice'][current_price['symbol'] == key].values[0]
+            self.asset_values[key] = self.assets[key] * current_prices[key]
 
     def _get_ohlcv_array(self, start_date, end_date):
         self._test_source()
-        self.portfolio_ohlcv = self.source.get_ohlcv_array(start_date, end_date, list(self.assets.keys()))
-        self.portfolio_ohlcv = self.portfolio_ohlcv[::-1]
-        return self.portfolio_ohlcv
-
-    def get_historical_asset_returns(self, start_date=None, end_date=None, log = True):
+        ohlcv = self.source.get_ohlcv_array(start_date, end_date, list(self.assets.keys()))
+        failed = {str(symbol): str(error) for symbol, error in ohlcv.attrs.get('failed_symbols', [])}
+        if failed or ohlcv.empty:
+            raise KeyError("No prices returned between {} and {} for {}"
+                           .format(start_date, end_date, failed or list(self.assets.keys())))
+        closes = ohlcv.filter(like='close')
+        return TimeSeries.from_frame(closes), closes.columns, ohlcv[::-1]
+
+    def invalidate(self, node=None):
+        """Forgets a cached computation ('ohlcv', 'asset_returns', 'portfolio_returns', ...) and everything computed
+        from it, or all of them if no node is given. Invalidating 'ohlcv' forces the prices to be refetched."""
+        self._nodes.invalidate(node)
+
+    def _window_key(self, start_date, end_date):
+        """Passing both dates moves the window, otherwise the last window is reused"""
+        if bool(start_date) and bool(end_date):
+            self._window = (pd.Timestamp(start_date).strftime('%Y-%m-%d'), pd.Timestamp(end_date).strftime('%Y-%m-%d'))
+        if self._window is None:
+            raise AttributeError("No price history loaded. Pass a start_date and end_date.")
+        return self._window
+
+    def _ohlcv_node(self, start_date=None, end_date=None):
         self._test_source()
-        self._recalc_ohlcv_new_dates_check(start_date, end_date)
-        self.asset_returns = self.portfolio_ohlcv.filter(like ='close')
-        if log:
-            self.asset_returns = np.log(self.portfolio_ohlcv.close/ self.portfolio_ohlcv.close.shift(-1))
+        key = (self._window_key(start_date, end_date), tuple(self.assets.keys()))
+        self._prices, self._close_columns, self.portfolio_ohlcv = \
+            self._nodes.get('ohlcv', key, lambda: self._get_ohlcv_array(*key[0]))
+        return key
+
+    def _asset_returns_node(self, start_date=None, end_date=None):
+        key = (self._ohlcv_node(start_date, end_date), self._log)
+        self._asset_returns, self.asset_returns = self._nodes.get('asset_returns', key, self._calc_asset_returns)
+        return key
+
+    def _portfolio_returns_node(self, start_date=None, end_date=None):
+        key = (self._asset_returns_node(start_date, end_date), tuple(self.asset_alloc.values()))
+        self._portfolio_returns, self.portfolio_returns = \
+            self._nodes.get('portfolio_returns', key, self._calc_portfolio_returns)
+        return key
+
+    def _calc_asset_returns(self):
+        symbols = self._close_columns.get_level_values('symbol')
+        if self._log:
+            returns = self._prices.log_returns(columns=symbols)
         else:
-            self.asset_returns = self.portfolio_ohlcv.close.pct_chg()
+            returns = self._prices.simple_returns(columns=symbols)
+        return returns, returns.to_frame()
+
+    def _calc_portfolio_returns(self):
+        returns = self._asset_returns.values @ np.array(list(self.asset_alloc.values()))
+        return returns, self._asset_returns.to_series(returns)
+
+    def get_historical_asset_returns(self, start_date=None, end_date=None, log = True):
+        self._log = log
+        self._asset_returns_node(start_date, end_date)
         return self.asset_returns
 
     def get_historical_portfolio_returns(self, start_date=None, end_date=None):
-        self._recalc_ohlcv_new_dates_check(start_date, end_date)
-        self._recalc_asset_returns_check(start_date, end_date)
-        self.portfolio_returns = self.asset_returns @ np.array(list(self.asset_alloc.values()))
+        self._portfolio_returns_node(start_date, end_date)
         return self.portfolio_returns
 
     def get_historical_portfolio_value(self, start_date=None, end_date=None, aggregate = False):
-        self._test_source()
-        self._recalc_ohlcv_new_dates_check(start_date, end_date)
-        self._recalc_asset_returns_check(start_date, end_date)
-        self._recalc_portfolio_returns_check(start_date, end_date)
-        if aggregate:
-            self.historical_value = self.portfolio_ohlcv.filter(like='close') @ np.array(list(self.assets.values()))
-        else:
-            self.historical_value = self.portfolio_ohlcv.filter(like='close') * np.array(list(self.assets.values()))
+        self._portfolio_returns_node(start_date, end_date)
+        key = (self._ohlcv_node(), tuple(self.assets.values()), aggregate)
+        self.historical_value = self._nodes.get('historical_value', key, lambda: self._calc_value(aggregate))
         return self.historical_value
 
-    def _recalc_ohlcv_new_dates_check(self, start_date, end_date):
-        self._test_source()
-        if self.portfolio_ohlcv.empty or (bool(start_date) and bool(end_date)):
-            self._get_ohlcv_array(start_date, end_date)
-            self.asset_returns = pd.DataFrame()
-            self.portfolio_returns = pd.DataFrame()
-            self.historical_value = pd.DataFrame()
+    def _calc_value(self, aggregate):
+        kernel = self._fin_metrics_node()
+        if aggregate:
+            return self._prices.to_series(kernel.total_value)
+        return self._prices.to_frame(kernel.asset_val_array)
 
-    def _recalc_asset_returns_check(self, start_date, end_date):
-        self._test_source()
-        if self.asset_returns.empty:
-            self.get_historical_asset_returns(start_date, end_date)
+    def _fin_metrics_node(self, dtype = np.float64):
+        key = (self._ohlcv_node(), tuple(self.assets.values()), tuple(self.asset_alloc.values()), self._log,
+               np.dtype(dtype).str)
+        return self._nodes.get('fin_metrics', key, lambda: self._calc_fin_metrics(dtype))
 
-    def _recalc_portfolio_returns_check(self, start_date, end_date):
-        self._test_source()
-        if self.portfolio_returns.empty:
-            self.get_historical_portfolio_returns(start_date, end_date)
+    def _calc_fin_metrics(self, dtype):
+        kernel = FinMetrics(self._prices.values, list(self.assets.values()), list(self.asset_alloc.values()), dtype)
+        kernel.calculate_metrics(self._log)
+        return kernel
+
+    def fin_metrics(self, dtype = np.float64):
+        """FinMetrics kernel run over the loaded prices, ascending in time. dtype=np.float32 halves its memory for
+        large universes."""
+        return self._fin_metrics_node(dtype)
 
     def get_asset_volatility(self, window = 20, annualized=True):
-        self.asset_volatility = self.asset_returns[::-1].rolling(window).std()[::-1]
-        if annualized:
-            self.asset_volatility = self.asset_volatility * np.sqrt(252)
+        key = (self._asset_returns_node(), window, annualized)
+        self.asset_volatility = self._nodes.get('asset_volatility', key,
+                                                lambda: self._calc_asset_volatility(window, annualized))
         return self.asset_volatility
 
-    def get_portfolio_volatility(self, window = 20, annualized=True):
-        self.portfolio_volatilty = self.portfolio_returns[::-1].rolling(window).std()[::-1]
+    def _calc_asset_volatility(self, window, annualized):
+        volatility = rolling_std(self._asset_returns.values, window)
         if annualized:
-            self.portfolio_volatilty = self.portfolio_volatilty * np.sqrt(252)
+            volatility *= np.sqrt(252)
+        return self._asset_returns.to_frame(volatility)
+
+    def get_portfolio_volatility(self, window = 20, annualized=True):
+        key = (self._portfolio_returns_node(), window, annualized)
+        self.portfolio_volatilty = self._nodes.get('portfolio_volatility', key,
+                                                   lambda: self._calc_portfolio_volatility(window, annualized))
         return self.portfolio_volatilty
 
+    def _calc_portfolio_volatility(self, window, annualized):
+        volatility = rolling_std(self._portfolio_returns, window)
+        if annualized:
+            volatility *= np.sqrt(252)
+        return self._asset_returns.to_series(volatility)
+
+    def start_streaming(self, window = 20, var_window = 250, level = 5, log = None):
+        """Switches to bar-by-bar mode. The running state is seeded from the history already loaded, after which
+        append_bar updates every metric in O(assets) without refetching or recomputing the history. Log or simple
+        returns follow the batch calculations unless log is given."""
+        if log is None:
+            log = self._log
+        self._ohlcv_node()
+        self.stream = PortfolioStream(list(self.asset_alloc.values()), list(self.assets.values()),
+                                      window, var_window, level, log)
+        for date, closes in zip(self._prices.index, self._prices.values):
+            self.stream.update(date, closes)
+        return self.stream.metrics
+
+    def append_bar(self, date, closes):
+        """Feeds one new bar of closes, a dict by symbol or a sequence in asset order, and returns the updated
+        metrics dictionary. The batch DataFrames (asset_returns, portfolio_returns, ...) are not extended."""
+        if self.stream is None:
+            raise AttributeError("Streaming mode not started. Use start_streaming method.")
+        if isinstance(closes, dict):
+            closes = [closes[key] for key in self.assets.keys()]
+        return self.stream.update(np.datetime64(pd.Timestamp(date)), closes)
+
     def asset_corr(self):
+        self._asset_returns_node()
         return self.asset_returns.corr()
 
     def cumm_portfolio_returns(self):
-        return self.portfolio_returns[::-1].cumsum()[::-1]
+        self._portfolio_returns_node()
+        return self._asset_returns.to_series(nancumsum(self._portfolio_returns))
 
     def cumm_asset_returns(self):
-        return self.asset_returns[::-1].cumsum()[::-1]
+        self._asset_returns_node()
+        return self._asset_returns.to_frame(nancumsum(self._asset_returns.values))
 
     def asset_kurtosis(self):
+        self._asset_returns_node()
         return self.asset_returns.kurtosis()
 
     def asset_skew(self):
+        self._asset_returns_node()
         return self.asset_returns.skew()
 
     def portfolio_kurtosis(self):
+        self._portfolio_returns_node()
         return self.portfolio_returns.kurtosis()
 
     def portfolio_skew(self):
+        self._portfolio_returns_node()
         return self.portfolio_returns.skew()
 
+    def _total_value(self):
+        """Ascending array of the summed position values"""
+        return self._fin_metrics_node().total_value
+
     def max_drawdown(self):
-        portfolio_hist_value = self.historical_value.sum(axis=1)
-        peak = portfolio_hist_value.max()
-        trough = portfolio_hist_value.min()
-        max_drawdown = (trough - peak)/ peak
-        return (max_drawdown, portfolio_hist_value.idxmax(), portfolio_hist_value.idxmin())
+        """Largest fall from a running peak of the portfolio value, with the peak and trough dates"""
+        stats = drawdown_stats(self._total_value(), self._prices.index)
+        return (stats['max_drawdown'][0], stats['peak'][0], stats['trough'][0])
+
+    def drawdown_stats(self):
+        """Max drawdown, peak/trough/recovery dates and durations in trading days of the portfolio value"""
+        stats = drawdown_stats(self._total_value(), self._prices.index)
+        return {key: value[0] for key, value in stats.items()}
+
+    def underwater(self, window=None):
+        """Drawdown from the running peak at each date, or the worst drawdown within each trailing window"""
+        values = self._total_value()
+        drawdowns = underwater(values) if window is None else rolling_max_drawdown(values, window)
+        return self._prices.to_series(drawdowns[:, 0])
 
     def sharpe_ratio(self, risk_free=False):
+        """Uses the treasury rate in force on each date unless a flat risk_free rate is passed"""
+        self._portfolio_returns_node()
         if risk_free == False:
-            risk_free = self.source.get_risk_free_rate("1 yr")
-        sharpe_ratio = (self.portfolio_returns[::-1].sum()- risk_free) / (self.portfolio_returns[::-1].std() * np.sqrt(252))
+            risk_free = self.source.get_risk_free_rates(self.portfolio_returns.index)
+            excess_return = (self.portfolio_returns - risk_free).sum()
+        else:
+            excess_return = self.portfolio_returns.sum() - risk_free
+        sharpe_ratio = excess_return / (self.portfolio_returns.std() * np.sqrt(252))
         return sharpe_ratio
 
     def var_historic(self, level=5):
         """VAR Historic
         returns the value at risk for a certain alpha level 0-100 of the data"""
+        key = (self._portfolio_returns_node(), level)
+        return self._nodes.get('var_historic', key, lambda: self._calc_var_historic(level))
+
+    def _calc_var_historic(self, level):
         if isinstance(self.portfolio_returns, pd.DataFrame):
-            return self.portfolio_returns.dropna().aggregate(self.var_historic, level=level)
+            return self.portfolio_returns.dropna().aggregate(self._calc_var_historic, level=level)
         elif isinstance(self.portfolio_returns, pd.Series):
             return -np.percentile(self.portfolio_returns.dropna(), level)
         else:
@@ -164,18 +302,17 @@ class Portfolio(object):
 
 
     def parametric_var(self, level=5, modified=False):
+        key = (self._portfolio_returns_node(), level, modified)
+        return self._nodes.get('parametric_var', key, lambda: self._calc_parametric_var(level, modified))
+
+    def _calc_parametric_var(self, level, modified):
         if isinstance(self.portfolio_returns, pd.DataFrame):
-            return self.portfolio_returns.dropna().aggregate(self.parametric_var, level=level, modified=modified)
+            return self.portfolio_returns.dropna().aggregate(self._calc_parametric_var, level=level, modified=modified)
         elif isinstance(self.portfolio_returns, pd.Series):
             z = norm.ppf(level / 100)
             if modified:
-                # mod z score for skew and kurt
-                s = self.portfolio_returns.skew()
-                k = self.portfolio_returns.kurtosis()
-                z = (z +
-                     (z ** 2 - 1) * s / 6 +
-                     (z ** 3 - 3 * z) * k / 24 -  # they did k-3
-                     (2 * z ** 3 - 5 * z) * (s ** 2) / 36)
+                # mod z score for skew and (excess) kurt
+                z = cornish_fisher_z(z, self.portfolio_returns.skew(), self.portfolio_returns.kurtosis())
             return -(self.portfolio_returns.mean() + z * self.portfolio_returns.std())
         else:
             raise TypeError("Expected Series or DataFrame")
@@ -183,112 +320,282 @@ class Portfolio(object):
     def cvar_historic(self, level=5):
         """CVAR Historic
         returns the conditional value at risk for a certain alpha level 0-100 of the data"""
+        key = (self._portfolio_returns_node(), level)
+        return self._nodes.get('cvar_historic', key, lambda: self._calc_cvar_historic(level))
+
+    def _calc_cvar_historic(self, level):
         if isinstance(self.portfolio_returns, pd.DataFrame):
-            return self.portfolio_returns.dropna().aggregate(self.cvar_historic, level=level)
+            return self.portfolio_returns.dropna().aggregate(self._calc_cvar_historic, level=level)
         elif isinstance(self.portfolio_returns, pd.Series):
-            is_beyond = self.portfolio_returns.dropna() <= -self.var_historic(level=level)
-            return -self.portfolio_returns.dropna()[is_beyond].mean()
+            var, cvar = historic_risk(self.portfolio_returns.dropna().values, [level])
+            return cvar[0]
         else:
             raise TypeError("Expected Series or DataFrame")
 
+    def risk_report(self, levels=(1, 2.5, 5), window=250, step=1):
+        """Historic VaR/CVaR, parametric VaR and modified VaR at every level over trailing windows of `window`
+        returns stepped by `step` days, or over the full sample if window is None. Columns are (measure, level),
+        rows are window end dates, newest first."""
+        key = (self._portfolio_returns_node(), tuple(levels), window, step)
+        return self._nodes.get('risk_report', key, lambda: self._calc_risk_report(levels, window, step))
+
+    def _calc_risk_report(self, levels, window, step):
+        keep = np.isfinite(self._portfolio_returns)
+        risk = rolling_risk(self._portfolio_returns[keep], levels, window, step)
+        index = pd.DatetimeIndex(self._asset_returns.index[keep][risk.pop('end')], name='datetime')
+        columns = pd.MultiIndex.from_product([list(risk), list(levels)])
+        values = np.concatenate([risk[measure][:, :, 0] for measure in risk], axis=1)
+        return pd.DataFrame(values[::-1], index=index[::-1], columns=columns)
+
+    def monte_carlo_var(self, levels=(1, 5), horizon=1, paths=100000, innovations='normal', dof=5, seed=0,
+                        workers=1, confidence=95):
+        """Monte Carlo VaR/CVaR with confidence intervals over a horizon in days, simulated from the loaded asset
+        returns. See library.montecarlo.MonteCarloVaR for the innovation choices. workers > 1 (None for all
+        cores) spreads the paths over a process pool; results for a seed do not depend on the worker count."""
+        key = (self._portfolio_returns_node(), tuple(levels), horizon, paths, innovations, dof, seed, confidence)
+        return self._nodes.get('monte_carlo_var', key, lambda: MonteCarloVaR(
+            self._asset_returns.values, list(self.asset_alloc.values()), horizon, innovations, dof, self._log
+        ).var(levels, paths, seed, workers=workers, confidence=confidence))
+
+    def _benchmark_returns_node(self, benchmarks):
+        """Benchmark returns aligned to the asset return dates, from the client's shared benchmark store"""
+        key = (self._asset_returns_node(), benchmarks)
+        returns = self._nodes.get('benchmark_returns', key, lambda: self._calc_benchmark_returns(benchmarks))
+        self.benchmark.update({b: self._asset_returns.to_series(returns[:, i], name=b) for i, b in enumerate(benchmarks)})
+        return key, returns
+
+    def _calc_benchmark_returns(self, benchmarks):
+        index = pd.DatetimeIndex(self._asset_returns.index)
+        returns = self.source.benchmarks.returns(benchmarks, index[0], index[-1], log=self._log)
+        return returns.reindex(index).values
+
+    def _betas_node(self, benchmarks):
+        """(assets + portfolio) x benchmarks betas, the portfolio in the last row"""
+        key, benchmark_returns = self._benchmark_returns_node(benchmarks)
+        key = (self._portfolio_returns_node(), key)
+        return self._nodes.get('betas', key, lambda: betas(
+            np.column_stack([self._asset_returns.values, self._portfolio_returns]), benchmark_returns))
+
+    def rolling_beta(self, benchmark = "SPY", window = None, halflife = None):
+        """Rolling (or exponentially weighted, if a halflife is given) beta, correlation and per period alpha of
+        every asset and the portfolio to one or more benchmarks. The window defaults to 60 days without a halflife.
+        Returns a dictionary of (time x asset x benchmark) arrays in ascending date order, with the 'index' dates,
+        the 'assets' (the portfolio last, as 'Portfolio') and the 'benchmarks' labelling the axes."""
+        if window is None and halflife is None:
+            window = 60
+        benchmarks = self._benchmark_tuple(benchmark)
+        key, benchmark_returns = self._benchmark_returns_node(benchmarks)
+        key = (self._portfolio_returns_node(), key, window, halflife)
+        result = self._nodes.get('rolling_betas', key, lambda: rolling_betas(
+            np.column_stack([self._asset_returns.values, self._portfolio_returns]), benchmark_returns,
+            window, halflife))
+        return dict(result, index=self._asset_returns.index, assets=list(self.assets.keys()) + ['Portfolio'],
+                    benchmarks=list(benchmarks))
+
+    @staticmethod
+    def _benchmark_tuple(benchmark):
+        return (benchmark,) if isinstance(benchmark, str) else tuple(benchmark)
+
     def portfolio_beta(self, benchmark = "SPY"):
-        if benchmark not in self.benchmark.keys():
-            self.benchmark = {benchmark: None}
-            end = self.portfolio_returns.index[0].strftime('%m-%d-%Y')
-            start = self.portfolio_returns.index[-1].strftime('%m-%d-%Y')
-            prices = self.source.get_daily_price_timeframe(benchmark,start, end)['close'][::-1]
-            self.benchmark[benchmark] = np.log(prices/ prices.shift(-1)).squeeze()
-        combo = pd.concat([self.portfolio_returns, self.benchmark[benchmark]], axis = 1)
-        beta = combo.cov()/self.benchmark[benchmark].var()
-        return beta['SPY'][beta.index != benchmark].item()
+        """Beta to one benchmark, or a Series of betas if a list of benchmarks is passed"""
+        benchmarks = self._benchmark_tuple(benchmark)
+        beta = self._betas_node(benchmarks)[-1]
+        return beta[0].item() if isinstance(benchmark, str) else pd.Series(beta, index=list(benchmarks))
 
     def asset_beta(self, benchmark = "SPY"):
-        if benchmark not in self.benchmark.keys():
-            self.benchmark = {benchmark: None}
-            end = self.asset_returns.index[0].strftime('%m-%d-%Y')
-            start = self.asset_returns.index[-1].strftime('%m-%d-%Y')
-            prices = self.source.get_daily_price_timeframe(benchmark,start, end)['close'][::-1]
-            self.benchmark[benchmark] = np.log(prices/ prices.shift(-1)).squeeze()
-        combo = pd.concat([self.asset_returns, self.benchmark[benchmark]], axis = 1)
-        beta = combo.cov()/self.benchmark[benchmark].var()
-        return beta['SPY'][beta.index != benchmark].copy()
+        """Series of asset betas to one benchmark, or an assets x benchmarks DataFrame for a list of benchmarks"""
+        benchmarks = self._benchmark_tuple(benchmark)
+        beta = pd.DataFrame(self._betas_node(benchmarks)[:-1], index=self.asset_returns.columns, columns=list(benchmarks))
+        return beta[benchmark] if isinstance(benchmark, str) else beta
+
+    def _risk_free_return(self, returns):
+        """Risk free return accrued over the dates of the returns, using the rate in force on each date"""
+        return self.source.get_risk_free_rates(returns.dropna().index).sum()
+
+    def _benchmark_total(self, benchmarks):
+        return np.nansum(self._benchmark_returns_node(benchmarks)[1], axis=0)
 
     def portfolio_alpha(self, benchmark):
-        portfolio_return = self.portfolio_returns[::-1].cumsum()[::-1][0]
-        if not bool(self.source.risk_free):
-            self.source.get_risk_free_rate("1 yr")
-        beta = self.portfolio_beta(benchmark)
-        benchmark_return = self.benchmark[benchmark][::-1].cumsum()[::-1][0]
-        alpha = portfolio_return - self.source.risk_free - beta * (benchmark_return - self.source.risk_free)
-        return alpha
+        """Jensen's alpha over the loaded window to one benchmark, or a Series for a list of benchmarks"""
+        benchmarks = self._benchmark_tuple(benchmark)
+        beta = self._betas_node(benchmarks)[-1]
+        portfolio_return = np.nansum(self._portfolio_returns)
+        risk_free = self._risk_free_return(self.portfolio_returns)
+        alpha = portfolio_return - risk_free - beta * (self._benchmark_total(benchmarks) - risk_free)
+        return alpha[0].item() if isinstance(benchmark, str) else pd.Series(alpha, index=list(benchmarks))
 
     def asset_alpha(self, benchmark):
-        total_returns = self.asset_returns[::-1].cumsum()[::-1].iloc[0,:]
-        if not bool(self.source.risk_free):
-            self.source.get_risk_free_rate("1 yr")
-        beta = self.portfolio_beta(benchmark)
-        benchmark_return = self.benchmark[benchmark][::-1].cumsum()[::-1][0]
-        alpha = total_returns - self.source.risk_free - beta * (benchmark_return - self.source.risk_free)
-        return alpha
+        """Jensen's alpha of every asset using its own beta, a Series for one benchmark or an assets x benchmarks
+        DataFrame for a list"""
+        benchmarks = self._benchmark_tuple(benchmark)
+        beta = self._betas_node(benchmarks)[:-1]
+        total_returns = np.nansum(self._asset_returns.values, axis=0)[:, None]
+        risk_free = self._risk_free_return(self.asset_returns)
+        alpha = total_returns - risk_free - beta * (self._benchmark_total(benchmarks) - risk_free)
+        alpha = pd.DataFrame(alpha, index=self.asset_returns.columns, columns=list(benchmarks))
+        return alpha[benchmark] if isinstance(benchmark, str) else alpha
 
 
 class StressTest(object):
+    """Factor exposures of a portfolio, its assets, or many weightings of its assets, over the portfolio's window"""
     def __init__(self, portfolio :Portfolio):
         self.portfolio = portfolio
-        self.end_date = portfolio.portfolio_returns.index[0].strftime('%m-%d-%Y')
-        self.start_date = portfolio.portfolio_returns.index[-1].strftime('%m-%d-%Y')
+        self.start_date, self.end_date = portfolio._window
         self.factors = None
+        self.factor_returns = None
+        self.regression_results = None
+        self.scenarios = ScenarioSet(portfolio.source, [], log=portfolio._log)
 
     def set_factors(self, list_of_tickers: list):
         self.factors = list_of_tickers
         factors = {key: 1 for key in list_of_tickers}
         self.factor_portfolio = Portfolio(factors)
         self.factor_portfolio.calculate_alloc_from_shares()
+        self.factor_returns = None
+        self.scenarios.factors = list(list_of_tickers)
 
     def get_factor_data(self):
-        self.factor_portfolio.set_source(apikey)
-        self.factor_portfolio.get_historical_portfolio_value(self.start_date, self.end_date)
-
-    def regress(self, factors = None):
-        if not bool(factors):
-            model = sm.OLS(self.portfolio.portfolio_returns.dropna(), (self.factor_portfolio.asset_returns.dropna()))
+        """Loads the factor returns through the portfolio's own client and aligns them once to the portfolio's
+        dates, ascending, in self.factor_returns"""
+        self.factor_portfolio.set_source(self.portfolio.source)
+        self.factor_portfolio.get_historical_asset_returns(self.start_date, self.end_date, log=self.portfolio._log)
+        dates = pd.DatetimeIndex(self.portfolio._asset_returns.index)
+        self.factor_returns = self.factor_portfolio.asset_returns.reindex(dates)[self.factors].values
+
+    def _regression_inputs(self, factors, weights, names):
+        """Returns matrix (assets and the portfolio, or one column per weight row), its row names and the selected
+        factor columns"""
+        if self.factor_returns is None:
+            self.get_factor_data()
+        self.portfolio._portfolio_returns_node()
+        asset_returns = self.portfolio._asset_returns.values
+        if weights is None:
+            returns = np.column_stack([asset_returns, self.portfolio._portfolio_returns])
+            names = list(self.portfolio.assets.keys()) + ['Portfolio']
+        else:
+            returns = asset_returns @ np.atleast_2d(np.asarray(weights, dtype=np.float64)).T
+            names = list(range(returns.shape[1])) if names is None else list(names)
+        columns = [self.factors.index(f) for f in factors]
+        return returns, names, self.factor_returns[:, columns]
+
+    def regress(self, factors = None, weights = None, names = None, intercept = True):
+        """OLS factor exposures in one solve. Without weights the rows are the assets then 'Portfolio'; with a
+        (P x assets) weight matrix each row is one weighting, labelled by names. Returns and keeps in
+        regression_results a dictionary of arrays (see factors.factor_regression) with 'names' and 'factors'."""
+        factors = list(factors or self.factors)
+        returns, names, factor_returns = self._regression_inputs(factors, weights, names)
+        self.regression_results = dict(factor_regression(returns, factor_returns, intercept),
+                                       names=names, factors=factors)
+        return self.regression_results
+
+    def rolling_exposures(self, window = None, halflife = None, factors = None, weights = None, names = None,
+                          intercept = True):
+        """Factor betas through time: expanding by default, over trailing windows of `window` days, or
+        exponentially weighted with a halflife in days. Rows as in regress. Returns a dictionary with 'betas'
+        (time x row x factor), 'alpha' (time x row), the ascending 'index' dates, 'names' and 'factors'."""
+        factors = list(factors or self.factors)
+        returns, names, factor_returns = self._regression_inputs(factors, weights, names)
+        return dict(rolling_factor_regression(returns, factor_returns, window, halflife, intercept),
+                    index=self.portfolio._asset_returns.index, names=names, factors=factors)
+
+    def add_scenario(self, name, start = None, end = None):
+        """Adds a named historical window, or a preset from scenarios.HISTORICAL_SCENARIOS if no dates are given"""
+        if start is None:
+            self.scenarios.add_historical([name])
         else:
-            model = sm.OLS(self.portfolio.portfolio_returns.dropna(),(self.factor_portfolio.asset_returns.dropna()[factors]))
-        results = model.fit()
-        self.regression_results = results
-        print(results.summary())
+            self.scenarios.add_scenario(name, start, end)
+
+    def run_scenarios(self, weights = None, names = None, values = None):
+        """Replays every scenario against the assets and the portfolio, or every row of a weight matrix, in one
+        batch. Asset history missing from a window is proxied through the assets' factor betas over the
+        portfolio's window, regressed only if needed (set_factors first) and not stored in regression_results.
+        Returns (row x scenario) 'pnl' and 'max_drawdown' DataFrames."""
+        symbols = list(self.portfolio.assets.keys())
+        if weights is None:
+            weights = np.vstack([np.eye(len(symbols)), list(self.portfolio.asset_alloc.values())])
+            names = symbols + ['Portfolio']
+        def proxy_betas():
+            returns, _, factor_returns = self._regression_inputs(self.factors, None, None)
+            return factor_regression(returns, factor_returns)['betas'][:len(symbols)]
+        return self.scenarios.run(symbols, weights, proxy_betas if self.factors else None, names, values)
 
 
 class FinMetrics(object):
-    """Pass in array of prices, either of a single asset or entire portfolio.
-    This object leverages numpy indices for portfolio calculations."""
-    def __init__(self, price_array, shares_array, alloc_array):
-        self.alloc_array = alloc_array
-        self.shares_array = shares_array
-        self.prices_array = price_array
-        self.asset_val_array = None
-        self.returns_array = None
-        self.portfolio_returns = None
+    """Pass in array of prices, either of a single asset or entire portfolio, as a (time x asset) array in
+    ascending time order with the share counts and allocation weights in asset order.
+    This object leverages numpy indices for portfolio calculations. dtype=np.float32 halves the memory of the
+    prices and of every output. Outputs go into buffers allocated once here, so a recalculation overwrites them."""
+    def __init__(self, price_array, shares_array, alloc_array, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        prices = np.asarray(price_array, dtype=self.dtype)
+        self.prices_array = np.ascontiguousarray(prices.reshape(len(prices), -1))
+        self.shares_array = np.asarray(shares_array, dtype=self.dtype)
+        self.alloc_array = np.asarray(alloc_array, dtype=self.dtype)
+        shape = self.prices_array.shape
+        self.returns_array = np.empty(shape, self.dtype)
+        self.cumm_returns_array = np.empty(shape, self.dtype)
+        self.volatility_array = np.empty(shape, self.dtype)
+        self.asset_val_array = np.empty(shape, self.dtype)
+        self.portfolio_returns = np.empty(shape[0], self.dtype)
+        self.total_value = np.empty(shape[0], self.dtype)
+        self.underwater = np.empty(shape[0], self.dtype)
         self.metrics = {}
 
     def get_returns_array(self, log_returns = True):
+        """Asset and portfolio returns, NaN on the first date"""
+        prices, returns = self.prices_array, self.returns_array
+        returns[0] = np.nan
+        np.divide(prices[1:], prices[:-1], out=returns[1:])
         if log_returns:
-            self.returns_array = np.log(self.prices_array/self.prices_array.shift(1))
+            np.log(returns[1:], out=returns[1:])
         else:
-            self.returns_array = self.prices_array.pct_chg()
-
-    def calculate_volatility(self):
-        NotImplementedError
+            returns[1:] -= 1
+        np.dot(returns, self.alloc_array, out=self.portfolio_returns)
+        return self.returns_array
+
+    def calculate_volatility(self, window = None, annualized = True, periods = 252):
+        """Full sample volatility per asset, or the rolling volatility of each asset if a window is given. Returns a
+        new array and leaves the metrics and buffers alone, so it is safe on the kernel a Portfolio caches."""
+        scale = np.sqrt(periods) if annualized else 1
+        if window is None:
+            return np.nanstd(self.returns_array, axis=0, ddof=1) * scale
+        return rolling_std(self.returns_array, window) * scale
+
+    def _calculate_volatility(self, window):
+        if window is None:
+            self.metrics['Volatility'] = self.calculate_volatility()
+        else:
+            self.volatility_array[...] = self.calculate_volatility(window)
+            self.metrics['Volatility'] = self.volatility_array
 
     def _calculate_cummulative_returns(self):
-        self.metrics['Cummulative Returns'] = self.returns_array.cumsum()
+        np.nancumsum(self.returns_array, axis=0, out=self.cumm_returns_array)
+        self.cumm_returns_array[np.isnan(self.returns_array)] = np.nan
+        self.metrics['Cummulative Returns'] = self.cumm_returns_array
 
     def _calculate_asset_val_array(self):
-        self.asset_val_array = self.shares_array @ self.prices_array
+        np.multiply(self.prices_array, self.shares_array, out=self.asset_val_array)
+        # an asset without a price on a date (not yet listed, halted) adds nothing rather than blanking the total
+        np.nansum(self.asset_val_array, axis=1, out=self.total_value)
+        self.total_value[np.isnan(self.asset_val_array).all(axis=1)] = np.nan
 
     def _calculate_gain_loss(self):
-        self.metrics['Gain/Loss'] = self.asset_val_array[-1,:].sum() - self.asset_val_array[0,:].sum()
-
-
-
-
+        valued = self.total_value[np.isfinite(self.total_value)]
+        self.metrics['Gain/Loss'] = valued[-1] - valued[0] if len(valued) else np.nan
+
+    def _calculate_drawdown(self):
+        np.fmax.accumulate(self.total_value, out=self.underwater)
+        np.divide(self.total_value, self.underwater, out=self.underwater)
+        self.underwater -= 1
+        self.metrics['Max Drawdown'] = np.fmin.reduce(self.underwater)
+
+    def calculate_metrics(self, log_returns = True, window = None):
+        """Runs every calculation and returns the metrics dictionary"""
+        self.get_returns_array(log_returns)
+        self._calculate_asset_val_array()
+        self._calculate_cummulative_returns()
+        self._calculate_volatility(window)
+        self._calculate_gain_loss()
+        self._calculate_drawdown()
+        self.metrics['Returns'] = np.nansum(self.portfolio_returns)
+        return self.metrics
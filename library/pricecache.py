@@ -0,0 +1,161 @@
+"""
+Local SQLite cache of daily OHLCV candles so repeated history pulls only hit the API for dates we have not seen.
+"""
+
+import datetime
+import os
+import sqlite3
+import threading
+import pandas as pd
+
+
+class PriceCache(object):
+    """On-disk cache of raw daily candles keyed by symbol and date.
+    Alongside the candles it keeps the date ranges that have already been requested from the API, so days with no
+    bars (weekends, holidays, pre-IPO) are not refetched. Ranges are half-open [start, end) to match the API."""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS candles (
+                                symbol TEXT NOT NULL,
+                                date TEXT NOT NULL,
+                                datetime INTEGER NOT NULL,
+                                open REAL, high REAL, low REAL, close REAL, volume INTEGER,
+                                PRIMARY KEY (symbol, date))""")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS coverage (
+                                symbol TEXT NOT NULL,
+                                start TEXT NOT NULL,
+                                end TEXT NOT NULL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS coverage_symbol ON coverage (symbol)")
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+        self.fetched_ranges = 0
+
+    @staticmethod
+    def _to_date(value):
+        return pd.to_datetime(value).date()
+
+    def _coverage(self, symbol):
+        rows = self._conn.execute("SELECT start, end FROM coverage WHERE symbol = ? ORDER BY start",
+                                  (symbol,)).fetchall()
+        return [(datetime.date.fromisoformat(s), datetime.date.fromisoformat(e)) for s, e in rows]
+
+    def missing_ranges(self, symbol, start, end):
+        """Returns the list of (start, end) date ranges in [start, end) that are not covered by the cache."""
+        start, end = self._to_date(start), self._to_date(end)
+        with self._lock:
+            covered = self._coverage(str(symbol))
+        gaps = []
+        cursor = start
+        for c_start, c_end in covered:
+            if c_end <= cursor:
+                continue
+            if c_start >= end:
+                break
+            if c_start > cursor:
+                gaps.append((cursor, c_start))
+            cursor = max(cursor, c_end)
+            if cursor >= end:
+                break
+        if cursor < end:
+            gaps.append((cursor, end))
+        with self._lock:
+            if gaps:
+                self.misses += 1
+                self.fetched_ranges += len(gaps)
+            else:
+                self.hits += 1
+        return gaps
+
+    def store(self, symbol, data, start, end):
+        """Writes the raw price history dictionary from the API and marks [start, end) as covered.
+        Today and later are never marked as covered since the current bar may still change."""
+        if 'candles' not in data:
+            raise ValueError("Price history response for {} has no candles: {}".format(symbol, data))
+        symbol = str(symbol)
+        start, end = self._to_date(start), min(self._to_date(end), datetime.date.today())
+        utc = datetime.timezone.utc
+        rows = [(symbol, datetime.datetime.fromtimestamp(c['datetime'] / 1000, tz=utc).date().isoformat(),
+                 int(c['datetime']), c['open'], c['high'], c['low'], c['close'], int(c['volume']))
+                for c in data['candles']]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO candles VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            if start < end:
+                self._add_coverage(symbol, start, end)
+            self._conn.commit()
+
+    def _add_coverage(self, symbol, start, end):
+        """Inserts a covered range and merges it with any overlapping or adjacent ranges."""
+        merged_start, merged_end = start, end
+        for c_start, c_end in self._coverage(symbol):
+            if c_end >= start and c_start <= end:
+                merged_start, merged_end = min(merged_start, c_start), max(merged_end, c_end)
+        self._conn.execute("DELETE FROM coverage WHERE symbol = ? AND end >= ? AND start <= ?",
+                           (symbol, start.isoformat(), end.isoformat()))
+        self._conn.execute("INSERT INTO coverage VALUES (?, ?, ?)",
+                           (symbol, merged_start.isoformat(), merged_end.isoformat()))
+
+    def load(self, symbol, start, end):
+        """Returns the cached candles in [start, end) in the same dictionary form as the price history endpoint."""
+        symbol = str(symbol)
+        start, end = self._to_date(start), self._to_date(end)
+        with self._lock:
+            rows = self._conn.execute("""SELECT open, high, low, close, volume, datetime FROM candles
+                                         WHERE symbol = ? AND date >= ? AND date < ? ORDER BY date""",
+                                      (symbol, start.isoformat(), end.isoformat())).fetchall()
+        candles = [dict(zip(('open', 'high', 'low', 'close', 'volume', 'datetime'), r)) for r in rows]
+        return {'candles': candles, 'symbol': symbol, 'empty': not candles}
+
+    def invalidate(self, symbol=None, start=None, end=None):
+        """Drops cached candles and coverage. With no arguments the whole cache is cleared, with a symbol only that
+        symbol, and with start/end only that date range is forgotten."""
+        with self._lock:
+            symbols = [str(symbol)] if symbol is not None else \
+                [r[0] for r in self._conn.execute("SELECT DISTINCT symbol FROM coverage").fetchall()]
+            if start is None and end is None:
+                if symbol is None:
+                    self._conn.execute("DELETE FROM candles")
+                    self._conn.execute("DELETE FROM coverage")
+                else:
+                    self._conn.execute("DELETE FROM candles WHERE symbol = ?", (str(symbol),))
+                    self._conn.execute("DELETE FROM coverage WHERE symbol = ?", (str(symbol),))
+            else:
+                start = self._to_date(start) if start is not None else datetime.date.min
+                end = self._to_date(end) if end is not None else datetime.date.max
+                for s in symbols:
+                    self._remove_coverage(s, start, end)
+                    self._conn.execute("DELETE FROM candles WHERE symbol = ? AND date >= ? AND date < ?",
+                                       (s, start.isoformat(), end.isoformat()))
+            self._conn.commit()
+
+    def _remove_coverage(self, symbol, start, end):
+        """Cuts [start, end) out of the covered ranges of a symbol."""
+        remaining = []
+        for c_start, c_end in self._coverage(symbol):
+            if c_end <= start or c_start >= end:
+                remaining.append((c_start, c_end))
+                continue
+            if c_start < start:
+                remaining.append((c_start, start))
+            if c_end > end:
+                remaining.append((end, c_end))
+        self._conn.execute("DELETE FROM coverage WHERE symbol = ?", (symbol,))
+        self._conn.executemany("INSERT INTO coverage VALUES (?, ?, ?)",
+                               [(symbol, s.isoformat(), e.isoformat()) for s, e in remaining])
+
+    def stats(self):
+        """Returns a dictionary of cache usage counters and size."""
+        with self._lock:
+            rows = self._conn.execute("SELECT COUNT(*), COUNT(DISTINCT symbol) FROM candles").fetchone()
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'fetched_ranges': self.fetched_ranges,
+                'rows': rows[0],
+                'symbols': rows[1],
+                'bytes': os.path.getsize(self.path) if os.path.exists(self.path) else 0}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
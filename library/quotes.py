@@ -0,0 +1,43 @@
+"""
+Short lived in-memory quote snapshot so valuing many portfolios over the same tickers costs a few batched quote calls.
+"""
+
+import threading
+import time
+
+
+class QuoteSnapshot(object):
+    """Caches raw quotes per symbol for `ttl` seconds. Missing or expired symbols are fetched together in chunks of
+    `chunk_size` through the comma separated quotes endpoint of the source."""
+    def __init__(self, source, ttl=15, chunk_size=300):
+        self.source = source
+        self.ttl = ttl
+        self.chunk_size = chunk_size
+        self._quotes = {}
+        self._lock = threading.Lock()
+
+    def get(self, symbols):
+        """Returns a dictionary of symbol to raw quote dictionary"""
+        symbols = [str(s) for s in symbols]
+        now = time.monotonic()
+        with self._lock:
+            stale = [s for s in dict.fromkeys(symbols) if s not in self._quotes or now - self._quotes[s][0] > self.ttl]
+        for i in range(0, len(stale), self.chunk_size):
+            raw = self.source._get_quotes_raw(stale[i:i + self.chunk_size])
+            fetched = time.monotonic()
+            with self._lock:
+                for symbol, quote in raw.items():
+                    self._quotes[symbol] = (fetched, quote)
+        with self._lock:
+            missing = [s for s in symbols if s not in self._quotes]
+            if missing:
+                raise KeyError("No quotes returned for {}".format(missing))
+            return {s: self._quotes[s][1] for s in symbols}
+
+    def get_prices(self, symbols, field='closePrice'):
+        """Returns a dictionary of symbol to the given quote field, closePrice by default"""
+        return {s: q[field] for s, q in self.get(symbols).items()}
+
+    def clear(self):
+        with self._lock:
+            self._quotes = {}
@@ -0,0 +1,57 @@
+"""
+Rate limiting helpers shared by the API clients.
+"""
+
+import asyncio
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket. Tokens refill continuously at `rate` per second up to `capacity`,
+    and every API call takes one token, blocking until one is available."""
+    def __init__(self, rate=2, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """Takes a token if one is available and returns 0, otherwise returns the seconds until the next token"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        wait = self._take()
+        while wait:
+            time.sleep(wait)
+            wait = self._take()
+
+
+class AsyncRateLimiter(object):
+    """Asyncio limiter combining a semaphore on requests in flight with token bucket pacing.
+    Use as `async with limiter:` around each request. The bucket can be shared with a synchronous client."""
+    def __init__(self, bucket=None, max_in_flight=100):
+        self.bucket = bucket if bucket is not None else TokenBucket()
+        self.max_in_flight = max_in_flight
+        self._semaphore = None
+
+    async def __aenter__(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        await self._semaphore.acquire()
+        wait = self.bucket._take()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self.bucket._take()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._semaphore.release()
@@ -0,0 +1,116 @@
+"""
+Multi-level risk engine. Historic VaR/CVaR and parametric/Cornish-Fisher VaR for several confidence levels over
+rolling windows of a (time x portfolio) return matrix, computed a chunk of windows at a time with partial sorts.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.stats import norm
+from library.timeseries import window_sums
+
+
+def cornish_fisher_z(z, skew, kurt):
+    """Cornish-Fisher adjusted z score for skew and excess kurtosis, as in Portfolio.parametric_var"""
+    return (z +
+            (z ** 2 - 1) * skew / 6 +
+            (z ** 3 - 3 * z) * kurt / 24 -
+            (2 * z ** 3 - 5 * z) * (skew ** 2) / 36)
+
+
+def sample_skew_kurtosis(n, m2, m3, m4):
+    """pandas-style bias corrected skew and excess kurtosis from the count and the sums of the second, third and
+    fourth powers of deviations from the mean. NaN below 3 observations for skew and 4 for kurtosis."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        skew = np.sqrt(n * (n - 1)) / (n - 2) * np.sqrt(n) * m3 / m2 ** 1.5
+        g2 = n * m4 / (m2 * m2) - 3
+        kurt = ((n + 1) * g2 + 6) * (n - 1) / ((n - 2) * (n - 3))
+    return np.where(n > 2, skew, np.nan), np.where(n > 3, kurt, np.nan)
+
+
+def historic_risk(windows, levels):
+    """Historic VaR and CVaR of each window along the last axis, for every level 0-100.
+    Only the order statistics around each percentile are placed (np.partition), matching np.percentile's linear
+    interpolation. Everything left of a placed statistic is no larger than it, so the tail sums come from one
+    cumulative sum; windows tied at the quantile are recounted exactly. Returns (var, cvar), each shaped
+    windows.shape[:-1] + (levels,)."""
+    windows = np.asarray(windows, dtype=np.float64)
+    n = windows.shape[-1]
+    h = (n - 1) * np.asarray(levels, dtype=np.float64) / 100
+    lo = np.floor(h).astype(np.intp)
+    hi = np.minimum(lo + 1, n - 1)
+    part = np.partition(windows, np.unique(np.concatenate([lo, hi])), axis=-1)
+    quantiles = part[..., lo] + (h - lo) * (part[..., hi] - part[..., lo])
+    tail = np.cumsum(part, axis=-1)[..., lo]
+    count = np.broadcast_to(lo + 1.0, tail.shape).copy()
+    ties = (part[..., hi] <= quantiles) & (hi > lo)
+    for i in np.flatnonzero(ties.reshape(-1, len(lo)).any(axis=0)):
+        tied = ties[..., i]
+        beyond = part[tied] <= quantiles[tied][:, i:i + 1]
+        tail[tied, i] = (part[tied] * beyond).sum(axis=-1)
+        count[tied, i] = beyond.sum(axis=-1)
+    return -quantiles, -tail / count
+
+
+def rolling_moments(returns, window):
+    """Mean, sample std and pandas-style skew and excess kurtosis over every trailing window, from running sums
+    of powers. Returns are centred on their column means first to limit cancellation. Windows holding a NaN are NaN."""
+    returns = np.asarray(returns, dtype=np.float64)
+    valid = np.isfinite(returns)
+    x = np.where(valid, returns, 0.0)
+    centre = x.sum(axis=0) / np.maximum(valid.sum(axis=0), 1)
+    x = np.where(valid, x - centre, 0.0)
+    x2 = x * x
+    n = window
+    s1 = window_sums(x, n) / n
+    s2 = window_sums(x2, n) / n
+    s3 = window_sums(x2 * x, n) / n
+    s4 = window_sums(x2 * x2, n) / n
+    complete = window_sums(valid.astype(np.float64), n) == n
+    m2 = (s2 - s1 * s1) * n
+    m3 = (s3 - 3 * s1 * s2 + 2 * s1 ** 3) * n
+    m4 = (s4 - 4 * s1 * s3 + 6 * s1 * s1 * s2 - 3 * s1 ** 4) * n
+    m2 = np.maximum(m2, 0)
+    std = np.sqrt(m2 / (n - 1))
+    skew, kurt = sample_skew_kurtosis(n, m2, m3, m4)
+    moments = [s1 + centre, std, skew, kurt]
+    return [np.where(complete, m, np.nan) for m in moments]
+
+
+def rolling_risk(returns, levels=(5,), window=None, step=1, chunk_size=None):
+    """Historic VaR/CVaR, parametric VaR and Cornish-Fisher (modified) VaR for every level and every portfolio
+    column of a (time x portfolio) return matrix, over trailing windows of `window` rows stepped by `step`, or over
+    the full sample if window is None. Windows containing a NaN come back NaN.
+    Returns a dictionary with 'end', the row of each window's last return, and one
+    (windows x levels x portfolios) array per measure. Historic measures are computed chunk_size windows at a
+    time so memory stays near chunk_size x window x portfolios."""
+    returns = np.asarray(returns, dtype=np.float64)
+    returns = returns.reshape(len(returns), -1)
+    levels = np.atleast_1d(np.asarray(levels, dtype=np.float64))
+    window = len(returns) if window is None else window
+    end = np.arange(window - 1, len(returns), step)
+    shape = (len(end), len(levels), returns.shape[1])
+    risk = {'end': end,
+            'var_historic': np.full(shape, np.nan),
+            'cvar_historic': np.full(shape, np.nan),
+            'parametric_var': np.full(shape, np.nan),
+            'modified_var': np.full(shape, np.nan)}
+    if not len(end):
+        return risk
+
+    complete = window_sums(np.isfinite(returns).astype(np.float64), window)[end - window + 1] == window
+    windows = sliding_window_view(returns, window, axis=0)[::step]
+    if chunk_size is None:
+        chunk_size = max(1, 2 ** 22 // (window * returns.shape[1]))
+    for start in range(0, len(end), chunk_size):
+        stop = start + chunk_size
+        var, cvar = historic_risk(windows[start:stop], levels)
+        risk['var_historic'][start:stop] = var.transpose(0, 2, 1)
+        risk['cvar_historic'][start:stop] = cvar.transpose(0, 2, 1)
+    for measure in ('var_historic', 'cvar_historic'):
+        risk[measure][~complete[:, None, :].repeat(len(levels), axis=1)] = np.nan
+
+    mean, std, skew, kurt = (m[end - window + 1][:, None, :] for m in rolling_moments(returns, window))
+    z = norm.ppf(levels / 100)[None, :, None]
+    risk['parametric_var'] = -(mean + z * std)
+    risk['modified_var'] = -(mean + cornish_fisher_z(z, skew, kurt) * std)
+    return risk
@@ -0,0 +1,92 @@
+"""
+Historical scenario replay. Named shock windows are held as precomputed asset and factor return paths and applied
+to many portfolios at once with one matrix product over all scenarios.
+"""
+
+import collections
+import numpy as np
+import pandas as pd
+from library.timeseries import TimeSeries
+from library.drawdown import underwater
+
+HISTORICAL_SCENARIOS = collections.OrderedDict([
+    ('2008-09 Financial Crisis', ('2008-09-01', '2009-03-09')),
+    ('2011-08 Debt Ceiling', ('2011-07-22', '2011-10-03')),
+    ('2018-12 Selloff', ('2018-10-01', '2018-12-24')),
+    ('2020-03 Covid Crash', ('2020-02-19', '2020-03-23')),
+    ('2022 Rate Shock', ('2022-01-03', '2022-10-12'))])
+
+
+class ScenarioSet(object):
+    """Named historical windows replayed against portfolios. Prices come from the client's shared benchmark store,
+    so every window is downloaded once per client. Asset returns missing from a window (e.g. a name not yet
+    listed) are proxied by the asset's factor betas times the factor returns of that day."""
+    def __init__(self, source, factors, log=True):
+        self.source = source
+        self.factors = list(factors)
+        self.log = log
+        self.windows = collections.OrderedDict()
+        self._paths = {}
+
+    def add_scenario(self, name, start, end):
+        self.windows[name] = (start, end)
+        self._paths.pop(name, None)
+
+    def add_historical(self, names=None):
+        """Adds the preset windows in HISTORICAL_SCENARIOS, all of them or the given names"""
+        for name in (names or HISTORICAL_SCENARIOS):
+            self.add_scenario(name, *HISTORICAL_SCENARIOS[name])
+
+    def paths(self, name, symbols):
+        """(days x assets) asset returns, NaN where an asset has no history, and (days x factors) factor returns
+        over a scenario window, precomputed once per window and set of symbols and factors"""
+        symbols = tuple(symbols)
+        if self._paths.get(name, (None,))[0] != (symbols, tuple(self.factors)):
+            start, end = self.windows[name]
+            columns = list(symbols) + self.factors
+            closes = self.source.benchmarks.closes(list(dict.fromkeys(columns)), start, end)[columns]
+            closes = TimeSeries.from_frame(closes)
+            returns = (closes.log_returns() if self.log else closes.simple_returns()).values[1:]
+            if not len(returns):
+                raise ValueError("No prices in scenario window {} {}".format(name, self.windows[name]))
+            self._paths[name] = ((symbols, tuple(self.factors)), returns[:, :len(symbols)], returns[:, len(symbols):])
+        return self._paths[name][1:]
+
+    def run(self, symbols, weights, betas=None, names=None, values=None):
+        """Buy and hold replay of every scenario for every row of a (P x assets) weight matrix in one product.
+        betas, an (assets x factors) matrix or a function returning one, proxies missing asset history; a function
+        is only called if some scenario has history missing. values, one per row, turns the
+        P&L from a fraction of the starting value into money. Returns a dictionary of (portfolio x scenario)
+        DataFrames 'pnl' and 'max_drawdown'."""
+        weights = np.atleast_2d(np.asarray(weights, dtype=np.float64))
+        scenarios = list(self.windows)
+        asset_paths, lengths = [], []
+        for scenario in scenarios:
+            returns, factor_returns = self.paths(scenario, symbols)
+            missing = ~np.isfinite(returns)
+            if missing.any():
+                if betas is None:
+                    raise KeyError("No history for {} in {} and no betas to proxy it"
+                                   .format([s for s, m in zip(symbols, missing.any(axis=0)) if m], scenario))
+                if callable(betas):
+                    betas = betas()
+                returns = np.where(missing, np.nan_to_num(factor_returns) @ np.asarray(betas).T, returns)
+            asset_paths.append(returns if self.log else np.log1p(returns))
+            lengths.append(len(returns))
+        log_returns = np.concatenate(asset_paths)
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        cumulative = np.cumsum(log_returns, axis=0)
+        offsets = np.concatenate([np.zeros((1, log_returns.shape[1])), cumulative])[starts]
+        value = np.exp(cumulative - np.repeat(offsets, lengths, axis=0)) @ weights.T
+
+        pnl = value[ends - 1] - weights.sum(axis=1)
+        drawdown = np.empty_like(pnl)
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            path = np.vstack([weights.sum(axis=1), value[start:end]])
+            drawdown[i] = underwater(path).min(axis=0)
+        if values is not None:
+            pnl = pnl * np.asarray(values, dtype=np.float64) / weights.sum(axis=1)
+        names = list(range(len(weights))) if names is None else list(names)
+        return {'pnl': pd.DataFrame(pnl.T, index=names, columns=scenarios),
+                'max_drawdown': pd.DataFrame(drawdown.T, index=names, columns=scenarios)}
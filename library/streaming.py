@@ -0,0 +1,171 @@
+"""
+Running-state accumulators for updating portfolio metrics one bar at a time, without rebuilding the history.
+"""
+
+import numpy as np
+from scipy.stats import norm
+from library.risk import cornish_fisher_z, sample_skew_kurtosis
+
+
+class RunningMoments(object):
+    """Running mean and central moments up to the fourth for a vector of series (Welford/Terriberry updates).
+    NaN inputs are skipped per series. skew and kurtosis use the same bias corrections as pandas."""
+    def __init__(self, size):
+        self.n = np.zeros(size)
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size)
+        self.m3 = np.zeros(size)
+        self.m4 = np.zeros(size)
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        valid = np.isfinite(x)
+        n1 = self.n
+        n = n1 + valid
+        delta = np.where(valid, x - self.mean, 0.0)
+        delta_n = np.divide(delta, n, out=np.zeros_like(delta), where=n > 0)
+        delta_n2 = delta_n * delta_n
+        term1 = delta * delta_n * n1
+        self.m4 += term1 * delta_n2 * (n * n - 3 * n + 3) + 6 * delta_n2 * self.m2 - 4 * delta_n * self.m3
+        self.m3 += term1 * delta_n * (n - 2) - 3 * delta_n * self.m2
+        self.m2 += term1
+        self.mean += delta_n
+        self.n = n
+
+    def variance(self, ddof=1):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.n > ddof, self.m2 / (self.n - ddof), np.nan)
+
+    def std(self, ddof=1):
+        return np.sqrt(self.variance(ddof))
+
+    def skew(self):
+        return sample_skew_kurtosis(self.n, self.m2, self.m3, self.m4)[0]
+
+    def kurtosis(self):
+        """Excess kurtosis"""
+        return sample_skew_kurtosis(self.n, self.m2, self.m3, self.m4)[1]
+
+
+class RingBuffer(object):
+    """Fixed window of the last `window` observations of a vector with running sums for the rolling std.
+    Each update is O(size)."""
+    def __init__(self, window, size):
+        self.window = window
+        self.buffer = np.full((window, size), np.nan)
+        self.pos = 0
+        self.count = 0
+        self.total = np.zeros(size)
+        self.total_sq = np.zeros(size)
+        self.invalid = np.zeros(size)
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        if self.count == self.window:
+            old = self.buffer[self.pos]
+            old_valid = np.isfinite(old)
+            self.total -= np.where(old_valid, old, 0.0)
+            self.total_sq -= np.where(old_valid, old * old, 0.0)
+            self.invalid -= ~old_valid
+        else:
+            self.count += 1
+        valid = np.isfinite(x)
+        self.total += np.where(valid, x, 0.0)
+        self.total_sq += np.where(valid, x * x, 0.0)
+        self.invalid += ~valid
+        self.buffer[self.pos] = x
+        self.pos = (self.pos + 1) % self.window
+
+    def values(self):
+        """Window contents in insertion order"""
+        if self.count < self.window:
+            return self.buffer[:self.count]
+        return np.roll(self.buffer, -self.pos, axis=0)
+
+    def std(self, ddof=1):
+        """Rolling std, NaN until the window is full or while it holds a NaN, like pandas rolling"""
+        w = self.window
+        var = (self.total_sq - self.total * self.total / w) / (w - ddof)
+        std = np.sqrt(np.maximum(var, 0))
+        return np.where((self.count == w) & (self.invalid == 0), std, np.nan)
+
+
+class PortfolioStream(object):
+    """Incremental portfolio metrics. Each update takes the new closes in asset order and costs O(assets):
+    returns, rolling volatility, running skew/kurtosis, running peak and drawdown, parametric and Cornish-Fisher
+    VaR from the running moments, and historic VaR over the last var_window portfolio returns."""
+    def __init__(self, weights, shares, window=20, var_window=250, level=5, log=True, periods=252):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.shares = np.asarray(shares, dtype=np.float64)
+        self.level = level
+        self.log = log
+        self.periods = periods
+        size = len(self.weights)
+        self.last_close = None
+        self.last_date = None
+        self.asset_moments = RunningMoments(size)
+        self.portfolio_moments = RunningMoments(1)
+        self.asset_window = RingBuffer(window, size)
+        self.portfolio_window = RingBuffer(window, 1)
+        self.var_window = RingBuffer(var_window, 1)
+        self.peak = -np.inf
+        self.peak_date = None
+        self.max_drawdown = 0.0
+        self.trough_date = None
+        self.metrics = {}
+
+    def update(self, date, closes):
+        closes = np.asarray(closes, dtype=np.float64)
+        if self.last_close is None:
+            returns = np.full(len(closes), np.nan)
+        elif self.log:
+            returns = np.log(closes / self.last_close)
+        else:
+            returns = closes / self.last_close - 1
+        portfolio_return = returns @ self.weights
+        self.last_close = closes
+        self.last_date = date
+        self.asset_moments.update(returns)
+        self.portfolio_moments.update([portfolio_return])
+        self.asset_window.update(returns)
+        self.portfolio_window.update([portfolio_return])
+        if np.isfinite(portfolio_return):
+            self.var_window.update([portfolio_return])
+
+        value = closes @ self.shares
+        if value > self.peak:
+            self.peak, self.peak_date = value, date
+        drawdown = (value - self.peak) / self.peak
+        if drawdown < self.max_drawdown:
+            self.max_drawdown, self.trough_date = drawdown, date
+
+        annualize = np.sqrt(self.periods)
+        self.metrics = {'date': date,
+                        'asset_returns': returns,
+                        'portfolio_return': portfolio_return,
+                        'value': value,
+                        'asset_volatility': self.asset_window.std() * annualize,
+                        'portfolio_volatility': self.portfolio_window.std()[0] * annualize,
+                        'asset_skew': self.asset_moments.skew(),
+                        'asset_kurtosis': self.asset_moments.kurtosis(),
+                        'portfolio_skew': self.portfolio_moments.skew()[0],
+                        'portfolio_kurtosis': self.portfolio_moments.kurtosis()[0],
+                        'drawdown': drawdown,
+                        'max_drawdown': self.max_drawdown,
+                        'peak_date': self.peak_date,
+                        'trough_date': self.trough_date,
+                        'var_historic': self._var_historic(),
+                        'parametric_var': self._parametric_var(False),
+                        'modified_var': self._parametric_var(True)}
+        return self.metrics
+
+    def _var_historic(self):
+        window = self.var_window.values()[:, 0]
+        return -np.percentile(window, self.level) if len(window) else np.nan
+
+    def _parametric_var(self, modified):
+        """Same Gaussian / Cornish-Fisher formula as Portfolio.parametric_var on the running moments"""
+        z = norm.ppf(self.level / 100)
+        if modified:
+            z = cornish_fisher_z(z, self.portfolio_moments.skew()[0], self.portfolio_moments.kurtosis()[0])
+        return -(self.portfolio_moments.mean[0] + z * self.portfolio_moments.std()[0])
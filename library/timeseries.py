@@ -0,0 +1,94 @@
+"""
+Array-backed time-series core for portfolio metrics. Data is held as a contiguous float64 matrix in ascending time
+order so metrics run without reversing or copying the panel, and DataFrames are only built when handed back to callers.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class TimeSeries(object):
+    """(time x column) float64 matrix in ascending time order, with a shared datetime64 index and column labels.
+    A 1-D series is held as a single column matrix."""
+    def __init__(self, values, index, columns):
+        values = np.asarray(values, dtype=np.float64)
+        self.values = np.ascontiguousarray(values.reshape(len(values), -1))
+        self.index = np.asarray(index, dtype='datetime64[ns]')
+        self.columns = columns
+
+    @classmethod
+    def from_frame(cls, frame):
+        """Builds the core from a DataFrame in any time order"""
+        order = np.argsort(frame.index.values, kind='stable')
+        return cls(frame.values[order], frame.index.values[order], frame.columns)
+
+    @property
+    def symbols(self):
+        return list(self.columns.get_level_values(-1)) if isinstance(self.columns, pd.MultiIndex) else list(self.columns)
+
+    def log_returns(self, columns=None):
+        out = np.empty_like(self.values)
+        out[0] = np.nan
+        np.log(self.values[1:] / self.values[:-1], out=out[1:])
+        return TimeSeries(out, self.index, self.columns if columns is None else columns)
+
+    def simple_returns(self, columns=None):
+        out = np.empty_like(self.values)
+        out[0] = np.nan
+        np.divide(self.values[1:], self.values[:-1], out=out[1:])
+        out[1:] -= 1
+        return TimeSeries(out, self.index, self.columns if columns is None else columns)
+
+    def to_frame(self, values=None, columns=None, descending=True):
+        """DataFrame at the public edge. descending=True keeps the newest-first order the Portfolio API returns,
+        built on reversed views rather than copies."""
+        values = self.values if values is None else values
+        index = pd.DatetimeIndex(self.index, name='datetime')
+        if descending:
+            values, index = values[::-1], index[::-1]
+        return pd.DataFrame(values, index=index, columns=self.columns if columns is None else columns, copy=False)
+
+    def to_series(self, values, name=None, descending=True):
+        """Series at the public edge for a 1-D result aligned to the index"""
+        index = pd.DatetimeIndex(self.index, name='datetime')
+        if descending:
+            values, index = values[::-1], index[::-1]
+        return pd.Series(values, index=index, name=name, copy=False)
+
+
+def rolling_std(values, window, ddof=1):
+    """Rolling standard deviation along time (axis 0) from running sums, O(time x columns) for any window.
+    Windows containing a NaN are NaN, like pandas rolling with min_periods equal to the window."""
+    values = np.asarray(values, dtype=np.float64)
+    valid = np.isfinite(values)
+    x = np.where(valid, values, 0.0)
+    shape = (1,) + values.shape[1:]
+    s1 = np.concatenate([np.zeros(shape), np.cumsum(x, axis=0)])
+    s2 = np.concatenate([np.zeros(shape), np.cumsum(x * x, axis=0)])
+    n = np.concatenate([np.zeros(shape), np.cumsum(valid, axis=0)])
+    out = np.full(values.shape, np.nan)
+    if len(values) < window:
+        return out
+    w1 = s1[window:] - s1[:-window]
+    w2 = s2[window:] - s2[:-window]
+    count = n[window:] - n[:-window]
+    var = (w2 - w1 * w1 / window) / (window - ddof)
+    std = np.sqrt(np.maximum(var, 0))
+    std[count < window] = np.nan
+    out[window - 1:] = std
+    return out
+
+
+def window_sums(values, window):
+    """Sums over every trailing window of `window` rows along time, one row per window end, from one cumulative sum"""
+    values = np.asarray(values, dtype=np.float64)
+    total = np.concatenate([np.zeros((1,) + values.shape[1:]), np.cumsum(values, axis=0)])
+    return total[window:] - total[:-window]
+
+
+def nancumsum(values):
+    """Cumulative sum along time that skips NaN but keeps them in place, like pandas cumsum"""
+    values = np.asarray(values, dtype=np.float64)
+    out = np.nancumsum(values, axis=0)
+    out[np.isnan(values)] = np.nan
+    return out
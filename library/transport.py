@@ -0,0 +1,208 @@
+"""
+Offline transports for AMTD. Each one has the get_json/post_json interface of broker.HTTPSession and can be passed as
+the session of an AMTD client to record live responses to a cassette, replay them, or generate synthetic ones.
+"""
+
+import datetime
+import gzip
+import json
+import threading
+import time
+import urllib.parse
+import zlib
+import numpy as np
+
+
+def _key(method, url, params=None):
+    """Cassette key for a request. The api key is left out so cassettes can be shared."""
+    params = {k: str(v) for k, v in (params or {}).items() if k != 'apikey' and v is not None}
+    return "{} {}?{}".format(method, url, urllib.parse.urlencode(sorted(params.items())))
+
+
+def _redact_tokens(response):
+    """Copy of an OAuth token response with the credentials replaced, so cassettes can be shared"""
+    return dict(response, **{k: 'redacted' for k in ('access_token', 'refresh_token') if k in response})
+
+
+class RecordingTransport(object):
+    """Passes requests through to a live session and appends every response to a gzipped json lines cassette.
+    Access and refresh tokens in POST (OAuth) responses are recorded as placeholders."""
+    def __init__(self, session, path):
+        self.session = session
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _record(self, key, data):
+        line = json.dumps({'key': key, 'response': data}) + "\n"
+        with self._lock:
+            with gzip.open(self.path, 'at') as f:
+                f.write(line)
+
+    def get_json(self, url, params=None, headers=None):
+        data = self.session.get_json(url, params=params, headers=headers)
+        self._record(_key('GET', url, params), data)
+        return data
+
+    def post_json(self, url, headers=None, data=None):
+        response = self.session.post_json(url, headers=headers, data=data)
+        self._record(_key('POST', url), _redact_tokens(response))
+        return response
+
+
+class ReplayTransport(object):
+    """Answers requests from a cassette written by RecordingTransport, sleeping `latency` seconds per call.
+    Requests missing from the cassette go to `fallback` (e.g. a SyntheticTransport) or raise KeyError. Token
+    requests always get a fixed fake token, as cassettes hold no credentials."""
+    token = {'access_token': 'replay', 'refresh_token': 'replay', 'expires_in': 1800}
+
+    def __init__(self, path, latency=0, fallback=None):
+        self.latency = latency
+        self.fallback = fallback
+        self.responses = {}
+        with gzip.open(path, 'rt') as f:
+            for line in f:
+                entry = json.loads(line)
+                self.responses[entry['key']] = entry['response']
+
+    def _replay(self, key):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.responses[key]
+
+    def get_json(self, url, params=None, headers=None):
+        key = _key('GET', url, params)
+        if key not in self.responses and self.fallback is not None:
+            return self.fallback.get_json(url, params=params, headers=headers)
+        return self._replay(key)
+
+    def post_json(self, url, headers=None, data=None):
+        if self.latency:
+            time.sleep(self.latency)
+        return dict(self.token)
+
+
+class SyntheticTransport(object):
+    """Generates plausible responses for any symbol and date range without a network.
+    Daily prices follow a geometric random walk seeded by the symbol from a fixed epoch, so overlapping requests
+    agree with each other and repeated runs are identical."""
+    epoch = datetime.date(2000, 1, 3)
+    fundamentals = ['high52', 'low52', 'dividendAmount', 'dividendYield', 'peRatio', 'pegRatio', 'pbRatio',
+                    'prRatio', 'pcfRatio', 'grossMarginTTM', 'netProfitMarginTTM', 'operatingMarginTTM',
+                    'returnOnEquity', 'returnOnAssets', 'quickRatio', 'currentRatio', 'totalDebtToEquity', 'epsTTM',
+                    'marketCap', 'sharesOutstanding', 'beta', 'vol1DayAvg', 'vol10DayAvg', 'vol3MonthAvg']
+
+    def __init__(self, latency=0, seed=0, drift=0.0003, volatility=0.02):
+        self.latency = latency
+        self.seed = seed
+        self.drift = drift
+        self.volatility = volatility
+
+    def _rng(self, symbol):
+        return np.random.default_rng([self.seed, zlib.crc32(str(symbol).encode())])
+
+    def _closes(self, symbol, days):
+        """Close prices for the first `days` business days after the epoch"""
+        returns = self._rng(symbol).normal(self.drift, self.volatility, days)
+        return 100 * np.exp(np.cumsum(returns))
+
+    def _daily_candles(self, symbol, start, end):
+        """Business day candles in [start, end), stamped at midnight US/Eastern like the API"""
+        start = np.datetime64(max(start, self.epoch), 'D')
+        end = np.datetime64(max(end, self.epoch), 'D')
+        first = int(np.busday_count(np.datetime64(self.epoch, 'D'), start))
+        count = int(np.busday_count(start, end))
+        closes = self._closes(symbol, first + count + 1)
+        opens = closes[first:first + count]
+        closes = closes[first + 1:first + count + 1]
+        spread = np.abs(closes - opens) + opens * self.volatility / 2
+        dates = np.arange(start, end, dtype='datetime64[D]')
+        dates = dates[np.is_busday(dates)]
+        epoch_ms = (dates.astype('datetime64[ms]').astype(np.int64) + 5 * 3600 * 1000)
+        volume = 1000000 + (zlib.crc32(str(symbol).encode()) % 1000) * 1000
+        return [{'open': float(o), 'high': float(max(o, c) + s / 2), 'low': float(min(o, c) - s / 2),
+                 'close': float(c), 'volume': volume, 'datetime': int(t)}
+                for o, c, s, t in zip(opens, closes, spread, epoch_ms)]
+
+    def _intraday_candles(self, symbol, start_ms, end_ms, minutes):
+        """Bars every `minutes` during regular trading hours, priced off the daily walk with a fixed path per day"""
+        daily = self._daily_candles(symbol, self._ms_to_date(start_ms), self._ms_to_date(end_ms) +
+                                    datetime.timedelta(days=1))
+        candles = []
+        steps = int(390 / minutes)
+        for day in daily:
+            rng = np.random.default_rng([self.seed, zlib.crc32(str(symbol).encode()), day['datetime'] // 86400000])
+            open_ms = day['datetime'] + int(9.5 * 3600 * 1000)
+            path = np.linspace(day['open'], day['close'], steps + 1)
+            path[1:-1] *= np.exp(rng.normal(0, self.volatility / np.sqrt(steps), steps - 1))
+            for i in range(steps):
+                t = open_ms + i * minutes * 60 * 1000
+                if start_ms <= t < end_ms:
+                    o, c = float(path[i]), float(path[i + 1])
+                    candles.append({'open': o, 'high': max(o, c), 'low': min(o, c), 'close': c,
+                                    'volume': int(day['volume'] / steps), 'datetime': int(t)})
+        return candles
+
+    @staticmethod
+    def _ms_to_date(ms):
+        return datetime.datetime.fromtimestamp(int(ms) / 1000, tz=datetime.timezone.utc).date()
+
+    def _price_history(self, symbol, params):
+        if 'startDate' in params:
+            start_ms, end_ms = int(params['startDate']), int(params['endDate'])
+        else:
+            end_ms = int(time.time() * 1000)
+            period_days = {'year': 365, 'month': 30, 'day': 1, 'ytd': 365}[params.get('periodType', 'year')]
+            start_ms = end_ms - int(params.get('period', 1)) * period_days * 86400000
+        if params.get('frequencyType') == 'minute':
+            candles = self._intraday_candles(symbol, start_ms, end_ms, int(params.get('frequency', 30)))
+        else:
+            candles = self._daily_candles(symbol, self._ms_to_date(start_ms), self._ms_to_date(end_ms))
+        return {'candles': candles, 'symbol': symbol, 'empty': not candles}
+
+    def _quote(self, symbol):
+        today = datetime.date.today()
+        close = float(self._closes(symbol, int(np.busday_count(np.datetime64(self.epoch, 'D'),
+                                                               np.datetime64(today, 'D'))) + 1)[-1])
+        return {'assetType': 'EQUITY', 'symbol': symbol, 'description': symbol + ' synthetic',
+                'bidPrice': close * 0.999, 'askPrice': close * 1.001, 'lastPrice': close, 'openPrice': close,
+                'highPrice': close * 1.01, 'lowPrice': close * 0.99, 'closePrice': close, 'totalVolume': 1000000,
+                'quoteTimeInLong': int(time.time() * 1000)}
+
+    def _instrument(self, symbol):
+        values = self._rng(symbol).uniform(0.1, 50, len(self.fundamentals))
+        fundamental = dict(zip(self.fundamentals, (float(v) for v in values)))
+        fundamental['symbol'] = symbol
+        fundamental['dividendDate'] = ' '
+        fundamental['dividendPayDate'] = ' '
+        return {'fundamental': fundamental, 'cusip': '{:09d}'.format(zlib.crc32(symbol.encode()) % 10 ** 9),
+                'symbol': symbol, 'description': symbol + ' synthetic', 'exchange': 'NASDAQ', 'assetType': 'EQUITY'}
+
+    def _account(self, account):
+        balances = {'cashBalance': 10000.0, 'longMarketValue': 90000.0, 'liquidationValue': 100000.0}
+        positions = [{'shortQuantity': 0.0, 'averagePrice': 100.0, 'longQuantity': 10.0,
+                      'settledLongQuantity': 10.0, 'marketValue': float(self._quote(s)['closePrice']) * 10,
+                      'instrument': {'assetType': 'EQUITY', 'cusip': self._instrument(s)['cusip'], 'symbol': s}}
+                     for s in ['AAPL', 'WMT', 'SPY']]
+        return {'securitiesAccount': {'type': 'MARGIN', 'accountId': str(account), 'positions': positions,
+                                      'initialBalances': balances, 'currentBalances': balances,
+                                      'projectedBalances': balances}}
+
+    def get_json(self, url, params=None, headers=None):
+        if self.latency:
+            time.sleep(self.latency)
+        params = params or {}
+        path = urllib.parse.urlparse(url).path
+        if path.endswith('/pricehistory'):
+            return self._price_history(path.split('/')[-2], params)
+        if path.endswith('/quotes'):
+            return {s: self._quote(s) for s in str(params['symbol']).split(',')}
+        if path.endswith('/instruments'):
+            return {s: self._instrument(s) for s in str(params['symbol']).split(',')}
+        if '/accounts/' in path:
+            return self._account(path.split('/')[-1])
+        raise KeyError("No synthetic response for {}".format(url))
+
+    def post_json(self, url, headers=None, data=None):
+        if self.latency:
+            time.sleep(self.latency)
+        return {'access_token': 'synthetic', 'refresh_token': 'synthetic', 'expires_in': 1800}
@@ -0,0 +1,120 @@
+"""
+Treasury par yield curve provider used for risk free rates. The full history is loaded once per day and looked up by
+date and tenor, optionally persisted to a local csv or loaded from one for offline use.
+"""
+
+import datetime
+import os
+import threading
+import numpy as np
+import pandas as pd
+
+
+class YieldCurve(object):
+    """Daily treasury yield curve as a float table of decimal rates indexed by date with one column per tenor
+    ('1 mo', '3 mo', '1 yr', '10 yr', ...). Lookups for dates without a print (weekends, holidays) use the last
+    available curve."""
+    url = "https://www.treasury.gov/resource-center/data-chart-center/interest-rates/pages/textview.aspx?data=yieldAll"
+
+    def __init__(self, cache_path=None, csv_path=None):
+        self.cache_path = cache_path
+        self.csv_path = csv_path
+        self._table = None
+        self._daily = None
+        self._first = None
+        self._tenors = {}
+        self._loaded_on = None
+        self._lock = threading.Lock()
+
+    @property
+    def table(self):
+        """The curve table, reloaded at most once a day. If the treasury page cannot be read, the cache_path file
+        or the table already loaded is used, however old."""
+        with self._lock:
+            if self._table is None or (self.csv_path is None and self._loaded_on != datetime.date.today()):
+                self._set_table(self._load())
+            return self._table
+
+    def _load(self):
+        if self.csv_path is not None:
+            return self._read_csv(self.csv_path)
+        if self.cache_path is not None and os.path.exists(self.cache_path):
+            modified = datetime.date.fromtimestamp(os.path.getmtime(self.cache_path))
+            if modified == datetime.date.today():
+                return self._read_csv(self.cache_path)
+        try:
+            table = self._scrape()
+        except Exception:
+            # offline or the page moved: a stale curve beats none, the scrape is retried tomorrow
+            if self.cache_path is not None and os.path.exists(self.cache_path):
+                return self._read_csv(self.cache_path)
+            if self._table is not None:
+                return self._table
+            raise
+        if self.cache_path is not None:
+            (table * 100).to_csv(self.cache_path, index_label='Date')
+        return table
+
+    @staticmethod
+    def _read_csv(path):
+        table = pd.read_csv(path, index_col=0, parse_dates=True)
+        table.index.name = 'Date'
+        # csv files hold percent, as published by the treasury
+        return (table.astype(np.float64) / 100).sort_index()
+
+    def _scrape(self):
+        rfr = pd.read_html(self.url)[1]
+        rfr.columns = list(rfr.iloc[0].values)
+        rdf = rfr[1:].set_index('Date')
+        rdf.index = pd.to_datetime(rdf.index)
+        rdf = rdf.apply(pd.to_numeric, errors='coerce') / 100
+        return rdf.astype(np.float64).sort_index()
+
+    def _set_table(self, table):
+        """Keeps a forward filled calendar-day array next to the table so a lookup by date is a single index"""
+        self._table = table
+        self._first = table.index[0].normalize()
+        daily = table.reindex(pd.date_range(self._first, table.index[-1].normalize(), freq='D')).ffill()
+        self._daily = daily.values
+        self._tenors = {t: i for i, t in enumerate(table.columns)}
+        self._loaded_on = datetime.date.today()
+
+    def _positions(self, dates):
+        days = ((pd.DatetimeIndex(dates).normalize() - self._first).days).values
+        if (days < 0).any():
+            raise KeyError("No yield curve before {}".format(self._first.date()))
+        return np.minimum(days, len(self._daily) - 1)
+
+    def rate(self, date=None, tenor='1 yr'):
+        """Annual rate for a tenor in force on a date, the latest curve if no date is given"""
+        self.table  # loads or refreshes the curve
+        if date is None:
+            return float(self._daily[-1, self._tenors[tenor]])
+        return float(self._daily[self._positions([pd.Timestamp(date)])[0], self._tenors[tenor]])
+
+    def rates(self, dates, tenor='1 yr'):
+        """Series of the annual rate in force on each of the given dates"""
+        self.table  # loads or refreshes the curve
+        dates = pd.DatetimeIndex(dates)
+        return pd.Series(self._daily[self._positions(dates), self._tenors[tenor]], index=dates, name=tenor)
+
+    def rates_between(self, start, end, tenor='1 yr'):
+        """Series of the annual rate in force for every calendar day from start to end inclusive"""
+        return self.rates(pd.date_range(start, end, freq='D'), tenor)
+
+    def daily_rates(self, dates, tenor='1 yr', periods=252):
+        """Per period rate in force on each date, for netting against daily returns"""
+        return self.rates(dates, tenor) / periods
+
+
+_default_curve = None
+_default_curve_lock = threading.Lock()
+
+
+def default_curve():
+    """Returns the process-wide yield curve so the history is loaded once for every client"""
+    global _default_curve
+    with _default_curve_lock:
+        if _default_curve is None:
+            _default_curve = YieldCurve()
+        return _default_curve
@@ -2,7 +2,9 @@
 Script for uploading SP500 Fundamental Data to the Local DB.
 """
 
-from library import DBA as db, broker as td
+from library import DBA as db
+from library.broker import AMTD
+from config import apikey
 import pandas as pd
 import time
 import logging
@@ -25,26 +27,14 @@ logger.debug('Successfully queried SP500 ticks {}'.format(datetime.datetime.now(
 #data = td.get_fundamentals('AAPL')
 #db.create_postgres_table(data, "td_fundamentals") #need to edit dtypes after
 print('Beginning to Call TDA API')
-##start getting prices and upload to DB, 500 takes about 10 minutes - may take up to 40 or an hour for 2k
-success = []
-fail = []
-
-A = pd.DataFrame()
-for i in (all_ticks.symb):
-    time.sleep(1)           #max two api calls per second
-    try:
-        newdata =td.get_fundamentals(str(i))
-        A = pd.concat([A, newdata], axis = 0, sort =True)
-        success.append(str(i))
-    except:
-        print(str(i)+" failed.")
-        fail.append(str(i))
-        logger.debug('{} failed.'.format(str(i)))
-        pass
-    if (len(success) + len(fail)) % 100 == 0:
-        print((len(success) + len(fail)) / len(all_ticks.symb))
-    else:
-        continue
+##symbols are batched into a few instruments requests, 500 takes a few seconds
+td = AMTD(apikey)
+A = td.get_fundamentals_bulk([str(i) for i in all_ticks.symb])
+fail = [str(symbol) for symbol, error in td.failed_symbols]
+success = sorted(set(A.symbol))
+for symbol, error in td.failed_symbols:
+    print(str(symbol)+" failed.")
+    logger.debug('{} failed: {}'.format(str(symbol), error))
 logger.debug('Finished creating dataframe of fundamental data {}'.format(datetime.datetime.now()))
 logger.debug('Failed Ticks: {}'.format(str(len(fail))))
 logger.debug('Successful Ticks: {}'.format(str(len(success))))
@@ -0,0 +1,874 @@
+import unittest
+import asyncio
+import gzip
+import os
+import tempfile
+import time
+from unittest import mock
+import pandas as pd
+import requests
+import numpy as np
+from scipy.stats import norm
+from library.broker import AMTD, APIError, HTTPSession
+from library.portfolio import Portfolio, StressTest
+from library.pricecache import PriceCache
+from library.async_broker import AsyncAMTD, AiohttpTransport
+from library.quotes import QuoteSnapshot
+from library.yieldcurve import YieldCurve
+from library.transport import RecordingTransport, ReplayTransport, SyntheticTransport
+from library.timeseries import rolling_std, nancumsum
+from library.batch import PortfolioBatch
+from library.drawdown import drawdown_stats, rolling_max_drawdown
+from library.risk import rolling_risk
+from library.montecarlo import MonteCarloVaR
+from library.benchmarks import betas, rolling_betas
+from library.factors import factor_regression, rolling_factor_regression
+from library.scenarios import ScenarioSet
+from library.frontier import EfficientFrontier
+from library.blakefolio import portfolio as blakefolio
+
+
+class TestPriceCache(unittest.TestCase):
+    """Test gap detection and invalidation of the local price cache without hitting the API"""
+    def _candles(self, dates):
+        return {'candles': [{'open': 1.0, 'high': 2.0, 'low': 0.5, 'close': 1.5, 'volume': 100,
+                             'datetime': int(pd.Timestamp(d).timestamp() + 18000) * 1000} for d in dates],
+                'symbol': 'AAPL', 'empty': False}
+
+    def test_gaps(self):
+        cache = PriceCache(':memory:')
+        self.assertEqual(len(cache.missing_ranges('AAPL', '2020-01-01', '2020-02-01')), 1)
+        cache.store('AAPL', self._candles(['2020-01-02', '2020-01-03']), '2020-01-01', '2020-01-10')
+        gaps = cache.missing_ranges('AAPL', '2019-12-01', '2020-02-01')
+        self.assertEqual([(str(s), str(e)) for s, e in gaps],
+                         [('2019-12-01', '2020-01-01'), ('2020-01-10', '2020-02-01')])
+        self.assertEqual(cache.missing_ranges('AAPL', '2020-01-02', '2020-01-05'), [])
+        self.assertEqual(len(cache.load('AAPL', '2020-01-01', '2020-01-03')['candles']), 1)
+        self.assertEqual(cache.stats()['rows'], 2)
+
+    def test_invalidate(self):
+        cache = PriceCache(':memory:')
+        cache.store('AAPL', self._candles(['2020-01-02', '2020-01-03']), '2020-01-01', '2020-01-10')
+        cache.invalidate('AAPL', '2020-01-03', '2020-01-04')
+        gaps = cache.missing_ranges('AAPL', '2020-01-01', '2020-01-10')
+        self.assertEqual([(str(s), str(e)) for s, e in gaps], [('2020-01-03', '2020-01-04')])
+        cache.invalidate()
+        self.assertEqual(cache.stats()['rows'], 0)
+
+    def test_client_fetches_gaps(self):
+        transport = RangeTransport()
+        td = AMTD('key', session=transport)
+        td.set_cache(':memory:')
+        first = td.get_daily_price_timeframe('AAPL', '2020-02-01', '2020-03-01')
+        self.assertEqual(transport.ranges, [('2020-02-01', '2020-03-01')])
+        wider = td.get_daily_price_timeframe('AAPL', '2020-01-01', '2020-04-01')
+        self.assertEqual(transport.ranges[1:], [('2020-01-01', '2020-02-01'), ('2020-03-01', '2020-04-01')])
+        again = td.get_daily_price_timeframe('AAPL', '2020-01-15', '2020-03-15')
+        self.assertEqual(len(transport.ranges), 3)
+        uncached = AMTD('key', session=SyntheticTransport())
+        self.assertTrue(wider.equals(uncached.get_daily_price_timeframe('AAPL', '2020-01-01', '2020-04-01')))
+        self.assertTrue(first.equals(wider.loc[first.index]))
+        self.assertTrue(again.equals(wider.loc[again.index]))
+
+
+class RangeTransport(SyntheticTransport):
+    """Synthetic transport that records the date range of every price history request"""
+    def __init__(self):
+        super().__init__()
+        self.ranges = []
+
+    def get_json(self, url, params=None, headers=None):
+        if 'startDate' in (params or {}):
+            self.ranges.append(tuple(str(pd.to_datetime(int(params[k]) - 18000000, unit='ms').date())
+                                     for k in ('startDate', 'endDate')))
+        return super().get_json(url, params=params, headers=headers)
+
+
+class StubTransport(object):
+    """Answers every price history request with the same two candles"""
+    def __init__(self):
+        self.calls = []
+
+    async def get_json(self, url, params=None, headers=None):
+        self.calls.append(url)
+        if 'BAD' in url:
+            return {'error': 'not found'}
+        return {'candles': [{'open': 1.0, 'high': 2.0, 'low': 0.5, 'close': 1.5, 'volume': 100,
+                             'datetime': 1577959200000},
+                            {'open': 1.5, 'high': 2.5, 'low': 1.0, 'close': 2.0, 'volume': 200,
+                             'datetime': 1578045600000}],
+                'empty': False}
+
+    async def close(self):
+        pass
+
+
+class TestAsyncAMTD(unittest.TestCase):
+    """Test the asyncio client against a stub transport"""
+    def test_ohlcv_array(self):
+        transport = StubTransport()
+        td = AsyncAMTD('key', transport=transport)
+        prices = asyncio.run(td.get_ohlcv_array('2020-01-01', '2020-01-05', ['AAPL', 'BAD', 'WMT']))
+        self.assertEqual(len(transport.calls), 3)
+        self.assertEqual(prices.shape, (2, 10))
+        self.assertEqual([s for s, e in prices.attrs['failed_symbols']], ['BAD'])
+
+    def test_matches_sync_client(self):
+        td = AsyncAMTD('key', transport=AsyncSyntheticTransport())
+        sync = AMTD('key', session=SyntheticTransport())
+        self.assertFalse(hasattr(td, 'quotes') or hasattr(td, 'get_risk_free_rate'))
+        fundamentals = asyncio.run(td.get_fundamentals_bulk(['AAPL', 'WMT', 'TSLA'], batch_size=2))
+        expected = sync.get_fundamentals_bulk(['AAPL', 'WMT', 'TSLA'], batch_size=2)
+        self.assertTrue(fundamentals.drop(columns='update_ts').equals(expected.drop(columns='update_ts')))
+        hist = asyncio.run(td.get_daily_price_hist('AAPL', 'daily', 1, 'year', 1))
+        self.assertEqual(hist.shape, sync.get_daily_price_hist('AAPL', 'daily', 1, 'year', 1).shape)
+
+        async def collect():
+            return [chunk async for chunk in td.iter_30min_price_timeframe(['AAPL', 'WMT'], '2020-01-06',
+                                                                           '2020-01-20', window_days=5)]
+        chunks = asyncio.run(collect())
+        expected = list(sync.iter_30min_price_timeframe(['AAPL', 'WMT'], '2020-01-06', '2020-01-20', window_days=5))
+        self.assertEqual(len(chunks), 3)
+        for chunk, other in zip(chunks, expected):
+            self.assertTrue(chunk.prices.equals(other.prices))
+            self.assertEqual(chunk.cursor, other.cursor)
+
+    def test_transport_retries(self):
+        transport = AiohttpTransport(backoff=0)
+        transport._session = FakeClientSession([(429, None), (503, None), (200, {'ok': 1}), (404, None)])
+        self.assertEqual(asyncio.run(transport.get_json('https://api/x')), {'ok': 1})
+        self.assertEqual(transport._session.calls, 3)
+        with self.assertRaises(APIError):
+            asyncio.run(transport.get_json('https://api/x'))
+
+
+class AsyncSyntheticTransport(object):
+    """Awaitable wrapper of SyntheticTransport"""
+    def __init__(self):
+        self.synthetic = SyntheticTransport()
+
+    async def get_json(self, url, params=None, headers=None):
+        return self.synthetic.get_json(url, params=params, headers=headers)
+
+    async def post_json(self, url, headers=None, data=None):
+        return self.synthetic.post_json(url, headers=headers, data=data)
+
+    async def close(self):
+        pass
+
+
+class FakeResponse(object):
+    """Stands in for an aiohttp response"""
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+        self.headers = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    async def json(self, content_type=None):
+        return self.body
+
+    async def text(self):
+        return 'error'
+
+
+class FakeClientSession(object):
+    """Stands in for an aiohttp ClientSession, answering with the given (status, body) pairs in order"""
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def request(self, method, url, **kwargs):
+        self.calls += 1
+        return FakeResponse(*self.responses.pop(0))
+
+
+class ScriptedResponse(object):
+    """Stands in for a requests response"""
+    def __init__(self, status_code, body=b'{}', headers=None):
+        self.status_code = status_code
+        self.content = body
+        self.text = body.decode()
+        self.headers = headers or {}
+
+
+class ScriptedSession(object):
+    """Stands in for a requests.Session, answering with the given responses (or raising the given exceptions) in
+    order and recording the requests"""
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url, kwargs))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class TestHTTPSession(unittest.TestCase):
+    """Test retries, backoff and token handling of the shared session against scripted responses"""
+    def _session(self, responses, **kwargs):
+        session = HTTPSession(**kwargs)
+        session.session = ScriptedSession(responses)
+        return session
+
+    def test_retry_after_and_backoff(self):
+        session = self._session([ScriptedResponse(429, headers={'Retry-After': '3'}), ScriptedResponse(503),
+                                 requests.ConnectionError(), ScriptedResponse(200, b'{"ok": 1}')], backoff=0.5)
+        with mock.patch('library.broker.time.sleep') as sleep:
+            self.assertEqual(session.get_json('https://api/x', params={'a': 1}), {'ok': 1})
+        delays = [c.args[0] for c in sleep.call_args_list]
+        self.assertEqual(len(session.session.calls), 4)
+        self.assertEqual(delays[0], 3.0)
+        self.assertTrue(0 <= delays[1] <= 1.0 and 0 <= delays[2] <= 2.0)
+        self.assertEqual(session.session.calls[0][2]['timeout'], session.timeout)
+
+    def test_gives_up(self):
+        session = self._session([ScriptedResponse(502, b'bad gateway')] * 3, max_retries=2)
+        with mock.patch('library.broker.time.sleep') as sleep:
+            with self.assertRaises(APIError) as raised:
+                session.get_json('https://api/x')
+        self.assertEqual(raised.exception.status, 502)
+        self.assertEqual((len(session.session.calls), sleep.call_count), (3, 2))
+        session = self._session([ScriptedResponse(404, b'missing')])
+        with mock.patch('library.broker.time.sleep') as sleep:
+            with self.assertRaisesRegex(APIError, '404'):
+                session.get_json('https://api/x')
+        self.assertEqual(sleep.call_count, 0)
+
+    def test_token_refresh(self):
+        token = b'{"access_token": "%s", "expires_in": 1800}'
+        session = self._session([ScriptedResponse(200, token % b'first'), ScriptedResponse(200, token % b'second'),
+                                 ScriptedResponse(200, b'{"id": 1}'), ScriptedResponse(401, b'expired'),
+                                 ScriptedResponse(200, token % b'third'), ScriptedResponse(200, b'{"id": 2}')])
+        td = AMTD('key', session=session)
+        td.generate_access_token('refresh')
+        self.assertEqual(td._auth_headers(), {'Authorization': 'Bearer first'})
+        td._access_tkn_expiry = time.monotonic() - 1
+        self.assertEqual(td._get_account_info_raw('123'), {'id': 1})
+        self.assertEqual(td._get_account_info_raw('123'), {'id': 2})
+        calls = session.session.calls
+        self.assertEqual([method for method, url, kwargs in calls], ['POST', 'POST', 'GET', 'GET', 'POST', 'GET'])
+        self.assertEqual([calls[i][2]['headers']['Authorization'] for i in (2, 3, 5)],
+                         ['Bearer second', 'Bearer second', 'Bearer third'])
+        session.session = ScriptedSession([ScriptedResponse(401, b'expired'), ScriptedResponse(200, token % b'fourth'),
+                                           ScriptedResponse(401, b'still expired')])
+        with self.assertRaisesRegex(APIError, '401'):
+            td._get_account_info_raw('123')
+        self.assertEqual(len(session.session.calls), 3)
+
+
+class StubQuoteSource(object):
+    """Returns a quote for every requested symbol and counts the calls"""
+    def __init__(self):
+        self.calls = []
+
+    def _get_quotes_raw(self, symbol_list):
+        self.calls.append(list(symbol_list))
+        return {s: {'symbol': s, 'closePrice': 10.0} for s in symbol_list}
+
+
+class TestQuoteSnapshot(unittest.TestCase):
+    """Test batching and caching of quotes"""
+    def test_batching(self):
+        source = StubQuoteSource()
+        quotes = QuoteSnapshot(source, ttl=60, chunk_size=2)
+        prices = quotes.get_prices(['AAPL', 'WMT', 'TSLA'])
+        self.assertEqual(prices, {'AAPL': 10.0, 'WMT': 10.0, 'TSLA': 10.0})
+        self.assertEqual(source.calls, [['AAPL', 'WMT'], ['TSLA']])
+        quotes.get_prices(['WMT', 'UBER'])
+        self.assertEqual(source.calls[-1], ['UBER'])
+        self.assertEqual(len(source.calls), 3)
+
+
+class TestYieldCurve(unittest.TestCase):
+    """Test dated lookups on an offline yield curve"""
+    def test_offline_curve(self):
+        path = os.path.join(tempfile.mkdtemp(), 'curve.csv')
+        pd.DataFrame({'1 mo': [1.0, 2.0], '1 yr': [1.5, 2.5]},
+                     index=pd.to_datetime(['2020-01-02', '2020-01-06'])).to_csv(path)
+        curve = YieldCurve(csv_path=path)
+        self.assertAlmostEqual(curve.rate(), 0.025)
+        self.assertAlmostEqual(curve.rate('2020-01-04', '1 mo'), 0.01)
+        rates = curve.rates(['2020-01-02', '2020-01-05', '2020-01-06', '2020-02-01'])
+        self.assertEqual(list(rates.round(4)), [0.015, 0.015, 0.025, 0.025])
+        with self.assertRaises(KeyError):
+            curve.rate('2019-12-31')
+
+    def test_stale_cache_offline(self):
+        path = os.path.join(tempfile.mkdtemp(), 'curve.csv')
+        pd.DataFrame({'1 yr': [1.5, 2.5]}, index=pd.to_datetime(['2020-01-02', '2020-01-06'])).to_csv(path)
+        yesterday = time.time() - 2 * 86400
+        os.utime(path, (yesterday, yesterday))
+        curve = OfflineYieldCurve(cache_path=path)
+        self.assertAlmostEqual(curve.rate('2020-01-03'), 0.015)
+        with self.assertRaises(OSError):
+            OfflineYieldCurve(cache_path=path + '.missing').rate()
+
+
+class OfflineYieldCurve(YieldCurve):
+    """Yield curve on a box that cannot reach the treasury site"""
+    def _scrape(self):
+        raise OSError("Network is unreachable")
+
+
+class TestOfflineTransports(unittest.TestCase):
+    """Test synthetic responses and record/replay through the AMTD client"""
+    def test_synthetic(self):
+        td = AMTD('key', session=SyntheticTransport())
+        prices = td.get_daily_price_timeframe('AAPL', '2020-01-06', '2020-01-13')
+        self.assertEqual(prices.shape, (5, 5))
+        overlap = td.get_daily_price_timeframe('AAPL', '2020-01-08', '2020-01-10')
+        self.assertEqual(list(overlap['close']['AAPL']), list(prices['close']['AAPL'][2:4]))
+        self.assertEqual(td.get_fundamentals('WMT').shape[1], 6)
+
+    def test_fundamentals_bulk(self):
+        td = AMTD('key', session=SyntheticTransport())
+        fundamentals = td.get_fundamentals_bulk(['AAPL', 'WMT', 'TSLA'], batch_size=2)
+        self.assertEqual(sorted(set(fundamentals.symbol)), ['AAPL', 'TSLA', 'WMT'])
+        self.assertEqual(len(fundamentals), 3 * len(SyntheticTransport.fundamentals))
+        self.assertEqual(fundamentals.value.dtype, float)
+        self.assertEqual(fundamentals.attrs['failed_symbols'], [])
+
+    def test_intraday_chunks(self):
+        td = AMTD('key', session=SyntheticTransport())
+        chunks = list(td.iter_30min_price_timeframe(['AAPL', 'WMT'], '2020-01-06', '2020-01-20', window_days=5))
+        self.assertEqual(len(chunks), 3)
+        bars = pd.concat([c.prices for c in chunks])
+        self.assertEqual(bars.shape, (130, 10))
+        self.assertTrue(bars.index.is_monotonic_increasing)
+        resumed = list(td.iter_30min_price_timeframe(['AAPL', 'WMT'], chunks[0].cursor, '2020-01-20', window_days=5))
+        self.assertTrue(pd.concat([c.prices for c in resumed]).equals(bars.iloc[len(chunks[0].prices):]))
+
+    def test_record_replay(self):
+        path = os.path.join(tempfile.mkdtemp(), 'cassette.jsonl.gz')
+        live = AMTD('key', session=RecordingTransport(SyntheticTransport(seed=1), path))
+        recorded = live.get_daily_price_timeframe('TSLA', '2020-01-01', '2020-02-01')
+        replay = AMTD('other', session=ReplayTransport(path))
+        replayed = replay.get_daily_price_timeframe('TSLA', '2020-01-01', '2020-02-01')
+        self.assertTrue(recorded.equals(replayed))
+        with self.assertRaises(KeyError):
+            replay.get_daily_price_timeframe('TSLA', '2020-01-01', '2020-03-01')
+
+    def test_cassette_has_no_tokens(self):
+        path = os.path.join(tempfile.mkdtemp(), 'cassette.jsonl.gz')
+        live = AMTD('key', session=RecordingTransport(SecretTokenTransport(), path))
+        live.generate_access_token('refresh-secret')
+        recorded = live.get_account_info('123')
+        with gzip.open(path, 'rt') as f:
+            cassette = f.read()
+        self.assertIn('accounts/123', cassette)
+        self.assertNotIn('access-secret', cassette)
+        self.assertNotIn('refresh-secret', cassette)
+        replay = AMTD('key', session=ReplayTransport(path))
+        replay.generate_access_token('anything')
+        self.assertEqual(replay._access_tkn, 'replay')
+        self.assertTrue(replay.get_account_info('123')[3].equals(recorded[3]))
+
+
+class SecretTokenTransport(SyntheticTransport):
+    """Synthetic transport that hands out credentials which must not reach a cassette"""
+    def post_json(self, url, headers=None, data=None):
+        return {'access_token': 'access-secret', 'refresh_token': 'refresh-secret', 'expires_in': 1800}
+
+
+class TestTimeSeriesCore(unittest.TestCase):
+    """Test the ascending array core against the pandas calculations it replaced, on synthetic data"""
+    def setUp(self):
+        self.td = AMTD('key', session=SyntheticTransport())
+        self.my_portfolio = Portfolio({'AAPL': 10, 'WMT': 20})
+        self.my_portfolio.calculate_alloc_from_shares()
+        self.my_portfolio.set_source(self.td)
+        self.my_portfolio.get_historical_portfolio_value('2020-01-01', '2020-06-01')
+
+    def test_returns_match_pandas(self):
+        close = self.my_portfolio.portfolio_ohlcv.close
+        expected = np.log(close / close.shift(-1))
+        self.assertTrue(np.allclose(self.my_portfolio.asset_returns.values, expected.values, equal_nan=True))
+        self.assertTrue(self.my_portfolio.asset_returns.index.equals(expected.index))
+
+    def test_rolling_and_cumulative(self):
+        returns = self.my_portfolio.asset_returns
+        vol = self.my_portfolio.get_asset_volatility(window=20, annualized=False)
+        expected = returns[::-1].rolling(20).std()[::-1]
+        self.assertTrue(np.allclose(vol.values, expected.values, equal_nan=True))
+        cumm = self.my_portfolio.cumm_portfolio_returns()
+        expected = self.my_portfolio.portfolio_returns[::-1].cumsum()[::-1]
+        self.assertTrue(np.allclose(cumm.values, expected.values, equal_nan=True))
+        self.assertTrue(np.isnan(rolling_std(np.ones(5), 10)).all())
+        self.assertTrue(np.isnan(nancumsum(np.array([np.nan, 1.0]))[0]))
+
+    def test_streaming_matches_batch(self):
+        metrics = self.my_portfolio.start_streaming(window=20)
+        self.assertAlmostEqual(metrics['portfolio_skew'], self.my_portfolio.portfolio_skew())
+        self.assertAlmostEqual(metrics['portfolio_kurtosis'], self.my_portfolio.portfolio_kurtosis())
+        self.assertAlmostEqual(metrics['portfolio_volatility'], self.my_portfolio.get_portfolio_volatility().iloc[0])
+        self.assertAlmostEqual(metrics['modified_var'], self.my_portfolio.parametric_var(modified=True))
+        self.assertTrue(np.allclose(metrics['asset_skew'], self.my_portfolio.asset_skew().values))
+        last = self.my_portfolio.portfolio_ohlcv.close.iloc[0]
+        metrics = self.my_portfolio.append_bar('2020-06-02', {'AAPL': last['AAPL'] * 1.01, 'WMT': last['WMT']})
+        self.assertAlmostEqual(metrics['asset_returns'][0], np.log(1.01))
+        self.assertLessEqual(metrics['max_drawdown'], 0)
+
+    def test_streaming_follows_return_type(self):
+        self.my_portfolio.get_historical_asset_returns(log=False)
+        metrics = self.my_portfolio.start_streaming(window=20)
+        self.assertAlmostEqual(metrics['portfolio_skew'], self.my_portfolio.portfolio_skew())
+        last = self.my_portfolio.portfolio_ohlcv.close.iloc[0]
+        metrics = self.my_portfolio.append_bar('2020-06-02', {'AAPL': last['AAPL'] * 1.01, 'WMT': last['WMT']})
+        self.assertAlmostEqual(metrics['asset_returns'][0], 0.01)
+        metrics = self.my_portfolio.start_streaming(window=20, log=True)
+        self.assertNotAlmostEqual(metrics['portfolio_skew'], self.my_portfolio.portfolio_skew())
+
+    def test_batch_matches_portfolio(self):
+        weights = [list(self.my_portfolio.asset_alloc.values()), [0.5, 0.5], [1.0, 0.0]]
+        batch = PortfolioBatch.from_portfolio(self.my_portfolio, weights)
+        self.assertAlmostEqual(batch.var_historic()[0], self.my_portfolio.var_historic())
+        self.assertAlmostEqual(batch.cvar_historic()[0], self.my_portfolio.cvar_historic())
+        self.assertAlmostEqual(batch.parametric_var(modified=True)[0], self.my_portfolio.parametric_var(modified=True))
+        self.assertAlmostEqual(batch.skew()[0], self.my_portfolio.portfolio_skew())
+        self.assertAlmostEqual(batch.kurtosis()[0], self.my_portfolio.portfolio_kurtosis())
+        self.assertEqual(batch.summary().shape, (3, 10))
+
+
+class CountingTransport(SyntheticTransport):
+    """Synthetic transport that counts requests"""
+    calls = 0
+
+    def get_json(self, url, params=None, headers=None):
+        self.calls += 1
+        return super().get_json(url, params=params, headers=headers)
+
+
+class FailingTransport(SyntheticTransport):
+    """Synthetic transport with no price history for symbols starting with BAD"""
+    def get_json(self, url, params=None, headers=None):
+        if '/BAD' in url:
+            return {'error': 'not found'}
+        return super().get_json(url, params=params, headers=headers)
+
+
+class LateListingTransport(SyntheticTransport):
+    """Synthetic transport where NEW starts trading 20 bars into January 2020"""
+    def _daily_candles(self, symbol, start, end):
+        candles = super()._daily_candles(symbol, start, end)
+        if symbol == 'NEW':
+            listed = pd.Timestamp('2020-01-30').value // 10 ** 6
+            candles = [c for c in candles if c['datetime'] >= listed]
+        return candles
+
+
+class TestLazyPortfolio(unittest.TestCase):
+    """Test that repeated metric calls are served from the dependency cache"""
+    def test_reuse_and_invalidation(self):
+        transport = CountingTransport()
+        my_portfolio = Portfolio({'AAPL': 10, 'WMT': 20})
+        my_portfolio.calculate_alloc_from_shares()
+        my_portfolio.set_source(AMTD('key', session=transport))
+        my_portfolio.get_historical_portfolio_value('2020-01-01', '2020-03-01')
+        self.assertEqual(transport.calls, 2)
+        var = my_portfolio.var_historic()
+        my_portfolio.get_historical_portfolio_returns('2020-01-01', '2020-03-01')
+        self.assertEqual(transport.calls, 2)
+        asset_returns = my_portfolio.asset_returns
+        my_portfolio.asset_alloc = {'AAPL': 0.9, 'WMT': 0.1}
+        self.assertNotEqual(my_portfolio.var_historic(), var)
+        self.assertIs(my_portfolio.asset_returns, asset_returns)
+        self.assertEqual(transport.calls, 2)
+        my_portfolio.invalidate('ohlcv')
+        my_portfolio.get_historical_portfolio_returns()
+        self.assertEqual(transport.calls, 4)
+
+    def test_failed_symbols(self):
+        td = AMTD('key', session=FailingTransport())
+        my_portfolio = Portfolio({'AAPL': 10, 'BAD': 20})
+        my_portfolio.calculate_alloc_from_shares()
+        my_portfolio.set_source(td)
+        with self.assertRaisesRegex(KeyError, 'BAD'):
+            my_portfolio.get_historical_portfolio_value('2020-01-01', '2020-03-01')
+        my_portfolio = Portfolio({'BAD1': 10, 'BAD2': 20})
+        my_portfolio.calculate_alloc_from_shares()
+        my_portfolio.set_source(td)
+        with self.assertRaisesRegex(KeyError, 'BAD1.*BAD2'):
+            my_portfolio.get_historical_portfolio_returns('2020-01-01', '2020-03-01')
+        failing = td.get_ohlcv_array('2020-01-01', '2020-03-01', ['AAPL', 'BAD'])
+        clean = td.get_ohlcv_array('2020-01-01', '2020-03-01', ['AAPL'], 'close')
+        self.assertEqual([s for s, e in failing.attrs['failed_symbols']], ['BAD'])
+        self.assertEqual(clean.attrs['failed_symbols'], [])
+
+
+class TestDrawdown(unittest.TestCase):
+    """Test the running peak drawdown engine on known paths"""
+    def test_drawdown_stats(self):
+        values = np.array([[1, 10], [2, 9], [1, 8], [1.5, 9], [2.5, 7], [2, 6]])
+        stats = drawdown_stats(values)
+        self.assertEqual(list(stats['max_drawdown']), [-0.5, -0.4])
+        self.assertEqual(list(stats['peak']), [1, 0])
+        self.assertEqual(list(stats['trough']), [2, 5])
+        self.assertEqual(list(stats['recovery']), [4, -1])
+        self.assertEqual(list(stats['drawdown_duration']), [3, 5])
+        rolling = rolling_max_drawdown(values, 3)
+        self.assertTrue(np.isnan(rolling[1]).all())
+        self.assertTrue(np.allclose(rolling[2], [-0.5, -0.2]))
+
+    def test_missing_values(self):
+        values = np.array([[np.nan, 10], [np.nan, 9], [2, 8], [1, np.nan], [1.5, 9], [2.5, 7]])
+        stats = drawdown_stats(values)
+        self.assertTrue(np.allclose(stats['max_drawdown'], [-0.5, -0.3]))
+        self.assertEqual(list(stats['peak']), [2, 0])
+        self.assertEqual(list(stats['trough']), [3, 5])
+        self.assertEqual(list(stats['recovery']), [5, -1])
+        self.assertTrue(np.allclose(rolling_max_drawdown(values, 2)[[1, 3], 0], [np.nan, -0.5], equal_nan=True))
+
+    def test_portfolio_late_listing(self):
+        my_portfolio = Portfolio({'AAPL': 10, 'NEW': 20})
+        my_portfolio.calculate_alloc_from_shares()
+        my_portfolio.set_source(AMTD('key', session=LateListingTransport()))
+        value = my_portfolio.get_historical_portfolio_value('2020-01-01', '2020-06-01').sum(axis=1)[::-1]
+        self.assertTrue(np.isnan(my_portfolio.historical_value.iloc[-1, 1]))
+        max_drawdown, peak, trough = my_portfolio.max_drawdown()
+        drawdown = value / value.cummax() - 1
+        self.assertAlmostEqual(max_drawdown, drawdown.min())
+        self.assertEqual(trough, drawdown.idxmin())
+        self.assertTrue(np.isfinite(my_portfolio.fin_metrics().metrics['Max Drawdown']))
+
+    def test_batch_array_positions(self):
+        values = np.array([[1, 10], [2, 9], [1, 8], [1.5, 9], [2.5, 7], [2, 6]])
+        batch = PortfolioBatch(np.log(values[1:] / values[:-1]), np.eye(2))
+        self.assertIsNone(batch.index)
+        stats = batch.drawdowns()
+        self.assertTrue(np.allclose(stats['max_drawdown'], [-0.5, -1 / 3]))
+        self.assertEqual(list(stats['peak']), [0, 0])
+        self.assertEqual(list(stats['trough']), [1, 4])
+        self.assertEqual(list(stats['recovery']), [3, -1])
+        self.assertEqual(list(batch.rolling_risk(window=3)['end']), [2, 3, 4])
+
+
+class TestRiskEngine(unittest.TestCase):
+    """Test the multi-level rolling VaR engine against per-window numpy and pandas calculations"""
+    def test_rolling_risk(self):
+        returns = np.random.default_rng(0).standard_t(4, size=(300, 2)) * 0.01
+        returns[50, 1] = np.nan
+        risk = rolling_risk(returns, (1, 5), window=100, step=10)
+        self.assertEqual(risk['var_historic'].shape, (21, 2, 2))
+        self.assertTrue(np.isnan(risk['modified_var'][0, :, 1]).all())
+        window = pd.Series(returns[200:300, 0])
+        var = -np.percentile(window, 5)
+        self.assertAlmostEqual(risk['var_historic'][-1, 1, 0], var)
+        self.assertAlmostEqual(risk['cvar_historic'][-1, 1, 0], -window[window <= -var].mean())
+        self.assertAlmostEqual(risk['parametric_var'][-1, 1, 0], -(window.mean() + norm.ppf(0.05) * window.std()))
+
+    def test_portfolio_report(self):
+        my_portfolio = Portfolio({'AAPL': 10, 'WMT': 20})
+        my_portfolio.calculate_alloc_from_shares()
+        my_portfolio.set_source(AMTD('key', session=SyntheticTransport()))
+        my_portfolio.get_historical_portfolio_returns('2020-01-01', '2020-12-31')
+        report = my_portfolio.risk_report(levels=(1, 5), window=100)
+        self.assertEqual(report.shape[1], 8)
+        self.assertTrue(report.index.is_monotonic_decreasing)
+        full = my_portfolio.risk_report(levels=(5,), window=None)
+        self.assertAlmostEqual(full['var_historic', 5].iloc[0], my_portfolio.var_historic())
+        self.assertAlmostEqual(full['cvar_historic', 5].iloc[0], my_portfolio.cvar_historic())
+        self.assertAlmostEqual(full['modified_var', 5].iloc[0], my_portfolio.parametric_var(modified=True))
+
+
+class TestMonteCarloVaR(unittest.TestCase):
+    """Test the Monte Carlo simulator against closed forms and for seed reproducibility"""
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.returns = rng.multivariate_normal([0.001, 0.0], [[1e-4, 5e-5], [5e-5, 4e-4]], size=2000)
+
+    def test_chunks_and_workers_reproducible(self):
+        model = MonteCarloVaR(self.returns, [0.5, 0.5], horizon=5, innovations='t')
+        serial = model.simulate(20000, seed=7, chunk_size=3000)
+        pooled = model.simulate(20000, seed=7, chunk_size=3000, workers=2)
+        self.assertTrue(np.array_equal(serial, pooled))
+        self.assertEqual(len(serial), 20000)
+
+    def test_normal_matches_closed_form(self):
+        model = MonteCarloVaR(self.returns, [0.5, 0.5], innovations='normal', log=False)
+        table = model.var(levels=(5,), paths=200000, seed=1)
+        w = np.array([0.5, 0.5])
+        expected = -(model.mean @ w + norm.ppf(0.05) * np.sqrt(w @ model.cov @ w))
+        self.assertAlmostEqual(table.loc[5, 'VaR'], expected, places=4)
+        self.assertLess(table.loc[5, 'VaR Lower'], table.loc[5, 'VaR'])
+        self.assertGreater(table.loc[5, 'CVaR Upper'], table.loc[5, 'CVaR'])
+        bootstrap = MonteCarloVaR(self.returns, w, innovations='bootstrap').simulate(1000, seed=2)
+        self.assertTrue(np.isfinite(bootstrap).all())
+        with self.assertRaises(ValueError):
+            MonteCarloVaR(self.returns, w, innovations='t', dof=2)
+
+
+class TestBenchmarks(unittest.TestCase):
+    """Test the shared benchmark store and the one pass betas"""
+    def test_betas_match_pandas(self):
+        rng = np.random.default_rng(0)
+        frame = pd.DataFrame(rng.normal(0, 0.01, size=(200, 4)), columns=['A', 'B', 'SPY', 'QQQ'])
+        frame.iloc[3, 0] = np.nan
+        beta = betas(frame[['A', 'B']].values, frame[['SPY', 'QQQ']].values)
+        for i, asset in enumerate(['A', 'B']):
+            for j, benchmark in enumerate(['SPY', 'QQQ']):
+                pair = frame[[asset, benchmark]].dropna()
+                self.assertAlmostEqual(beta[i, j], pair.cov().iloc[0, 1] / pair[benchmark].var())
+
+    def test_shared_downloads(self):
+        transport = CountingTransport()
+        td = AMTD('key', session=transport)
+        portfolios = []
+        for assets in ({'AAPL': 10, 'WMT': 20}, {'MSFT': 5}):
+            my_portfolio = Portfolio(assets)
+            my_portfolio.calculate_alloc_from_shares()
+            my_portfolio.set_source(td)
+            my_portfolio.get_historical_portfolio_returns('2020-01-01', '2020-06-01')
+            portfolios.append(my_portfolio)
+        calls = transport.calls
+        sectors = ['SPY', 'QQQ', 'XLK', 'XLF']
+        table = portfolios[0].asset_beta(sectors)
+        self.assertEqual(table.shape, (2, 4))
+        self.assertIsInstance(portfolios[0].portfolio_beta('SPY'), float)
+        self.assertEqual(len(portfolios[1].asset_beta(sectors[1:])), 1)
+        self.assertEqual(transport.calls - calls, len(sectors))
+        self.assertAlmostEqual(portfolios[0].asset_beta('QQQ').loc['WMT'], table.loc['WMT', 'QQQ'])
+        combo = pd.concat([portfolios[0].portfolio_returns, portfolios[0].benchmark['SPY']], axis=1).dropna()
+        self.assertAlmostEqual(portfolios[0].portfolio_beta('SPY'), combo.cov().iloc[0, 1] / combo.iloc[:, 1].var())
+        rolling = portfolios[0].rolling_beta(['SPY', 'QQQ'], window=20)
+        self.assertEqual(rolling['beta'].shape, (len(rolling['index']), 3, 2))
+        decayed = portfolios[0].rolling_beta('SPY', halflife=20)
+        self.assertEqual(decayed['beta'].shape, (len(decayed['index']), 3, 1))
+        self.assertTrue(np.isfinite(decayed['beta'][-1]).all())
+        self.assertFalse(np.allclose(decayed['beta'][-1, :, 0], rolling['beta'][-1, :, 0]))
+        self.assertEqual(transport.calls - calls, len(sectors))
+
+    def test_rolling_betas_match_pandas(self):
+        rng = np.random.default_rng(1)
+        benchmark = rng.normal(0, 0.01, 200)
+        frame = pd.DataFrame({'x': 0.8 * benchmark + rng.normal(0, 0.005, 200), 'b': benchmark})
+        frame.iloc[30, 0] = np.nan
+        for kwargs in ({'window': 40}, {'halflife': 15}):
+            result = rolling_betas(frame[['x']].values, frame[['b']].values, **kwargs)
+            paired = frame.dropna().reindex(frame.index)
+            paired = paired.rolling(40) if 'window' in kwargs else paired.ewm(halflife=15)
+            beta = paired.cov().unstack()[('x', 'b')] / paired.var()['b']
+            found = np.isfinite(result['beta'][:, 0, 0])
+            self.assertTrue(np.allclose(result['beta'][found, 0, 0], beta[found]))
+            self.assertTrue(np.allclose(result['correlation'][found, 0, 0], paired.corr().unstack()[('x', 'b')][found]))
+
+
+class TestFinMetrics(unittest.TestCase):
+    """Test the NumPy metrics kernel against the Portfolio calculations, in float64 and float32"""
+    def test_kernel(self):
+        my_portfolio = Portfolio({'AAPL': 10, 'WMT': 20})
+        my_portfolio.calculate_alloc_from_shares()
+        my_portfolio.set_source(AMTD('key', session=SyntheticTransport()))
+        my_portfolio.get_historical_portfolio_value('2020-01-01', '2020-06-01')
+        kernel = my_portfolio.fin_metrics()
+        self.assertTrue(np.allclose(kernel.portfolio_returns[::-1], my_portfolio.portfolio_returns.values,
+                                    equal_nan=True))
+        self.assertAlmostEqual(kernel.metrics['Max Drawdown'], my_portfolio.max_drawdown()[0])
+        before = {k: np.copy(v) for k, v in kernel.metrics.items()}
+        volatility = kernel.calculate_volatility(window=20, annualized=False)
+        self.assertIs(my_portfolio.fin_metrics(), kernel)
+        for name, value in before.items():
+            self.assertTrue(np.array_equal(kernel.metrics[name], value, equal_nan=True), name)
+        self.assertTrue(np.allclose(volatility[::-1], my_portfolio.get_asset_volatility(annualized=False).values,
+                                    equal_nan=True))
+        small = my_portfolio.fin_metrics(np.float32)
+        self.assertEqual(small.returns_array.dtype, np.float32)
+        self.assertEqual(small.prices_array.nbytes * 2, kernel.prices_array.nbytes)
+        self.assertAlmostEqual(small.metrics['Gain/Loss'], kernel.metrics['Gain/Loss'], places=2)
+
+
+class TestFactorEngine(unittest.TestCase):
+    """Test the one solve factor regressions against per portfolio least squares"""
+    def test_stress_test_offline(self):
+        my_portfolio = Portfolio({'AAPL': 10, 'WMT': 20, 'MSFT': 5})
+        my_portfolio.calculate_alloc_from_shares()
+        my_portfolio.set_source(AMTD('key', session=SyntheticTransport()))
+        my_portfolio.get_historical_portfolio_value('2020-01-01', '2020-12-31')
+        stress = StressTest(my_portfolio)
+        stress.set_factors(['SPY', 'GLD', 'TLT'])
+        results = stress.regress()
+        self.assertEqual(results['betas'].shape, (4, 3))
+        self.assertEqual(results['names'][-1], 'Portfolio')
+        weights = np.random.default_rng(0).dirichlet(np.ones(3), size=50)
+        accounts = stress.regress(factors=['SPY', 'TLT'], weights=weights)
+        y = my_portfolio.asset_returns.values[::-1] @ weights[7]
+        x = np.column_stack([np.ones(len(y)), stress.factor_returns[:, [0, 2]]])[1:]
+        coef, ssr = np.linalg.lstsq(x, y[1:], rcond=None)[:2]
+        self.assertTrue(np.allclose(accounts['betas'][7], coef[1:]))
+        self.assertAlmostEqual(accounts['alpha'][7], coef[0])
+        sigma2 = ssr[0] / (len(x) - 3)
+        se = np.sqrt(np.diag(np.linalg.inv(x.T @ x)) * sigma2)
+        self.assertTrue(np.allclose(accounts['t_stats'][7], coef[1:] / se[1:]))
+        self.assertAlmostEqual(accounts['residual_volatility'][7], np.sqrt(sigma2))
+        self.assertAlmostEqual(accounts['r_squared'][7], 1 - ssr[0] / ((y[1:] - y[1:].mean()) ** 2).sum())
+
+        expanding = stress.rolling_exposures(factors=['SPY', 'TLT'], weights=weights)
+        self.assertEqual(expanding['betas'].shape, (len(y), 50, 2))
+        self.assertTrue(np.allclose(expanding['betas'][-1], accounts['betas']))
+        rolling = stress.rolling_exposures(window=60)
+        self.assertTrue(np.isnan(rolling['betas'][59]).all())
+        x = np.column_stack([np.ones(60), stress.factor_returns[-60:]])
+        coef = np.linalg.lstsq(x, my_portfolio.portfolio_returns.values[:60][::-1], rcond=None)[0]
+        self.assertTrue(np.allclose(rolling['betas'][-1, -1], coef[1:]))
+        weighted = stress.rolling_exposures(halflife=20)
+        self.assertTrue(np.isfinite(weighted['betas'][-1]).all())
+
+    def test_flat_factor(self):
+        rng = np.random.default_rng(3)
+        factors = rng.normal(0, 0.01, (120, 3))
+        factors[:80, 2] = 0
+        returns = factors[:, :2] @ [[1.0, 0.5], [0.2, -0.3]] + rng.normal(0, 0.001, (120, 2))
+        full = factor_regression(returns[:60], factors[:60])
+        coef = np.linalg.lstsq(np.column_stack([np.ones(60), factors[:60]]), returns[:60], rcond=None)[0]
+        self.assertTrue(np.allclose(full['betas'], coef[1:].T))
+        expanding = rolling_factor_regression(returns, factors)['betas']
+        self.assertTrue(np.isfinite(expanding[40:]).all())
+        self.assertTrue(np.allclose(expanding[59], full['betas']))
+        rolling = rolling_factor_regression(returns, factors, window=30)['betas']
+        self.assertTrue(np.isfinite(rolling[29:]).all())
+        coef = np.linalg.lstsq(np.column_stack([np.ones(30), factors[-30:]]), returns[-30:], rcond=None)[0]
+        self.assertTrue(np.allclose(rolling[-1], coef[1:].T))
+
+
+class TestScenarios(unittest.TestCase):
+    """Test the batched historical scenario replay"""
+    def test_replay(self):
+        td = AMTD('key', session=SyntheticTransport())
+        my_portfolio = Portfolio({'AAPL': 10, 'WMT': 20})
+        my_portfolio.calculate_alloc_from_shares()
+        my_portfolio.set_source(td)
+        my_portfolio.get_historical_portfolio_value('2021-01-01', '2021-12-31')
+        stress = StressTest(my_portfolio)
+        stress.set_factors(['SPY', 'TLT'])
+        stress.add_scenario('2020-03 Covid Crash')
+        stress.add_scenario('Custom', '2019-05-01', '2019-06-15')
+        tables = stress.run_scenarios()
+        self.assertEqual(tables['pnl'].shape, (3, 2))
+        closes = td.benchmarks.closes(['AAPL'], '2020-02-19', '2020-03-23')['AAPL']
+        self.assertAlmostEqual(tables['pnl'].loc['AAPL', '2020-03 Covid Crash'], closes.iloc[-1] / closes.iloc[0] - 1)
+        self.assertAlmostEqual(tables['max_drawdown'].loc['AAPL', '2020-03 Covid Crash'],
+                               (closes / closes.cummax() - 1).min())
+        self.assertTrue((tables['max_drawdown'].values <= 0).all())
+        accounts = stress.run_scenarios(weights=[[0.5, 0.5], [1, 0]], values=[1000, 2000])
+        self.assertAlmostEqual(accounts['pnl'].loc[1, 'Custom'], 2000 * tables['pnl'].loc['AAPL', 'Custom'])
+
+    def test_proxy(self):
+        scenarios = ScenarioSet(None, ['SPY'])
+        scenarios.add_scenario('shock', '2020-01-01', '2020-01-03')
+        scenarios._paths['shock'] = ((('NEW',), ('SPY',)), np.array([[np.nan], [np.nan]]), np.array([[-0.1], [0.05]]))
+        calls = []
+        tables = scenarios.run(['NEW'], [[1.0]], betas=lambda: calls.append(1) or [[2.0]])
+        self.assertEqual(len(calls), 1)
+        self.assertAlmostEqual(tables['pnl'].iloc[0, 0], np.exp(-0.1) - 1)
+        self.assertAlmostEqual(tables['max_drawdown'].iloc[0, 0], np.exp(-0.2) - 1)
+        with self.assertRaises(KeyError):
+            scenarios.run(['NEW'], [[1.0]])
+
+    def test_without_factors(self):
+        my_portfolio = Portfolio({'AAPL': 10, 'WMT': 20})
+        my_portfolio.calculate_alloc_from_shares()
+        my_portfolio.set_source(AMTD('key', session=SyntheticTransport()))
+        my_portfolio.get_historical_portfolio_value('2021-01-01', '2021-12-31')
+        stress = StressTest(my_portfolio)
+        stress.add_scenario('2020-03 Covid Crash')
+        self.assertEqual(stress.run_scenarios()['pnl'].shape, (3, 1))
+        stress.set_factors(['SPY', 'TLT'])
+        results = stress.regress(factors=['SPY'])
+        stress.run_scenarios()
+        self.assertIs(stress.regression_results, results)
+
+
+class TestEfficientFrontier(unittest.TestCase):
+    """Test the exact frontier against the closed form and against random sampling"""
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        returns = rng.normal(0.0004, 0.01, (750, 8)) + rng.normal(0, 0.01, (750, 1)) * rng.uniform(0, 1, 8)
+        self.mean = pd.Series(returns.mean(axis=0) * 250, index=['S{}'.format(i) for i in range(8)])
+        self.cov = np.cov(returns, rowvar=False) * 250
+        self.samples = rng.dirichlet(np.ones(8), size=50000)
+
+    def test_long_only(self):
+        ef = EfficientFrontier(self.mean, self.cov)
+        sampled = ef.table(self.samples)
+        min_variance = ef.table(ef.min_variance())
+        tangency = ef.table(ef.tangency())
+        self.assertLessEqual(min_variance['Volatility'].item(), sampled['Volatility'].min())
+        self.assertGreaterEqual(tangency['Sharpe Ratio'].item(), sampled['Sharpe Ratio'].max())
+        frontier = ef.frontier(20)
+        weights = frontier.filter(like='Weight').values
+        self.assertTrue((weights >= 0).all())
+        self.assertTrue(np.allclose(weights.sum(axis=1), 1))
+        self.assertTrue(frontier['Volatility'].is_monotonic_increasing)
+        self.assertAlmostEqual(frontier['Returns'].iloc[-1], self.mean.max())
+        with self.assertRaises(ValueError):
+            ef.weights_for_return(self.mean.max() + 0.1)
+
+    def test_unconstrained(self):
+        ef = EfficientFrontier(self.mean, self.cov, long_only=False)
+        inverse = np.linalg.inv(self.cov)
+        ones = np.ones(8)
+        self.assertTrue(np.allclose(ef.min_variance(), inverse @ ones / (ones @ inverse @ ones)))
+        weights = ef.weights_for_return(0.2)
+        self.assertAlmostEqual(weights @ self.mean.values, 0.2)
+        self.assertAlmostEqual(weights.sum(), 1)
+        self.assertTrue(np.allclose(ef.tangency(), inverse @ self.mean.values / (ones @ inverse @ self.mean.values)))
+        low = ef.mean @ ef.min_variance()
+        with self.assertRaisesRegex(ValueError, 'minimum variance'):
+            EfficientFrontier(self.mean, self.cov, risk_free=low + 0.01, long_only=False).tangency()
+
+    def test_singular_covariance(self):
+        mean = pd.concat([self.mean, pd.Series({'Copy': self.mean.iloc[0]})])
+        cov = np.pad(self.cov, ((0, 1), (0, 1)))
+        cov[-1, :-1] = cov[:-1, -1] = self.cov[0]
+        cov[-1, -1] = self.cov[0, 0]
+        weights = EfficientFrontier(mean, cov).min_variance()
+        self.assertAlmostEqual(weights.sum(), 1)
+        self.assertAlmostEqual(weights[0] + weights[-1], EfficientFrontier(self.mean, self.cov).min_variance()[0])
+        with self.assertRaises(np.linalg.LinAlgError):
+            EfficientFrontier(mean, cov, long_only=False).min_variance()
+
+
+class TestBlakefolio(unittest.TestCase):
+    """Test the sampled and exact frontiers of the older portfolio object on synthetic closes"""
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        symbols = ['AAPL', 'MSFT', 'TSLA', 'WMT']
+        self.folio = blakefolio()
+        self.folio.get_portfolio({s: 10 for s in symbols})
+        returns = rng.normal(0.0005, 0.012, (500, 4)) + rng.normal(0, 0.01, (500, 1))
+        self.folio.close = pd.DataFrame(100 * np.exp(np.cumsum(returns, axis=0)), columns=symbols)
+        self.folio.current_ps = self.folio.close.tail(1)
+
+    def test_markowitz_chunks(self):
+        self.folio.markowitz_ef(5000, chunk_size=700, seed=11)
+        chunked = self.folio.pf_df
+        weights = chunked.filter(like='Weight').values
+        self.assertEqual(chunked.shape, (5000, 7))
+        self.assertTrue(np.allclose(weights.sum(axis=1), 1) and (weights >= 0).all())
+        self.assertTrue(np.allclose(chunked['Sharpe Ratio'], chunked['Returns'] / chunked['Volatility']))
+        self.folio.markowitz_ef(5000, chunk_size=700, seed=11)
+        self.assertTrue(self.folio.pf_df.equals(chunked))
+        self.folio.markowitz_ef(5000, chunk_size=5000, seed=11)
+        self.assertTrue(np.allclose(self.folio.pf_df.values, chunked.values))
+
+    def test_exact_wrappers(self):
+        frontier = self.folio.efficient_frontier(points=10)
+        self.assertEqual(list(frontier.columns), list(self.folio.ef.table(self.folio.ef.min_variance()).columns))
+        self.assertAlmostEqual(self.folio.min_variance_port.loc['Volatility'].item(), frontier['Volatility'].min())
+        benchmark = self.folio.benchmark_frontier(2000)
+        self.assertLessEqual(benchmark.loc['Exact', 'Min Volatility'], benchmark.loc['Sampled', 'Min Volatility'])
+        self.assertGreaterEqual(benchmark.loc['Exact', 'Max Sharpe'], benchmark.loc['Sampled', 'Max Sharpe'])
+        self.folio.CB = pd.DataFrame({'currentBalances': [10000.0]}, index=['longMarketValue'])
+        balanced = self.folio.get_balanced_portfolio('sharpe', exact=True)
+        weights = self.folio.ef.tangency()
+        expected = np.round(weights * 10000 / self.folio.current_ps.values[0])
+        self.assertEqual(list(balanced.columns), sorted(self.folio.close.columns))
+        self.assertTrue(np.array_equal(balanced.values[0], expected[np.argsort(self.folio.close.columns)]))